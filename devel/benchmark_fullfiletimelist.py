@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Measure the time and the peak memory used to parse a large fullfiletimelist.
+
+A synthetic file is generated with about the requested number of lines, laid
+out like fullfiletimelist-fedora: directories of a few dozen files each.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from mirrormanager2.lib.fullfiletimelist import read_fullfiletimelist
+
+EXTENSIONS = (".rpm", ".drpm", ".iso", ".html", "-CHECKSUM", ".xml.gz")
+
+
+def write_fullfiletimelist(f, lines, files_per_dir):
+    f.write(b"[Version]\n2\n\n[Files]\n")
+    written = 0
+    dir_index = 0
+    while written < lines:
+        dirname = f"linux/releases/{dir_index // 1000}/Everything/x86_64/os/Packages/{dir_index}"
+        f.write(f"{1700000000 + dir_index}\td\t4096\t{dirname}\n".encode())
+        for file_index in range(random.randint(1, 2 * files_per_dir)):
+            ext = random.choice(EXTENSIONS)
+            f.write(
+                f"{1700000000 + file_index}\tf\t{random.randint(0, 10**9)}\t"
+                f"{dirname}/package-{file_index}-1.fc40.x86_64{ext}\n".encode()
+            )
+        written += file_index + 2
+        dir_index += 1
+    f.write(b"\n[Checksums SHA1]\n")
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=3_000_000, help="number of lines")
+    parser.add_argument("--files-per-dir", type=int, default=30, help="mean files per directory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--digests", action="store_true", help="also compute the digests of the directories"
+    )
+    parser.add_argument("--no-tracemalloc", action="store_true", help="only measure time")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    with tempfile.NamedTemporaryFile(prefix="fullfiletimelist-") as f:
+        lines = write_fullfiletimelist(f, args.lines, args.files_per_dir)
+        f.flush()
+        size = os.path.getsize(f.name)
+        print(f"Generated {lines} lines ({size / 1024**2:.1f} MiB)")
+
+        if not args.no_tracemalloc:
+            tracemalloc.start()
+        start = time.perf_counter()
+        fft = read_fullfiletimelist(f.name, with_digests=args.digests)
+        duration = time.perf_counter() - start
+        if not args.no_tracemalloc:
+            _current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    print(f"Parsed {len(fft.ctimes)} directories and {sum(map(len, fft.files.values()))} files")
+    print(f"Parse time: {duration:.2f}s")
+    if not args.no_tracemalloc:
+        print(f"Peak memory: {peak / 1024**2:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,652 @@
+"""Crawl the mirrors from an asyncio event loop.
+
+The default engine crawls each host in its own thread, with blocking connectors. This engine
+crawls all the hosts concurrently from a single event loop, which is much lighter when most of
+the time is spent waiting for the HTTP HEAD requests to complete. The number of simultaneous
+requests to a host is limited by its ``max_connections`` setting, and the database is accessed
+through a small pool of threads.
+
+Categories that can only be crawled with RSYNC or FTP fall back to the blocking connectors, in
+a separate thread.
+"""
+
+import asyncio
+import dataclasses
+import datetime
+import hashlib
+import logging
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from functools import partial
+from typing import NamedTuple
+
+import aiohttp
+import backoff
+
+import mirrormanager2.lib as mmlib
+from mirrormanager2.lib import model
+
+from . import threads
+from .connection_pool import ConnectionPool
+from .connector import SchemeNotAvailable, TryLater, _on_backoff, _on_giveup
+from .constants import (
+    ASYNC_CONNECTION_LIMIT,
+    ASYNC_DB_WORKERS,
+    CONNECTION_TIMEOUT,
+    REPODATA_FILE,
+    RETRIES,
+    RETRIES_MAX_INTERVAL,
+)
+from .continents import check_continent
+from .crawler import (
+    AllCategoriesFailed,
+    CategoryNotAccessible,
+    CrawlResult,
+    CrawlStats,
+    NoCategory,
+    get_crawl_status,
+    get_hcd_path,
+    get_preferred_urls,
+    is_unchanged_since,
+    select_host_categories_to_scan,
+)
+from .database import worker_session
+from .http_connector import HEADERS
+from .manifest import DirectoryManifest, ManifestStore
+from .reconciler import HostCategoryDirReconciler
+from .states import CrawlStatus
+from .threads import GlobalTimeoutError, ThreadTimeout
+from .ui import ProgressTask
+
+logger = logging.getLogger(__name__)
+
+
+class DirectoryEntry(NamedTuple):
+    id: int
+    name: str
+    readable: bool
+    manifest: DirectoryManifest
+    ctime: int | None = None
+
+
+@dataclasses.dataclass
+class HostCategoryPlan:
+    id: int
+    category_id: int
+    category_name: str
+    topdir_name: str
+    always_up2date: bool
+    urls: list[str]
+    last_full_scan: int | None = None
+
+
+@dataclasses.dataclass
+class HostPlan:
+    """What must be crawled on a host, loaded from the database before crawling."""
+
+    id: int
+    name: str
+    max_connections: int
+    skip: bool = False
+    host_categories: list[HostCategoryPlan] = dataclasses.field(default_factory=list)
+
+
+def _is_http(url):
+    return url.startswith(("http:", "https:"))
+
+
+def _load_host(session, options, host_id):
+    host = mmlib.get_host(session, host_id)
+    plan = HostPlan(id=host.id, name=host.name, max_connections=max(host.max_connections or 1, 1))
+    if host.private and not options["include_private"]:
+        plan.skip = True
+        return plan
+    with suppress(NoCategory):
+        for hc in select_host_categories_to_scan(session, options, host):
+            plan.host_categories.append(
+                HostCategoryPlan(
+                    id=hc.id,
+                    category_id=hc.category_id,
+                    category_name=hc.category.name,
+                    topdir_name=hc.category.topdir.name,
+                    always_up2date=hc.always_up2date,
+                    urls=get_preferred_urls(hc),
+                    last_full_scan=hc.last_full_scan,
+                )
+            )
+    return plan
+
+
+def _load_directories(session, options, manifests, category_id):
+    category = session.get(model.Category, category_id)
+    entries = []
+    for directory in mmlib.get_directories_by_category(session, category, options["repodata"]):
+        manifest = manifests.get(directory.id) if manifests is not None else None
+        if manifest is None:
+            manifest = DirectoryManifest.from_directory(directory)
+        entries.append(
+            DirectoryEntry(
+                directory.id, directory.name, directory.readable, manifest, directory.ctime
+            )
+        )
+    return entries
+
+
+def _count_directories(session, options, manifests, category_id):
+    category = session.get(model.Category, category_id)
+    return mmlib.count_directories_by_category(session, category, options["repodata"])
+
+
+def _check_continent(session, config, options, url):
+    check_continent(config, options, session, url)
+
+
+def _get_up2date_paths(session, host_category_id):
+    return {
+        row.path
+        for row in mmlib.get_hostcategorydirs_by_hostcategory(session, host_category_id)
+        if row.up2date
+    }
+
+
+def _sync_host_category(session, options, host_category, statuses, total, kept, scan_start):
+    hc = session.get(model.HostCategory, host_category.id)
+    stats = CrawlStats(total_directories=total)
+    reconciler = HostCategoryDirReconciler(session, hc)
+    for path in kept:
+        reconciler.keep_if_up2date(path)
+    for directory, status in statuses:
+        path = get_hcd_path(host_category.topdir_name, directory.name)
+        sync_status = reconciler.sync_dir(path, directory.id, status)
+        stats.increment(sync_status.value)
+    reconciler.flush()
+    stats.unchanged += reconciler.kept
+
+    # In repodata or canary mode we only want to update the files actually scanned.
+    # Do not mark files which have not been scanned as not being up to date.
+    if options["repodata"] or options["canary"]:
+        return stats
+
+    stats.unreadable += mmlib.count_hostcategorydirs_with_unreadable_dir(session, hc)
+    stats.hcds_deleted += reconciler.set_unseen_not_up2date()
+    hc.last_full_scan = scan_start
+    return stats
+
+
+async def _gather_or_cancel(*coroutines):
+    """Run the coroutines concurrently, and cancel them all as soon as one of them fails."""
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def _cancel_all_tasks(loop):
+    for task in asyncio.all_tasks(loop):
+        task.cancel()
+
+
+def sigalrm_handler(loop, signal, stackframe):
+    logger.warning("Received SIGALRM. Cancelling all the crawls.")
+    threads.shutdown = True
+    loop.call_soon_threadsafe(_cancel_all_tasks, loop)
+
+
+class TaskTimeout(ThreadTimeout):
+    """A ThreadTimeout for hosts that share the event loop's thread."""
+
+    def start(self):
+        self._starttime = time.monotonic()
+
+    def elapsed(self):
+        return time.monotonic() - self._starttime
+
+
+class DatabaseExecutor:
+    """Run the database operations of the event loop in a small pool of threads.
+
+    Each operation gets its own session, which is committed when the operation is done.
+    """
+
+    def __init__(self, db_manager, max_workers):
+        self._db_manager = db_manager
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="crawler-db"
+        )
+
+    def _call(self, fn, args):
+        with worker_session(self._db_manager) as session:
+            result = fn(session, *args)
+            session.commit()
+        return result
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self._call, fn, args)
+
+    def shutdown(self):
+        self._executor.shutdown(cancel_futures=True)
+
+
+class CategoryDirectories:
+    """The directories of each category, loaded once and shared by all the hosts."""
+
+    def __init__(self, db, options, manifests):
+        self._db = db
+        self._options = options
+        self._manifests = manifests
+        self._tasks = {}
+
+    def _get(self, fn, category_id):
+        key = (fn, category_id)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.ensure_future(
+                self._db.run(fn, self._options, self._manifests, category_id)
+            )
+        # Don't cancel the loading for the other hosts if this one is cancelled
+        return asyncio.shield(self._tasks[key])
+
+    async def get(self, category_id):
+        return await self._get(_load_directories, category_id)
+
+    async def count(self, category_id):
+        return await self._get(_count_directories, category_id)
+
+
+class AsyncCrawler:
+    def __init__(self, engine, host, progress):
+        self.engine = engine
+        self.config = engine.config
+        self.options = engine.options
+        self.host = host
+        self.progress = progress
+        self.timeout = TaskTimeout(self.options["host_timeout"])
+
+    async def crawl(self):
+        """Scan all the categories of the host, like Crawler.crawl()."""
+        self.timeout.start()
+        if not self.host.host_categories:
+            raise NoCategory
+        successful_categories = 0
+        stats = CrawlStats()
+
+        for hc in self.host.host_categories:
+            self.timeout.check()
+            self.progress.reset()
+            self.progress.set_action(hc.category_name)
+            if hc.always_up2date:
+                successful_categories += 1
+                continue
+            try:
+                category_stats = await self._scan_host_category(hc)
+            except CategoryNotAccessible:
+                continue
+            else:
+                successful_categories += 1
+            stats.update(category_stats)
+
+        if successful_categories == 0:
+            raise AllCategoriesFailed
+
+        return stats
+
+    async def check_for_base_dir(self, urls):
+        """Check if at least one of the HTTP(S) URLs exists on the remote host."""
+        for url in urls:
+            if not _is_http(url):
+                continue
+            self.timeout.check()
+            try:
+                async with self.engine.http.head(url) as response:
+                    exists = response.ok
+            except Exception as e:
+                exists = False
+                logger.info("Could not get the base dir on %s: %s", url, e)
+            if not exists:
+                logger.warning("Base URL %s does not exist.", url)
+                continue
+            return True
+        return False
+
+    async def _scan_host_category(self, hc):
+        msg = f"scanning category {hc.category_name}"
+        if self.options["canary"]:
+            msg = f"canary {msg}"
+        elif self.options["repodata"]:
+            msg = f"repodata {msg}"
+        logger.debug(msg)
+
+        scan_start = int(time.time())
+        if self.options["canary"]:
+            directories = []
+            total = await self.engine.directories.count(hc.category_id)
+        else:
+            directories = await self.engine.directories.get(hc.category_id)
+            total = len(directories)
+        self.progress.set_total(total)
+
+        kept = []
+        if self.options.get("delta") and directories:
+            directories, kept = await self._select_changed_directories(hc, directories)
+
+        statuses = await self._get_directory_statuses(hc, directories)
+        return await self.engine.db.run(
+            _sync_host_category, self.options, hc, statuses, total, kept, scan_start
+        )
+
+    async def _select_changed_directories(self, hc, directories):
+        """Same as Crawler._select_changed_directories()"""
+        up2date_paths = await self.engine.db.run(_get_up2date_paths, hc.id)
+        selected = []
+        kept = []
+        for directory in directories:
+            path = get_hcd_path(hc.topdir_name, directory.name)
+            if is_unchanged_since(directory.ctime, hc.last_full_scan) and path in up2date_paths:
+                kept.append(path)
+                self.progress.advance()
+                continue
+            selected.append(directory)
+        logger.debug("Delta crawl of %s: checking %s directories", hc.category_name, len(selected))
+        return selected, kept
+
+    async def _get_directory_statuses(self, hc, directories):
+        urls = hc.urls
+        if not urls:
+            logger.debug("No URLs: %s", repr(urls))
+            raise CategoryNotAccessible
+
+        if self.options["continents"]:
+            # Only check for continent if something specified
+            # on the command-line
+            await self.engine.db.run(_check_continent, self.config, self.options, urls[0])
+
+        if not await self.check_for_base_dir(urls):
+            logger.debug("Base directory not accessible: %s", repr(urls))
+            raise CategoryNotAccessible
+
+        if self.options["canary"]:
+            return []
+
+        category_prefix_length = len(hc.topdir_name)
+        if category_prefix_length > 0:
+            category_prefix_length += 1
+
+        # HTTP(S) URLs are checked from the event loop, prefer them to the blocking connectors.
+        for url in sorted(urls, key=lambda url: not _is_http(url)):
+            if url.endswith("/"):
+                url = url[:-1]
+
+            logger.debug("Crawling %s with URL %s", hc.category_name, url)
+
+            # No rsync in repodata mode, we only retrive a small subset of
+            # existing files
+            if self.options["repodata"] and url.startswith("rsync:"):
+                continue
+
+            try:
+                if _is_http(url):
+                    return await self._check_directories(url, directories, category_prefix_length)
+                return await asyncio.to_thread(
+                    self._check_directories_blocking, url, directories, category_prefix_length
+                )
+            except SchemeNotAvailable:
+                logger.debug(f"Scheme {url} is not available")
+                continue
+        logger.debug("Category %s is not accessible with any URL. Tried %s", hc.category_name, urls)
+        raise CategoryNotAccessible
+
+    async def _check_directories(self, url, directories, category_prefix_length):
+        statuses = [None] * len(directories)
+        remaining = iter(enumerate(directories))
+
+        async def check_remaining():
+            for index, directory in remaining:
+                self.timeout.check()
+                dir_url = f"{url}/{directory.name[category_prefix_length:]}"
+                try:
+                    status = await self.check_dir(dir_url, directory)
+                except TryLater as e:
+                    # We backed off a few times but it's still in timeout
+                    raise SchemeNotAvailable from e
+                statuses[index] = (directory, status)
+                self.progress.advance()
+
+        # Each of those checks up to one file at a time, there are as many as the host allows
+        # simultaneous connections.
+        await _gather_or_cancel(*(check_remaining() for _ in range(self.host.max_connections)))
+        return statuses
+
+    def _check_directories_blocking(self, url, directories, category_prefix_length):
+        manifests = ManifestStore({directory.id: directory.manifest for directory in directories})
+        connection_pool = ConnectionPool(
+            self.config, debuglevel=2 if self.options["debug"] else 0, manifests=manifests
+        )
+        statuses = []
+        try:
+            connector = connection_pool.get(url)
+            connector.prepare_category(url, directories, category_prefix_length)
+            for directory in directories:
+                self.timeout.check()
+                status = connector.check_category(url, directory, category_prefix_length)
+                statuses.append((directory, status))
+                self.progress.advance()
+        finally:
+            connection_pool.close_all()
+        return statuses
+
+    @backoff.on_exception(
+        backoff.expo,
+        TryLater,
+        max_tries=RETRIES,
+        max_value=RETRIES_MAX_INTERVAL,
+        on_backoff=_on_backoff,
+        on_giveup=_on_giveup,
+        logger=None,  # custom logging
+    )
+    async def check_dir(self, url, directory):
+        manifest = directory.manifest
+        for file_entry in manifest.files:
+            file_url = f"{url}/{file_entry.name}"
+            exists = await self._check_file(file_url, file_entry, directory.readable)
+            if file_entry.name == REPODATA_FILE and exists:
+                # Additional optional check
+                with suppress(Exception):
+                    exists = await self._compare_sha256(manifest, file_url)
+            if exists in (False, None):
+                # Shortcut: we don't need to go over other files
+                return exists
+        return True
+
+    async def _check_file(self, url, file_entry, readable):
+        """Same as HTTPConnector._check_file()"""
+        try:
+            async with self.engine.http.head(url) as response:
+                response.raise_for_status()
+                content_length = response.headers.get("Content-Length")
+        except asyncio.TimeoutError as e:
+            raise TryLater(f"HTTP timeout: {e}") from e
+        except aiohttp.ClientResponseError as e:
+            if e.status in (404, 410):
+                # Not Found / Gone
+                return False
+            if e.status == 403:
+                # may be a hidden dir still
+                if readable:
+                    # It should be readable but it's not
+                    return False
+                else:
+                    # This 403 is allowed
+                    return None
+            logger.debug("Could not get the content length for %s: %s", url, e)
+            return None
+        except aiohttp.ClientError as e:
+            logger.debug("Could not get the content length for %s: %s", url, e)
+            return None
+
+        if content_length is None:
+            logger.debug("No content length header for %s", url)
+            return True
+        if file_entry is None:
+            # The file/directory seems to exist, no additional check possible
+            return True
+        # fixme should check last_modified too
+        if float(file_entry.size) != float(content_length):
+            return False
+
+        # handle streaming/chunked return or zero-length file
+        return True
+
+    async def _compare_sha256(self, manifest, url):
+        try:
+            async with self.engine.http.get(url) as response:
+                response.raise_for_status()
+                sha256 = hashlib.sha256(await response.read()).hexdigest()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            logger.debug("Could not get %s", url)
+            return False
+        if manifest.repomd_sha256 is None:
+            return False
+        if manifest.repomd_sha256 != sha256:
+            logger.debug(f"Found {url} with sha {sha256}, but expected {manifest.repomd_sha256}")
+            return False
+        return True
+
+
+class AsyncCrawlEngine:
+    """Crawl all the hosts concurrently from an event loop."""
+
+    def __init__(self, options, config, db_manager, manifests):
+        self.options = options
+        self.config = config
+        self.db = DatabaseExecutor(
+            db_manager, max_workers=min(options["threads"], ASYNC_DB_WORKERS)
+        )
+        self.directories = CategoryDirectories(self.db, options, manifests)
+        self.http = None
+        # The names of the hosts loaded so far, to report the cancelled crawls
+        self.host_names = {}
+
+    async def _open(self):
+        self.http = aiohttp.ClientSession(
+            headers=HEADERS,
+            connector=aiohttp.TCPConnector(limit=ASYNC_CONNECTION_LIMIT),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=CONNECTION_TIMEOUT, sock_read=CONNECTION_TIMEOUT
+            ),
+        )
+
+    async def _close(self):
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    async def crawl_host(self, progress_bar, host_id):
+        progress = ProgressTask(progress_bar, host_id)
+        try:
+            host = await self.db.run(_load_host, self.options, host_id)
+            self.host_names[host_id] = host.name
+            progress.set_host_name(host.name)
+            if host.skip:
+                return None
+            logger.debug(f"Starting crawl of host {host.id} ({host.name})")
+            crawler = AsyncCrawler(self, host, progress)
+            details = None
+            stats = None
+            try:
+                stats = await crawler.crawl()
+            except (Exception, KeyboardInterrupt) as e:
+                status, details = get_crawl_status(self.options, host.id, host.name, e)
+            else:
+                status = CrawlStatus.OK
+            logger.debug(f"Ending crawl of host {host.id} ({host.name})")
+            return CrawlResult(
+                host_id=host.id,
+                host_name=host.name,
+                status=status.value,
+                details=details,
+                finished_at=datetime.datetime.now(tz=datetime.timezone.utc),
+                duration=crawler.timeout.elapsed(),
+                stats=stats,
+            )
+        finally:
+            progress.finish()
+
+    def _cancelled_result(self, host_id, duration):
+        """Return the result of a host whose crawl was cancelled by the global timeout."""
+        host_name = self.host_names.get(host_id)
+        status, details = get_crawl_status(
+            self.options,
+            host_id,
+            host_name,
+            GlobalTimeoutError(f"Maximum run time reached, crawl of host {host_id} cancelled"),
+        )
+        return CrawlResult(
+            host_id=host_id,
+            host_name=host_name,
+            status=status.value,
+            details=details,
+            finished_at=datetime.datetime.now(tz=datetime.timezone.utc),
+            duration=duration,
+        )
+
+    def run(self, host_ids, progress_bar, timeout):
+        """Crawl the hosts and yield their results as they complete.
+
+        This has the same semantics as run_in_threadpool().
+        """
+        threads.max_global_execution_dt = datetime.datetime.now() + datetime.timedelta(
+            seconds=timeout
+        )
+        starttime = time.monotonic()
+        timed_out = False
+        loop = asyncio.new_event_loop()
+        signal.signal(signal.SIGALRM, partial(sigalrm_handler, loop))
+        loop.run_until_complete(self._open())
+        tasks = {
+            loop.create_task(self.crawl_host(progress_bar, host_id)): host_id
+            for host_id in host_ids
+        }
+        pending = set(tasks)
+        try:
+            while pending:
+                try:
+                    done, pending = loop.run_until_complete(
+                        asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    )
+                except asyncio.CancelledError:
+                    # SIGALRM cancelled all the tasks, including this wait: let the crawls
+                    # finish their cancellation and report the hosts that completed anyway.
+                    logger.info("Maximum run time reached, draining the cancelled crawls")
+                    timed_out = True
+                    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+                    done, pending = pending, set()
+                for task in done:
+                    if task.cancelled():
+                        yield self._cancelled_result(tasks[task], time.monotonic() - starttime)
+                        continue
+                    try:
+                        yield task.result()
+                    except Exception:
+                        logger.exception("Crawler failed!")
+        except (Exception, KeyboardInterrupt) as e:
+            if isinstance(e, KeyboardInterrupt):
+                logger.info("Cancelling all the crawls")
+            else:
+                logger.exception("Unhandled error in the event loop")
+            threads.shutdown = True
+            _cancel_all_tasks(loop)
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            raise
+        finally:
+            loop.run_until_complete(self._close())
+            self.db.shutdown()
+            loop.close()
+            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        if timed_out or datetime.datetime.now() > threads.max_global_execution_dt:
+            raise GlobalTimeoutError("maximum run time reached, some host statuses are unknown")
@@ -0,0 +1,122 @@
+"""Parse the directory listings generated by the HTTP servers.
+
+Apache, nginx and lighttpd can generate an HTML page listing the content of a directory. All
+of them put each file in a link, followed by its modification date and its size, either in
+bytes or in a human-readable form such as ``1.2K``.
+"""
+
+import re
+from html.parser import HTMLParser
+from typing import NamedTuple
+from urllib.parse import unquote
+
+SIZE_RE = re.compile(r"^(?P<value>\d+(?:\.\d+)?)(?P<unit>[KMGTP])?i?B?$", re.IGNORECASE)
+SIZE_UNITS = {None: 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4, "P": 1024**5}
+# Tags that end the cells of a listing's row
+ROW_END_TAGS = ("tr", "pre", "table")
+# The servers round the human-readable sizes to the last displayed digit, some of them with
+# slightly different rules: accept a bit more than half of that digit.
+ROUNDING_SLOP = 0.05
+
+
+class ListedSize(NamedTuple):
+    value: float
+    # The tolerance on the value, in bytes: less than 1 for exact sizes, about half of the
+    # last displayed digit for human-readable ones
+    precision: float
+
+    def matches(self, size):
+        return abs(size - self.value) < self.precision
+
+
+def parse_size(text):
+    match = SIZE_RE.match(text)
+    if match is None:
+        return None
+    unit = match.group("unit")
+    if unit is not None:
+        unit = unit.upper()
+    multiplier = SIZE_UNITS[unit]
+    value = match.group("value")
+    decimals = len(value.partition(".")[2])
+    step = multiplier / 10**decimals
+    return ListedSize(float(value) * multiplier, step * (0.5 + ROUNDING_SLOP))
+
+
+def _get_file_name(href):
+    if not href or href.startswith(("/", "?", "#", "../")) or ":" in href:
+        return None
+    name = unquote(href.split("?", 1)[0])
+    if name.startswith("./"):
+        name = name[2:]
+    if not name or "/" in name:
+        # Sub-directory
+        return None
+    return name
+
+
+class AutoindexParser(HTMLParser):
+    """Extract the files and their sizes from a directory listing.
+
+    The listing can be fed in chunks as it is downloaded. Only the files in ``wanted`` are
+    kept, to use as little memory as possible on very large directories.
+    """
+
+    def __init__(self, wanted):
+        super().__init__(convert_charrefs=True)
+        self.wanted = wanted
+        # The number of links to files that were found, wanted or not
+        self.links = 0
+        self.entries = {}
+        self._current = None
+        self._in_link = False
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            self._text.append(" ")
+            return
+        self._end_entry()
+        self._in_link = True
+        name = _get_file_name(dict(attrs).get("href"))
+        if name is not None:
+            self.links += 1
+            self._current = name
+
+    def handle_endtag(self, tag):
+        if tag == "a":
+            self._in_link = False
+        elif tag in ROW_END_TAGS:
+            self._end_entry()
+        # The text of a cell must not be glued to the next one
+        self._text.append(" ")
+
+    def handle_data(self, data):
+        # Ignore the link's text, it may look like a size too. The text can be split in
+        # several calls when the listing is fed in chunks.
+        if self._current is not None and not self._in_link:
+            self._text.append(data)
+
+    def close(self):
+        super().close()
+        self._end_entry()
+
+    def _get_size(self):
+        # The first token of the text after the link that looks like a size. The dates are not
+        # mistaken for sizes because they contain dashes or colons.
+        for token in "".join(self._text).split():
+            size = parse_size(token)
+            if size is not None:
+                return size
+        return None
+
+    def _end_entry(self):
+        if self._current is None:
+            return
+        if self._current in self.wanted:
+            size = self._get_size()
+            # Icons can be links to the file too, don't override the size of the file's entry
+            if size is not None or self._current not in self.entries:
+                self.entries[self._current] = size
+        self._current = None
+        self._text = []
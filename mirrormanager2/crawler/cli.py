@@ -9,15 +9,16 @@ from rich.console import Console
 from rich.progress import Progress
 
 from mirrormanager2.lib import get_categories, get_category_by_name, get_mirrors, model, read_config
-from mirrormanager2.lib.database import get_db_manager
 from mirrormanager2.lib.fedora import get_current_versions
 
 from .constants import CONTINENTS, DEFAULT_GLOBAL_TIMEOUT
 from .crawler import CrawlResult, PropagationResult, worker
+from .database import get_crawler_db_manager
 from .log import setup_logging
+from .manifest import ManifestStore
 from .reporter import store_crawl_result
 from .threads import GlobalTimeoutError, run_in_threadpool
-from .ui import human_duration, report_crawl, report_propagation
+from .ui import human_duration, report_crawl, report_pool_stats, report_propagation
 
 logger = logging.getLogger(__name__)
 
@@ -139,7 +140,9 @@ def validate_continents(ctx, param, value):
     help="Always exit with status code zero",
 )
 @click.pass_context
-def main(ctx, config, debug, include_disabled, categories, startid, stopid, fraction, **kwargs):
+def main(
+    ctx, config, debug, include_disabled, categories, startid, stopid, fraction, threads, **kwargs
+):
     ctx.ensure_object(dict)
     ctx.obj["console"] = Console()
 
@@ -147,7 +150,9 @@ def main(ctx, config, debug, include_disabled, categories, startid, stopid, frac
     ctx.obj["options"] = ctx.params
     config = read_config(config)
     ctx.obj["config"] = config
-    db_manager = get_db_manager(config)
+    # One engine for the whole process, its pool is shared by all the worker threads
+    db_manager = get_crawler_db_manager(config, threads)
+    ctx.obj["db_manager"] = db_manager
     with db_manager.Session() as session:
         category_ids = []
         for category_name in categories:
@@ -160,6 +165,7 @@ def main(ctx, config, debug, include_disabled, categories, startid, stopid, frac
                     f"Available categories: {available_categories}",
                 )
             category_ids.append(category.id)
+        ctx.obj["category_ids"] = category_ids or [c.id for c in get_categories(session)]
         # Get *all* of the mirrors
         hosts = get_mirrors(
             session,
@@ -210,15 +216,29 @@ def run_on_all_hosts(ctx_obj, options, report):
     error = None
     with Progress(console=ctx_obj["console"], refresh_per_second=1) as progress:
         task_global = progress.add_task(f"Crawling {len(host_ids)} mirrors", total=len(host_ids))
-        threads_results = run_in_threadpool(
-            worker,
-            host_ids,
-            fn_args=(options, ctx_obj["config"], progress),
-            timeout=options["global_timeout"],
-            executor_kwargs={
-                "max_workers": options["threads"],
-            },
-        )
+        if options.get("engine") == "async":
+            from .async_engine import AsyncCrawlEngine
+
+            engine = AsyncCrawlEngine(
+                options, ctx_obj["config"], ctx_obj["db_manager"], ctx_obj.get("manifests")
+            )
+            threads_results = engine.run(host_ids, progress, timeout=options["global_timeout"])
+        else:
+            threads_results = run_in_threadpool(
+                worker,
+                host_ids,
+                fn_args=(
+                    options,
+                    ctx_obj["config"],
+                    ctx_obj["db_manager"],
+                    ctx_obj.get("manifests"),
+                    progress,
+                ),
+                timeout=options["global_timeout"],
+                executor_kwargs={
+                    "max_workers": options["threads"],
+                },
+            )
         try:
             for result in threads_results:
                 progress.advance(task_global)
@@ -231,6 +251,7 @@ def run_on_all_hosts(ctx_obj, options, report):
 
     # Report what we have even if there was an error
     report(ctx_obj, options, results)
+    report_pool_stats(ctx_obj["console"], ctx_obj["db_manager"].pool_stats)
     duration = human_duration(time.monotonic() - starttime)
     if error is None:
         click.echo(f"Crawler finished after {duration}")
@@ -253,10 +274,29 @@ def run_on_all_hosts(ctx_obj, options, report):
     default=False,
     help="Fast crawl by only checking if the repodata is up to date",
 )
+@click.option(
+    "--delta",
+    is_flag=True,
+    default=False,
+    help="Only check the directories that changed since the last crawl or are not up to date",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["threads", "async"]),
+    default="threads",
+    help="Crawl each host in its own thread, or all the hosts from an event loop",
+    show_default=True,
+)
 @click.pass_context
 def crawl(ctx, **kwargs):
     options = ctx.obj["options"]
     options.update(ctx.params)
+    if not options["canary"]:
+        # Decode the expected content of the directories once for all the hosts
+        with ctx.obj["db_manager"].Session() as session:
+            ctx.obj["manifests"] = ManifestStore.build(
+                session, ctx.obj["category_ids"], only_repodata=options["repodata"]
+            )
     run_on_all_hosts(ctx.obj, options, record_crawl)
 
 
@@ -264,7 +304,7 @@ def record_crawl(ctx_obj, options, results: list[CrawlResult]):
     console = ctx_obj["console"]
     config = ctx_obj["config"]
     options = ctx_obj["options"]
-    db_manager = get_db_manager(config)
+    db_manager = ctx_obj["db_manager"]
     with db_manager.Session() as session:
         for result in results:
             store_crawl_result(config, options, session, result)
@@ -318,8 +358,7 @@ def propagation(ctx, **kwargs):
 
 def record_propagation(ctx_obj, options, results: list[PropagationResult]):
     console = ctx_obj["console"]
-    config = ctx_obj["config"]
-    db_manager = get_db_manager(config)
+    db_manager = ctx_obj["db_manager"]
     repo_status = defaultdict(lambda: defaultdict(lambda: 0))
     for result in results:
         for repo_id, status in result.repo_status.items():
@@ -22,10 +22,12 @@ def _get_connection_class(scheme):
 
 
 class ConnectionPool:
-    def __init__(self, config, debuglevel=0):
+    def __init__(self, config, debuglevel=0, manifests=None, max_connections=1):
         self._connections = {}
         self.config = config
         self.debuglevel = debuglevel
+        self.manifests = manifests
+        self.max_connections = max_connections
 
     def _get_key(self, url):
         scheme, netloc, path, query, fragment = urlsplit(url)
@@ -49,6 +51,8 @@ class ConnectionPool:
                 netloc=netloc,
                 debuglevel=self.debuglevel,
                 on_closed=partial(self._remove_connection, key),
+                manifests=self.manifests,
+                max_connections=self.max_connections,
             )
             # self._connections[key] = self._connect(netloc)
             # self._connections[key].set_debuglevel(self.debuglevel)
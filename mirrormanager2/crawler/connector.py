@@ -2,11 +2,9 @@ import hashlib
 import logging
 
 import backoff
-from sqlalchemy.orm import object_session
-
-from mirrormanager2 import lib as mmlib
 
 from .constants import RETRIES, RETRIES_MAX_INTERVAL
+from .manifest import DirectoryManifest
 
 logger = logging.getLogger(__name__)
 
@@ -44,12 +42,14 @@ def _on_giveup(details):
 class Connector:
     scheme = None
 
-    def __init__(self, config, netloc, debuglevel, on_closed):
+    def __init__(self, config, netloc, debuglevel, on_closed, manifests=None, max_connections=1):
         self._config = config
         self._netloc = netloc
         self.debuglevel = debuglevel
         self._connection = None
         self._on_closed = on_closed
+        self._manifests = manifests
+        self._max_connections = max_connections
 
     def get_connection(self):
         if self._connection is None:
@@ -86,31 +86,42 @@ class Connector:
     def _check_dir(self, url, directory):
         raise NotImplementedError
 
+    def get_manifest(self, directory):
+        """Return the expected content of a directory.
+
+        Use the crawl-wide manifest store if there is one, and fall back to the database.
+        """
+        if self._manifests is not None:
+            manifest = self._manifests.get(directory.id)
+            if manifest is not None:
+                return manifest
+        return DirectoryManifest.from_directory(directory)
+
     def get_sha256(self, graburl):
         """looks for a FileDetails object that matches the given URL"""
         contents = self._get_file(graburl)
         return hashlib.sha256(contents).hexdigest()
 
-    def compare_sha256(self, directory, filename, graburl):
-        """looks for a FileDetails object that matches the given URL"""
+    def compare_sha256(self, manifest, filename, graburl):
+        """compares the checksum of the given URL with the one in the manifest"""
         try:
             sha256 = self.get_sha256(graburl)
         except FetchingFailed:
             logger.debug("Could not get %s", graburl)
             return False
-        session = object_session(directory)
-        latest_file_detail = mmlib.get_file_detail(
-            session, filename, directory_id=directory.id, reverse=True
-        )
-        if latest_file_detail is None:
+        if manifest.repomd_sha256 is None:
             return False
-        if latest_file_detail.sha256 != sha256:
+        if manifest.repomd_sha256 != sha256:
             logger.debug(
-                f"Found {filename} with sha {sha256}, but expected {latest_file_detail.sha256}"
+                f"Found {filename} with sha {sha256}, but expected {manifest.repomd_sha256}"
             )
             return False
         return True
 
+    def prepare_category(self, url, directories, category_prefix_length):
+        """Called with all the directories of a category before they are checked."""
+        pass
+
     def _get_dir_url(self, url, directory, category_prefix_length):
         dirname = directory.name[category_prefix_length:]
         return f"{url}/{dirname}"
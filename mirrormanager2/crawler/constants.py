@@ -12,6 +12,17 @@ SHUTDOWN_TIMEOUT = 5
 
 CONNECTION_TIMEOUT = 10  # seconds
 
+# Size of the chunks in which the HTTP directory listings are downloaded and parsed
+LISTING_CHUNK_SIZE = 65536  # bytes
+
 # Number of times to retry a connection
 RETRIES = 10
 RETRIES_MAX_INTERVAL = 10  # in seconds
+
+# Number of HostCategoryDir rows written to the database in a single statement
+HCD_BATCH_SIZE = 1000
+
+# Asynchronous engine: maximum number of simultaneous HTTP connections for the whole crawl
+ASYNC_CONNECTION_LIMIT = 1000
+# Asynchronous engine: number of threads running the database operations
+ASYNC_DB_WORKERS = 4
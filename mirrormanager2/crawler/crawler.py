@@ -1,20 +1,21 @@
 import dataclasses
 import datetime
 import logging
+import time
 from collections import defaultdict
 
 import mirrormanager2.lib as mmlib
 from mirrormanager2.lib.constants import PROPAGATION_ARCH
-from mirrormanager2.lib.database import get_db_manager
 from mirrormanager2.lib.fedora import get_propagation_repo_prefix
-from mirrormanager2.lib.model import HostCategoryDir
 
 from .connection_pool import ConnectionPool
 from .connector import FetchingFailed, SchemeNotAvailable
 from .constants import REPODATA_DIR, REPODATA_FILE
 from .continents import BrokenBaseUrl, EmbargoedCountry, WrongContinent, check_continent
+from .database import worker_session
 from .log import thread_file_logger
-from .states import CrawlStatus, PropagationStatus, SyncStatus
+from .reconciler import HostCategoryDirReconciler
+from .states import CrawlStatus, PropagationStatus
 from .threads import (
     GlobalTimeoutError,
     HostTimeoutError,
@@ -104,14 +105,51 @@ def get_preferred_urls(host_category):
     return urls
 
 
+def select_host_categories_to_scan(session, options, host, ignore_empty=False):
+    result = []
+    if options["categories"]:
+        for category in options["categories"]:
+            hc = mmlib.get_host_category_by_hostid_category(
+                session, host_id=host.id, category=category
+            )
+            if hc is not None:
+                result.append(hc)
+    else:
+        result = list(host.categories)
+    if not result and not ignore_empty:
+        # If the host has no categories do not auto-disable it. Just skip the host.
+        raise NoCategory
+    return result
+
+
+def get_hcd_path(topdir_name, directory_name):
+    """Return the path of a HostCategoryDir, relative to the category's top directory."""
+    toplen = len(topdir_name)
+    if directory_name.startswith("/"):
+        toplen += 1
+    return directory_name[toplen:]
+
+
+def is_unchanged_since(directory_ctime, last_full_scan):
+    """Whether a directory has not changed since the last complete scan of its category."""
+    if last_full_scan is None or directory_ctime is None:
+        return False
+    return directory_ctime <= last_full_scan
+
+
 class Crawler:
-    def __init__(self, config, session, options, progress, host):
+    def __init__(self, config, session, options, progress, host, manifests=None):
         self.config = config
         self.options = options
         self.session = session
         self.progress = progress
         self.host = host
-        self.connection_pool = ConnectionPool(config, debuglevel=2 if options["debug"] else 0)
+        self.connection_pool = ConnectionPool(
+            config,
+            debuglevel=2 if options["debug"] else 0,
+            manifests=manifests,
+            max_connections=host.max_connections or 1,
+        )
         self.timeout = ThreadTimeout(options["host_timeout"])
         self.host_category_dirs = {}
 
@@ -135,20 +173,9 @@ class Crawler:
     #     self.add_parents(host_category_dirs, parentDir, topdir)
 
     def select_host_categories_to_scan(self, ignore_empty=False):
-        result = []
-        if self.options["categories"]:
-            for category in self.options["categories"]:
-                hc = mmlib.get_host_category_by_hostid_category(
-                    self.session, host_id=self.host.id, category=category
-                )
-                if hc is not None:
-                    result.append(hc)
-        else:
-            result = list(self.host.categories)
-        if not result and not ignore_empty:
-            # If the host has no categories do not auto-disable it. Just skip the host.
-            raise NoCategory
-        return result
+        return select_host_categories_to_scan(
+            self.session, self.options, self.host, ignore_empty=ignore_empty
+        )
 
     def crawl(self):
         """This function scans all categories a host has defined.
@@ -249,16 +276,16 @@ class Crawler:
         # logger.info("Category %s has %s directories", hc.category.name, trydirs_count)
 
         stats = CrawlStats(total_directories=trydirs_count)
-        seen_hcds = set()
+        reconciler = HostCategoryDirReconciler(self.session, hc)
+        scan_start = int(time.time())
 
-        for directory, status in self._get_directory_statuses(hc):
+        for directory, status in self._get_directory_statuses(hc, reconciler):
             self.timeout.check()
             self.progress.advance()
-            sync_status, hcd_id = self.sync_dir(hc, directory, status)
+            sync_status = self.sync_dir(hc, reconciler, directory, status)
             stats.increment(sync_status.value)
-            if hcd_id is not None:
-                # It's None on unknown status
-                seen_hcds.add(hcd_id)
+        reconciler.flush()
+        stats.unchanged += reconciler.kept
         # Expire the session to unload the directory entries
         self.session.commit()
 
@@ -271,12 +298,27 @@ class Crawler:
         # we wait for a cascading Directory delete to delete this
         # It is VERY memory-hungry to list hc.directories, so make specific DB queries.
         stats.unreadable += mmlib.count_hostcategorydirs_with_unreadable_dir(self.session, hc)
-        stats.hcds_deleted += mmlib.set_hostcategorydirs_not_up2date(self.session, hc, seen_hcds)
+        stats.hcds_deleted += reconciler.set_unseen_not_up2date()
+        hc.last_full_scan = scan_start
         self.session.commit()
 
         return stats
 
-    def _get_directory_statuses(self, hc):
+    def _select_changed_directories(self, hc, directories, reconciler):
+        """Only keep the directories that changed since the last complete scan of the category,
+        or that were not up2date on the host."""
+        selected = []
+        for directory in directories:
+            if is_unchanged_since(directory.ctime, hc.last_full_scan) and (
+                reconciler.keep_if_up2date(get_hcd_path(hc.category.topdir.name, directory.name))
+            ):
+                self.progress.advance()
+                continue
+            selected.append(directory)
+        logger.debug("Delta crawl of %s: checking %s directories", hc.category.name, len(selected))
+        return selected
+
+    def _get_directory_statuses(self, hc, reconciler):
         urls = get_preferred_urls(hc)
         if not urls:
             logger.debug("No URLs: %s", repr(urls))
@@ -294,9 +336,12 @@ class Crawler:
         if self.options["canary"]:
             return
 
-        trydirs = mmlib.get_directories_by_category(
-            self.session, hc.category, self.options["repodata"]
+        # A list, it may be iterated once per URL
+        trydirs = list(
+            mmlib.get_directories_by_category(self.session, hc.category, self.options["repodata"])
         )
+        if self.options.get("delta"):
+            trydirs = self._select_changed_directories(hc, trydirs, reconciler)
 
         category_prefix_length = len(hc.category.topdir.name)
         if category_prefix_length > 0:
@@ -319,6 +364,7 @@ class Crawler:
                 continue
 
             connector = self.connection_pool.get(url)
+            connector.prepare_category(url, trydirs, category_prefix_length)
             try:
                 for directory in trydirs:
                     status = connector.check_category(url, directory, category_prefix_length)
@@ -332,46 +378,10 @@ class Crawler:
         )
         raise CategoryNotAccessible
 
-    def sync_dir(self, hc, directory, status):
+    def sync_dir(self, hc, reconciler, directory, status):
         logger.debug("Syncing directory %s with status %r", directory.name, status)
-        sync_status = SyncStatus.UNKNOWN
-        if status is None:
-            # could be a dir with no files, or an unreadable dir.
-            # defer decision on this dir, let a child decide.
-            return sync_status, None
-
-        topname = hc.category.topdir.name
-        toplen = len(topname)
-        if directory.name.startswith("/"):
-            toplen += 1
-        path = directory.name[toplen:]
-
-        hcd = mmlib.get_hostcategorydir_by_hostcategoryid_and_path(
-            self.session, host_category_id=hc.id, path=path
-        )
-        if hcd is None:
-            if not status:
-                # don't create HCDs for directories which aren't up2date on the
-                # mirror chances are the mirror is excluding that directory
-                return sync_status, None
-            hcd = HostCategoryDir(host_category_id=hc.id, path=path, directory_id=directory.id)
-            self.session.add(hcd)
-            self.session.flush()
-            sync_status = SyncStatus.CREATED
-
-        if hcd.directory is None:
-            hcd.directory = directory
-        if hcd.up2date != status:
-            hcd.up2date = status
-            if status is False:
-                logger.info("Directory %s is not up-to-date on this host.", directory.name)
-                sync_status = SyncStatus.NOT_UP2DATE
-            else:
-                sync_status = SyncStatus.UP2DATE
-        else:
-            sync_status = SyncStatus.UNCHANGED
-        self.session.flush()
-        return sync_status, hcd.id
+        path = get_hcd_path(hc.category.topdir.name, directory.name)
+        return reconciler.sync_dir(path, directory.id, status)
 
     def check_propagation(self, product_versions):
         self.timeout.start()
@@ -492,6 +502,57 @@ class Crawler:
             return PropagationStatus.SAME_DAY
 
 
+def get_crawl_status(options, host_id, host_name, error):
+    """Return the crawl status and details matching the error raised while crawling a host.
+
+    This must be called while handling the exception, so that unexpected errors are logged
+    with their traceback.
+    """
+    details = None
+    if isinstance(error, AllCategoriesFailed):
+        status = CrawlStatus.FAILURE
+        if options["canary"]:
+            # If running in canary mode do not auto disable mirrors
+            # if they have failed.
+            # Let's mark the complete mirror as not being up to date.
+            details = "Canary mode failed for all categories. Marking host as not up to date."
+        logger.info("All categories failed.")
+    elif isinstance(error, HostTimeoutError):
+        status = CrawlStatus.TIMEOUT
+        details = "Crawler timed out before completing. Host is likely overloaded."
+        logger.info(details)
+    elif isinstance(error, GlobalTimeoutError):
+        status = CrawlStatus.UNKNOWN
+        details = "Crawler reached its maximum execution time, could not complete this host's scan."
+        logger.info(details)
+    elif isinstance(error, WrongContinent):
+        logger.info("Skipping host %s (%s); wrong continent", host_id, host_name)
+        status = CrawlStatus.UNKNOWN
+    elif isinstance(error, BrokenBaseUrl):
+        logger.info("Skipping host %s (%s); broken base URL", host_id, host_name)
+        status = CrawlStatus.UNKNOWN
+    elif isinstance(error, EmbargoedCountry):
+        logger.info(
+            "Host %s (%s) is from an embargoed country: %s", host_id, host_name, error.country
+        )
+        status = CrawlStatus.DISABLE
+        details = f"Embargoed country: {error.country}"
+    elif isinstance(error, NoCategory):
+        # no category to crawl found. This is to make sure,
+        # that host.crawl_failures is not reset to zero for crawling
+        # non existing categories on this host
+        logger.info("No categories to crawl on host %s (%s)", host_id, host_name)
+        status = CrawlStatus.UNKNOWN
+    elif isinstance(error, KeyboardInterrupt):
+        status = CrawlStatus.UNKNOWN
+    else:
+        logger.exception("Unhandled exception raised, this is a bug in the MM crawler.")
+        # Don't disable the host, it's not their fault.
+        # status = CrawlStatus.FAILURE
+        status = CrawlStatus.UNKNOWN
+    return status, details
+
+
 def crawl_and_report(options, crawler):
     host = crawler.host
 
@@ -501,49 +562,8 @@ def crawl_and_report(options, crawler):
         stats = None
         try:
             stats = crawler.crawl()
-        except AllCategoriesFailed:
-            status = CrawlStatus.FAILURE
-            if options["canary"]:
-                # If running in canary mode do not auto disable mirrors
-                # if they have failed.
-                # Let's mark the complete mirror as not being up to date.
-                details = "Canary mode failed for all categories. Marking host as not up to date."
-            logger.info("All categories failed.")
-        except HostTimeoutError:
-            status = CrawlStatus.TIMEOUT
-            details = "Crawler timed out before completing. Host is likely overloaded."
-            logger.info(details)
-        except GlobalTimeoutError:
-            status = CrawlStatus.UNKNOWN
-            details = (
-                "Crawler reached its maximum execution time, could not complete this host's scan."
-            )
-            logger.info(details)
-        except WrongContinent:
-            logger.info("Skipping host %s (%s); wrong continent", host.id, host.name)
-            status = CrawlStatus.UNKNOWN
-        except BrokenBaseUrl:
-            logger.info("Skipping host %s (%s); broken base URL", host.id, host.name)
-            status = CrawlStatus.UNKNOWN
-        except EmbargoedCountry as e:
-            logger.info(
-                "Host %s (%s) is from an embargoed country: %s", host.id, host.name, e.country
-            )
-            status = CrawlStatus.DISABLE
-            details = f"Embargoed country: {e.country}"
-        except NoCategory:
-            # no category to crawl found. This is to make sure,
-            # that host.crawl_failures is not reset to zero for crawling
-            # non existing categories on this host
-            logger.info("No categories to crawl on host %s (%s)", host.id, host.name)
-            status = CrawlStatus.UNKNOWN
-        except KeyboardInterrupt:
-            status = CrawlStatus.UNKNOWN
-        except Exception:
-            logger.exception("Unhandled exception raised, this is a bug in the MM crawler.")
-            # Don't disable the host, it's not their fault.
-            # status = CrawlStatus.FAILURE
-            status = CrawlStatus.UNKNOWN
+        except (Exception, KeyboardInterrupt) as e:
+            status, details = get_crawl_status(options, host.id, host.name, e)
         else:
             status = CrawlStatus.OK
 
@@ -569,10 +589,9 @@ def check_propagation_and_report(options, crawler):
     )
 
 
-def worker(options, config, progress_bar, host_id):
+def worker(options, config, db_manager, manifests, progress_bar, host_id):
     progress = ProgressTask(progress_bar, host_id)
-    db_manager = get_db_manager(config)
-    with db_manager.Session() as session:
+    with worker_session(db_manager) as session:
         host = mmlib.get_host(session, host_id)
         progress.set_host_name(host.name)
 
@@ -583,7 +602,7 @@ def worker(options, config, progress_bar, host_id):
 
         logger.debug(f"Worker {get_thread_id()!r} starting on host {host.id} ({host.name})")
 
-        crawler = Crawler(config, session, options, progress, host)
+        crawler = Crawler(config, session, options, progress, host, manifests=manifests)
 
         if options.get("propagation", False):
             check_function = check_propagation_and_report
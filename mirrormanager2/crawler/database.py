@@ -0,0 +1,79 @@
+import dataclasses
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from mirrormanager2.lib.database import get_db_manager
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class PoolStats:
+    pool_size: int = 0
+    connections: int = 0
+    checkouts: int = 0
+    checked_out: int = 0
+    peak_checked_out: int = 0
+    waits: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+
+    def __post_init__(self):
+        self._lock = threading.Lock()
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connections += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checked_out -= 1
+
+    def record_wait(self, duration):
+        with self._lock:
+            self.waits += 1
+            self.wait_total += duration
+            self.wait_max = max(self.wait_max, duration)
+
+    @property
+    def wait_average(self):
+        if not self.waits:
+            return 0.0
+        return self.wait_total / self.waits
+
+
+def get_crawler_db_manager(config, threads):
+    """Return a database manager whose engine is shared by all the crawler threads.
+
+    The connection pool is sized to the number of threads so that every worker can hold a
+    connection for the duration of a host crawl without ever opening more than ``threads``
+    connections to the database.
+    """
+    db_manager = get_db_manager(config, pool_size=threads, max_overflow=0)
+    stats = PoolStats(pool_size=threads)
+    sa.event.listen(db_manager.engine, "connect", stats.on_connect)
+    sa.event.listen(db_manager.engine, "checkout", stats.on_checkout)
+    sa.event.listen(db_manager.engine, "checkin", stats.on_checkin)
+    db_manager.pool_stats = stats
+    return db_manager
+
+
+@contextmanager
+def worker_session(db_manager):
+    """Check out a connection from the shared pool and bind a new session to it."""
+    start = time.monotonic()
+    with db_manager.engine.connect() as connection:
+        db_manager.pool_stats.record_wait(time.monotonic() - start)
+        with Session(bind=connection, autoflush=False) as session:
+            yield session
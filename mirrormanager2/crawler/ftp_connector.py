@@ -4,8 +4,6 @@ from contextlib import suppress
 from ftplib import FTP
 from urllib.parse import urlsplit
 
-from mirrormanager2 import lib as mmlib
-
 from .connector import Connector, TryLater
 from .constants import CONNECTION_TIMEOUT
 
@@ -98,12 +96,12 @@ class FTPConnector(Connector):
                 pass
         return results
 
-    def compare_sha256(self, d, filename, graburl):
+    def compare_sha256(self, manifest, filename, graburl):
         return True  # Not implemented on FTP
 
-    def _check_file(self, current_file_info, db_file_info):
+    def _check_file(self, current_file_info, file_entry):
         try:
-            return float(current_file_info["size"]) == float(db_file_info["size"])
+            return float(current_file_info["size"]) == float(file_entry.size)
         except Exception:
             return False
 
@@ -112,15 +110,11 @@ class FTPConnector(Connector):
         if results is None:
             return None
 
-        with mmlib.instance_attribute(directory, "files") as files:
-            # Getting Directory.files is a bit expensive, involves json decoding
-            # files can be None in case of empty directories
-            files = files or []
-            for filename in files:
-                if filename not in results:
-                    return False  # Missing file, we don't need to go over other files
-                status = self._check_file(results[filename], files[filename])
-                if not status:
-                    # Shortcut: we don't need to go over other files
-                    return False
+        for file_entry in self.get_manifest(directory).files:
+            if file_entry.name not in results:
+                return False  # Missing file, we don't need to go over other files
+            status = self._check_file(results[file_entry.name], file_entry)
+            if not status:
+                # Shortcut: we don't need to go over other files
+                return False
         return True
@@ -1,27 +1,51 @@
+import codecs
 import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from contextlib import suppress
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from mirrormanager2 import __version__
-from mirrormanager2 import lib as mmlib
 
+from .autoindex import AutoindexParser
 from .connector import Connector, FetchingFailed, TryLater
-from .constants import CONNECTION_TIMEOUT, REPODATA_FILE
+from .constants import CONNECTION_TIMEOUT, LISTING_CHUNK_SIZE, REPODATA_FILE
 
 logger = logging.getLogger(__name__)
 
+HEADERS = {
+    "Connection": "Keep-Alive",
+    "Pragma": "no-cache",
+    "User-Agent": f"mirrormanager-crawler/{__version__} (+https://github.com/fedora-infra/mirrormanager2/)",
+}
+
 
 class HTTPConnector(Connector):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._executor = None
+
+    @property
+    def concurrency(self):
+        """The number of files of a directory that are checked simultaneously."""
+        return max(1, min(self._config.get("CRAWLER_HTTP_CONCURRENCY", 1), self._max_connections))
+
     def _connect(self):
         session = requests.Session()
-        session.headers = {
-            "Connection": "Keep-Alive",
-            "Pragma": "no-cache",
-            "User-Agent": f"mirrormanager-crawler/{__version__} (+https://github.com/fedora-infra/mirrormanager2/)",
-        }
+        session.headers = HEADERS.copy()
+        # Keep as many connections open as there can be simultaneous requests
+        adapter = HTTPAdapter(pool_maxsize=self.concurrency)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
         return session
 
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        super().close()
+
     def _close(self):
         self._connection.close()
 
@@ -30,7 +54,7 @@ class HTTPConnector(Connector):
         response = conn.head(url, timeout=CONNECTION_TIMEOUT)
         return response.ok
 
-    def _check_file(self, conn, url, filedata, readable):
+    def _check_file(self, conn, url, file_entry, readable):
         """Returns tuple:
         True - URL exists
         False - URL doesn't exist
@@ -70,12 +94,12 @@ class HTTPConnector(Connector):
         # apache and nginx do not
         # For the basic check in check_for_base_dir() it is only
         # relevant if the directory exists or not. Therefore
-        # passing None as filedata[]. This needs to be handled here.
-        if filedata is None:
+        # passing None as file_entry. This needs to be handled here.
+        if file_entry is None:
             # The file/directory seems to exist, no additional check possible
             return True
         # fixme should check last_modified too
-        if float(filedata["size"]) != float(content_length):
+        if float(file_entry.size) != float(content_length):
             return False
 
         # handle streaming/chunked return or zero-length file
@@ -87,22 +111,113 @@ class HTTPConnector(Connector):
         except Exception as e:
             logger.info(f"Could not get {url}: {e}")
             return None
-        with mmlib.instance_attribute(directory, "files") as files:
-            # Getting Directory.files is a bit expensive, involves json decoding
-            # files can be None in case of empty directories
-            files = files or []
-            for filename in files:
-                file_url = f"{url}/{filename}"
-                exists = self._check_file(conn, file_url, files[filename], directory.readable)
-                if filename == REPODATA_FILE and exists:
+        manifest = self.get_manifest(directory)
+        if self._config.get("CRAWLER_HTTP_AUTOINDEX", False) and len(manifest.files) > 1:
+            exists = self._check_dir_listing(conn, url, manifest)
+            if exists is not None:
+                if exists and any(f.name == REPODATA_FILE for f in manifest.files):
                     # Additional optional check
                     with suppress(Exception):
-                        exists = self.compare_sha256(directory, filename, file_url)
-                if exists in (False, None):
-                    # Shortcut: we don't need to go over other files
-                    return exists
+                        exists = self.compare_sha256(
+                            manifest, REPODATA_FILE, f"{url}/{REPODATA_FILE}"
+                        )
+                return exists
+            # The listing is not usable, check the files one by one
+        if self.concurrency > 1 and len(manifest.files) > 1:
+            return self._check_dir_concurrently(conn, url, directory, manifest)
+        for file_entry in manifest.files:
+            exists = self._check_entry(conn, url, manifest, file_entry, directory.readable)
+            if exists in (False, None):
+                # Shortcut: we don't need to go over other files
+                return exists
         return True
 
+    def _check_dir_listing(self, conn, url, manifest):
+        """Check a directory with a single request, using the listing made by the web server.
+
+        Returns:
+        True - all the files are listed, with the expected size
+        False - a file is listed with another size
+        None - the listing is not available, or some files are not in it or
+               without their size
+        """
+        parser = AutoindexParser({file_entry.name for file_entry in manifest.files})
+        try:
+            with conn.get(f"{url}/", stream=True, timeout=CONNECTION_TIMEOUT) as response:
+                content_type = response.headers.get("Content-Type", "")
+                if not response.ok or "html" not in content_type:
+                    return None
+                encoding = response.encoding if "charset" in content_type else "utf-8"
+                decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+                for chunk in response.iter_content(LISTING_CHUNK_SIZE):
+                    parser.feed(decoder.decode(chunk))
+                parser.feed(decoder.decode(b"", final=True))
+        except requests.Timeout as e:
+            raise TryLater(f"HTTP timeout: {e}") from e
+        except (requests.RequestException, LookupError) as e:
+            logger.debug("Could not get the listing of %s: %s", url, e)
+            return None
+        parser.close()
+        if not parser.links:
+            # This is not a directory listing
+            return None
+        for file_entry in manifest.files:
+            try:
+                size = parser.entries[file_entry.name]
+            except KeyError:
+                # The file may still exist but be hidden from the listing
+                return None
+            if size is None:
+                # Listed without a size, only a HEAD request can tell
+                return None
+            if not size.matches(file_entry.size):
+                logger.debug(
+                    "The listing of %s shows %s with size %s instead of %s",
+                    url,
+                    file_entry.name,
+                    size.value,
+                    file_entry.size,
+                )
+                return False
+        return True
+
+    def _check_entry(self, conn, url, manifest, file_entry, readable):
+        file_url = f"{url}/{file_entry.name}"
+        exists = self._check_file(conn, file_url, file_entry, readable)
+        if file_entry.name == REPODATA_FILE and exists:
+            # Additional optional check
+            with suppress(Exception):
+                exists = self.compare_sha256(manifest, file_entry.name, file_url)
+        return exists
+
+    def _check_dir_concurrently(self, conn, url, directory, manifest):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        remaining = iter(manifest.files)
+        running = set()
+        try:
+            while True:
+                # Keep up to self.concurrency checks running
+                for file_entry in remaining:
+                    running.add(
+                        self._executor.submit(
+                            self._check_entry, conn, url, manifest, file_entry, directory.readable
+                        )
+                    )
+                    if len(running) >= self.concurrency:
+                        break
+                if not running:
+                    return True
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    exists = future.result()
+                    if exists in (False, None):
+                        # Shortcut: we don't need to go over other files
+                        return exists
+        finally:
+            for future in running:
+                future.cancel()
+
     def _get_file(self, url):
         conn = self.get_connection()
         try:
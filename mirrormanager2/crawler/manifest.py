@@ -0,0 +1,79 @@
+import logging
+from typing import NamedTuple
+
+from sqlalchemy.orm import object_session
+
+import mirrormanager2.lib as mmlib
+
+from .constants import REPODATA_FILE
+
+logger = logging.getLogger(__name__)
+
+
+class FileEntry(NamedTuple):
+    name: str
+    size: int
+    timestamp: int
+
+
+class DirectoryManifest(NamedTuple):
+    files: tuple[FileEntry, ...]
+    # The expected SHA256 checksum of the repomd.xml file, if there is one in the directory
+    repomd_sha256: str | None = None
+
+    @classmethod
+    def from_files(cls, files, repomd_sha256=None):
+        # files can be None in case of empty directories
+        files = files or {}
+        return cls(
+            files=tuple(
+                FileEntry(name, int(data["size"]), int(data["stat"]))
+                for name, data in sorted(files.items())
+            ),
+            repomd_sha256=repomd_sha256,
+        )
+
+    @classmethod
+    def from_directory(cls, directory):
+        """Build the manifest of a single Directory from the database."""
+        with mmlib.instance_attribute(directory, "files") as files:
+            # Getting Directory.files is a bit expensive, involves json decoding
+            manifest = cls.from_files(files)
+        if any(entry.name == REPODATA_FILE for entry in manifest.files):
+            file_detail = mmlib.get_file_detail(
+                object_session(directory), REPODATA_FILE, directory_id=directory.id, reverse=True
+            )
+            if file_detail is not None:
+                manifest = manifest._replace(repomd_sha256=file_detail.sha256)
+        return manifest
+
+
+class ManifestStore:
+    """The decoded manifests of all the directories to crawl.
+
+    It is built once when the crawler starts and shared read-only by all the threads, so
+    that the files of each directory are only decoded once per crawl instead of once per
+    host.
+    """
+
+    def __init__(self, manifests):
+        self._manifests = manifests
+
+    def __len__(self):
+        return len(self._manifests)
+
+    def get(self, directory_id):
+        return self._manifests.get(directory_id)
+
+    @classmethod
+    def build(cls, session, category_ids, only_repodata=False):
+        checksums = mmlib.get_latest_file_detail_checksums(session, category_ids, REPODATA_FILE)
+        manifests = {}
+        for directory_id, files in mmlib.get_directory_files_by_categories(
+            session, category_ids, only_repodata
+        ):
+            manifests[directory_id] = DirectoryManifest.from_files(
+                files, checksums.get(directory_id)
+            )
+        logger.info("Loaded the manifests of %s directories", len(manifests))
+        return cls(manifests)
@@ -0,0 +1,112 @@
+import logging
+
+import mirrormanager2.lib as mmlib
+
+from .constants import HCD_BATCH_SIZE
+from .states import SyncStatus
+
+logger = logging.getLogger(__name__)
+
+
+class HostCategoryDirReconciler:
+    """Reconcile the HostCategoryDirs of a HostCategory with the crawl results.
+
+    All the existing HostCategoryDirs of the HostCategory are loaded in one query, the
+    changes are computed in memory and written to the database with batched INSERT and
+    UPDATE statements, instead of a SELECT and a flush for each directory.
+    """
+
+    def __init__(self, session, host_category, batch_size=HCD_BATCH_SIZE):
+        self.session = session
+        self.host_category_id = host_category.id
+        self.batch_size = batch_size
+        self._existing = {
+            row.path: row
+            for row in mmlib.get_hostcategorydirs_by_hostcategory(session, host_category.id)
+        }
+        self._seen_ids = set()
+        # The number of up2date HostCategoryDirs that were kept without being checked
+        self.kept = 0
+        self._to_create = []
+        self._to_update = []
+
+    def sync_dir(self, path, directory_id, status):
+        if status is None:
+            # could be a dir with no files, or an unreadable dir.
+            # defer decision on this dir, let a child decide.
+            return SyncStatus.UNKNOWN
+
+        hcd = self._existing.get(path)
+        if hcd is None:
+            if not status:
+                # don't create HCDs for directories which aren't up2date on the
+                # mirror chances are the mirror is excluding that directory
+                return SyncStatus.UNKNOWN
+            self._to_create.append(
+                {
+                    "host_category_id": self.host_category_id,
+                    "path": path,
+                    "up2date": True,
+                    "directory_id": directory_id,
+                }
+            )
+            self._flush_if_needed()
+            # New HCDs are created up2date, so their status does not change.
+            return SyncStatus.UNCHANGED
+
+        self._seen_ids.add(hcd.id)
+        if hcd.up2date != status:
+            if status is False:
+                logger.info("Directory %s is not up-to-date on this host.", path)
+                sync_status = SyncStatus.NOT_UP2DATE
+            else:
+                sync_status = SyncStatus.UP2DATE
+        else:
+            sync_status = SyncStatus.UNCHANGED
+        if sync_status != SyncStatus.UNCHANGED or hcd.directory_id is None:
+            self._to_update.append(
+                {
+                    "hcd_id": hcd.id,
+                    "hcd_up2date": status,
+                    "hcd_directory_id": hcd.directory_id or directory_id,
+                }
+            )
+            self._flush_if_needed()
+        return sync_status
+
+    def keep_if_up2date(self, path):
+        """Leave the HostCategoryDir of a directory that was not checked untouched.
+
+        :returns: True if the HostCategoryDir exists and is up2date, False if the directory
+            must be checked.
+        """
+        hcd = self._existing.get(path)
+        if hcd is None or not hcd.up2date:
+            return False
+        self._seen_ids.add(hcd.id)
+        self.kept += 1
+        return True
+
+    def _flush_if_needed(self):
+        if len(self._to_create) + len(self._to_update) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        mmlib.add_hostcategorydirs(self.session, self._to_create)
+        mmlib.update_hostcategorydirs(self.session, self._to_update)
+        self._to_create = []
+        self._to_update = []
+
+    def set_unseen_not_up2date(self):
+        """Mark the existing HostCategoryDirs that were not synced as not up2date.
+
+        :returns: the number of HostCategoryDirs that were marked
+        """
+        unseen_ids = sorted(
+            hcd.id for hcd in self._existing.values() if hcd.id not in self._seen_ids
+        )
+        changed = 0
+        for index in range(0, len(unseen_ids), self.batch_size):
+            batch = unseen_ids[index : index + self.batch_size]
+            changed += mmlib.set_hostcategorydirs_up2date(self.session, batch, False)
+        return changed
@@ -147,4 +147,6 @@ def store_crawl_result(config, options, session, crawl_result: "CrawlResult"):
         # reporter.record_duration(crawl_result.duration)
         host.last_crawl_duration = crawl_result.duration
 
+    # The crawl changed the up2date status of the HostCategoryDirs
+    mmlib.refresh_host_capabilities(session, host.id)
     session.commit()
@@ -1,11 +1,13 @@
 import logging
 import os
+import shlex
+import tempfile
 import time
 
-from mirrormanager2 import lib as mmlib
-from mirrormanager2.lib.sync import run_rsync
+from mirrormanager2.lib.sync import RsyncError, iter_rsync
 
 from .connector import Connector, SchemeNotAvailable
+from .rsync_listing import SYMLINK, RsyncListing, get_include_patterns
 
 logger = logging.getLogger(__name__)
 
@@ -14,94 +16,65 @@ class RsyncConnector(Connector):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._scan_result = None
+        self._scan_url = None
+        self._wanted = None
 
     def close(self):
         super().close()
         self._scan_result = None
+        self._scan_url = None
+
+    def prepare_category(self, url, directories, category_prefix_length):
+        # The listing only keeps the files of the category's directories
+        self._wanted = {directory.name[category_prefix_length:] for directory in directories}
+        self._scan_result = None
+        self._scan_url = None
 
     def _run(self, url):
         if not url.endswith("/"):
             url += "/"
         rsync_start_time = time.monotonic()
-        try:
-            result, listing = run_rsync(url, self._config["CRAWLER_RSYNC_PARAMETERS"], logger)
-        except Exception:
-            logger.exception("Failed to run rsync.", exc_info=True)
-            return False
+        with tempfile.NamedTemporaryFile(mode="w", prefix="mm-rsync-filter-") as filter_file:
+            rsync_args = self._config["CRAWLER_RSYNC_PARAMETERS"]
+            if self._wanted is not None and self._config.get("CRAWLER_RSYNC_INCLUDE_FILTER"):
+                # Let the server only walk the directories that will be checked
+                for pattern in get_include_patterns(self._wanted):
+                    filter_file.write(f"{pattern}\n")
+                filter_file.flush()
+                rsync_args += f" --include-from={shlex.quote(filter_file.name)} --exclude='*'"
+            # Only keep the files of the directories that will be checked. The listing is
+            # parsed while rsync is running.
+            rsync = RsyncListing(self._wanted)
+            try:
+                rsync.feed(iter_rsync(url, rsync_args, logger))
+            except RsyncError as e:
+                if e.returncode == 10:
+                    # no rsync content, fail!
+                    logger.info(
+                        "Connection to %s Refused.  Please check that the URL is "
+                        "correct and that the host has an rsync module still available.",
+                        url,
+                    )
+                    return False
+                logger.info("rsync returned exit code %s", e.returncode)
+            except Exception:
+                logger.exception("Failed to run rsync.", exc_info=True)
+                return False
         rsync_stop_time = time.monotonic()
         logger.debug("rsync time: %s", int(rsync_stop_time - rsync_start_time))
-        if result == 10:
-            # no rsync content, fail!
-            logger.info(
-                "Connection to %s Refused.  Please check that the URL is "
-                "correct and that the host has an rsync module still available.",
-                url,
-            )
-            return False
-        if result > 0:
-            logger.info("rsync returned exit code %s", result)
-
-        rsync = {}
-        # put the rsync listing in a dict for easy access
-        while True:
-            line = listing.readline()
-            if not line:
-                break
-            fields = line.split()
-            try:
-                rsync[fields[4]] = {
-                    "mode": fields[0],
-                    "size": fields[1],
-                    "date": fields[2],
-                    "time": fields[3],
-                }
-            except IndexError:
-                logger.debug("invalid rsync line: %s", line)
-
-        # run_rsync() returns a temporary file which needs to be closed
-        listing.close()
-
-        logger.debug("rsync listing has %s lines", len(rsync))
+        logger.debug("rsync listing has %s lines, %s files kept", rsync.lines, len(rsync))
         return rsync
 
-    def _check_file(self, current_file_info, db_file_info):
-        if current_file_info["mode"].startswith("l"):
-            # ignore symlink size differences
-            return True
-
-        try:
-            return float(current_file_info["size"]) == float(db_file_info["size"])
-        except ValueError:  # one of the conversion to float() failed
-            logger.debug("Invalid size value for file %s", current_file_info)
-            return False
-
     def _check_dir(self, dirname, directory):
-        with mmlib.instance_attribute(directory, "files") as files:
-            # Getting Directory.files is a bit expensive, involves json decoding
-            # files can be None in case of empty directories
-            files = files or []
-            for filename in sorted(files):
-                if len(dirname) == 0:
-                    key = filename
-                else:
-                    key = os.path.join(dirname, filename)
-                logger.debug(f"Dirname: {dirname}, filename: {filename}, key: {key}")
-
-                logger.debug("trying with key %s", key)
-                try:
-                    current_file_info = self._scan_result[key]
-                except KeyError:  # file is not in the rsync listing
-                    logger.debug("Missing remote file %s", key)
-                    return False
-
-                try:
-                    status = self._check_file(current_file_info, files[filename])
-                    if not status:
-                        # Shortcut: we don't need to go over other files
-                        return False
-                except Exception as e:  # something else went wrong
-                    logger.error("Exception caught when scanning %s: %s", filename, e)
-                    return False
+        for file_entry in self.get_manifest(directory).files:
+            size = self._scan_result.get_size(dirname, file_entry.name)
+            if size is None:
+                # file is not in the rsync listing
+                logger.debug("Missing remote file %s", os.path.join(dirname, file_entry.name))
+                return False
+            if size != SYMLINK and size != file_entry.size:
+                # Shortcut: we don't need to go over other files
+                return False
 
         return True
 
@@ -116,8 +89,9 @@ class RsyncConnector(Connector):
         category_prefix_length,
     ):
         # Scan only once for the entire category
-        if self._scan_result is None:
+        if self._scan_result is None or self._scan_url != url:
             self._scan_result = self._run(url)
+            self._scan_url = url
         if not self._scan_result:
             # no rsync content, fail!
             raise SchemeNotAvailable
@@ -0,0 +1,113 @@
+"""Parse the recursive listing of a directory generated by rsync.
+
+Each line of the listing describes a file or a directory, for example::
+
+    -rw-r--r--      1,234,567 2023/10/01 10:00:00 linux/releases/39/README
+    lrwxrwxrwx             10 2023/10/01 10:00:00 linux/latest -> releases/39
+
+The listings of the big mirrors have millions of lines, but only the files of the directories
+the crawler knows about are interesting. The rsync server can be asked to only walk those
+directories with include patterns, see ``get_include_patterns()``.
+"""
+
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# The size stored for symlinks, their size is not compared
+SYMLINK = -1
+WILDCARD_RE = re.compile(r"([*?[\\])")
+
+
+def parse_size(text):
+    # rsync adds thousands separators unless --no-human-readable is used
+    return int(text.replace(",", "").replace(".", ""))
+
+
+def _escape(path, wildcard):
+    # rsync only interprets the backslashes in patterns that contain wildcards
+    if wildcard or WILDCARD_RE.search(path.replace("\\", "")):
+        return WILDCARD_RE.sub(r"\\\1", path)
+    return path
+
+
+def get_include_patterns(directories):
+    """Yield the rsync include patterns that only list the files of the given directories.
+
+    Each directory's ancestors must be included for rsync to descend into it, and its direct
+    children are included. The sub-directories that are not in the set are listed but not
+    walked, as long as the patterns are followed by ``--exclude='*'``.
+    """
+    included = set()
+    for directory in sorted(directories):
+        if "\n" in directory or "\r" in directory:
+            # Can't be expressed in a patterns file
+            continue
+        parts = directory.split("/") if directory else []
+        for index in range(1, len(parts) + 1):
+            ancestor = "/".join(parts[:index])
+            if ancestor not in included:
+                included.add(ancestor)
+                yield f"/{_escape(ancestor, False)}/"
+        prefix = f"/{_escape(directory, True)}/" if directory else "/"
+        yield f"{prefix}*"
+
+
+class RsyncListing:
+    """The size of the listed files, indexed by directory.
+
+    The listing can be fed line by line while rsync is running. When ``wanted`` is set, only
+    the files of those directories are kept, and each of them only costs its name and its size.
+    """
+
+    def __init__(self, wanted=None):
+        self.wanted = wanted
+        # The number of lines that were parsed, wanted or not
+        self.lines = 0
+        self._directories = {}
+
+    def __len__(self):
+        return sum(len(files) for files in self._directories.values())
+
+    def __bool__(self):
+        return self.lines > 0
+
+    def feed(self, lines):
+        for line in lines:
+            self.add_line(line)
+
+    def add_line(self, line):
+        self.lines += 1
+        fields = line.rstrip("\n").split(None, 4)
+        if len(fields) < 5:
+            logger.debug("invalid rsync line: %s", line)
+            return
+        mode, size, _date, _time, path = fields
+        if mode.startswith("d"):
+            return
+        if mode.startswith("l"):
+            # ignore symlink size differences
+            path = path.split(" -> ", 1)[0]
+            size = SYMLINK
+        else:
+            try:
+                size = parse_size(size)
+            except ValueError:
+                logger.debug("Invalid size value in rsync line: %s", line)
+                return
+        dirname, _sep, filename = path.rpartition("/")
+        if self.wanted is not None and dirname not in self.wanted:
+            return
+        try:
+            files = self._directories[dirname]
+        except KeyError:
+            files = self._directories[dirname] = {}
+        files[filename] = size
+
+    def get_size(self, dirname, filename):
+        """Return the size of a listed file, SYMLINK for symlinks, or None if it is missing."""
+        files = self._directories.get(dirname)
+        if files is None:
+            return None
+        return files.get(filename)
@@ -12,6 +12,7 @@ from .states import PropagationStatus
 
 if typing.TYPE_CHECKING:
     from .crawler import CrawlResult
+    from .database import PoolStats
 
 
 def get_logging_handler(console):
@@ -140,3 +141,22 @@ def report_propagation(
             row.append(str(status_counts.get(ps.value, 0)))
         table.add_row(*row)
     console.print(table)
+
+
+def report_pool_stats(console: Console, stats: "PoolStats"):
+    table = Table(title="Database connection pool")
+    table.add_column("Pool size")
+    table.add_column("Connections opened")
+    table.add_column("Checkouts")
+    table.add_column("Peak checked out")
+    table.add_column("Average wait")
+    table.add_column("Max wait")
+    table.add_row(
+        str(stats.pool_size),
+        str(stats.connections),
+        str(stats.checkouts),
+        str(stats.peak_checked_out),
+        f"{stats.wait_average:.3f}s",
+        f"{stats.wait_max:.3f}s",
+    )
+    console.print(table)
@@ -175,10 +175,26 @@ CRAWLER_RSYNC_PARAMETERS = "--no-motd"
 # can be used decrease the probability of stale rsync processes
 CRAWLER_RSYNC_PARAMETERS = "--no-motd --timeout 14400"
 
+# Only ask the rsync servers for the listing of the directories MirrorManager
+# knows about, with --include-from and --exclude='*', instead of the whole
+# module.
+CRAWLER_RSYNC_INCLUDE_FILTER = True
+
 # If a host fails for CRAWLER_AUTO_DISABLE times in a row
 # the host will be disable automatically (user_active)
 CRAWLER_AUTO_DISABLE = 4
 
+# Number of files of a directory that the crawler checks simultaneously over
+# HTTP. It is capped by the host's max_connections setting.
+CRAWLER_HTTP_CONCURRENCY = 4
+
+# Check the directories over HTTP by downloading the listing generated by the
+# web server, instead of checking each file. If the listing is not available
+# or not conclusive, the files are checked one by one. The human-readable
+# sizes of some listings (like "1.0G") are less precise than checking each file,
+# so this is disabled by default.
+CRAWLER_HTTP_AUTOINDEX = False
+
 # This is a list of directories which MirrorManager will ignore while guessing
 # the version and architecture from a path.
 SKIP_PATHS_FOR_VERSION = ["pub/alt"]
@@ -189,11 +205,36 @@ BODHI_URL = "https://bodhi.fedoraproject.org"
 # Whether to use Fedora Messaging for notifications
 USE_FEDORA_MESSAGING = True
 
+# Whether the report_mirror check-ins are only queued by the XML-RPC endpoint,
+# to be processed later by mm2_process-checkins, instead of being processed
+# during the request.
+CHECKIN_QUEUE = False
+
+# The file locked by mm2_process-checkins while it runs, so that overlapping
+# runs don't process the same check-ins twice.
+CHECKIN_QUEUE_LOCK_FILE = "/var/lock/mm2_process-checkins.lock"
+
 # Maximum age of a FileDetail entry in the database
 MAX_STALE_DAYS = 4
 
 UMDL_PREFIX = ""
 
+# Directory where umdl keeps the fingerprint of the last fullfiletimelist it
+# processed for each category. When it is set, the categories whose
+# fullfiletimelist has not changed are skipped, and only the directories that
+# changed are processed otherwise. Remove its content to force a full run.
+UMDL_FULLFILETIMELIST_CACHE_DIR = None
+
+# Number of directories listed at the same time when umdl scans a category on
+# disk, because it has no fullfiletimelist. Raise it when the master mirror is
+# on NFS, where each listing and stat() is a round trip to the server.
+UMDL_DISK_WALKER_THREADS = 4
+
+# File where umdl and update-single-file-detail keep the digests of the
+# repository metadata files (repomd.xml and summary), so that they are not
+# hashed again as long as their inode, size and mtime do not change.
+UMDL_DIGEST_CACHE = None
+
 UMDL_MASTER_DIRECTORIES = []
 
 HEALTHZ = {
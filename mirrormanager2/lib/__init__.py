@@ -28,6 +28,7 @@ from collections import defaultdict
 from contextlib import contextmanager
 
 import sqlalchemy as sa
+from sqlalchemy.orm import undefer
 
 from mirrormanager2 import default_config
 from mirrormanager2.lib import model
@@ -599,7 +600,13 @@ def get_mirrors(
     if country_id is not None:
         query = query.join(model.HostCountry).join(model.Country)
 
-    if up2date is not None:
+    if up2date is True:
+        # Precomputed, the host_category_dir table is much larger
+        query = query.join(
+            model.HostCapability,
+            model.HostCapability.host_category_id == model.HostCategory.id,
+        )
+    elif up2date is not None:
         query = query.join(model.HostCategoryDir).filter(model.HostCategoryDir.up2date == up2date)
 
     if version_id is not None:
@@ -826,6 +833,63 @@ def count_directories_by_category(session, category, only_repodata=False):
     return session.scalar(query)
 
 
+def get_directory_files_by_categories(session, category_ids, only_repodata=False):
+    """Return the ID and the files of the readable directories linked to the
+    specified Categories.
+
+    :arg session: the session with which to connect to the database.
+    :arg category_ids: a list of category IDs.
+
+    """
+    # A subquery rather than a join, so that the directories of several categories are
+    # returned once without comparing their files
+    category_directories = sa.select(model.CategoryDirectory.directory_id).where(
+        model.CategoryDirectory.category_id.in_(category_ids)
+    )
+    query = sa.select(model.Directory.id, model.Directory.files).where(
+        model.Directory.id.in_(category_directories),
+        model.Directory.readable.is_(True),
+    )
+    if only_repodata:
+        query = query.where(model.Directory.name.like("%/repodata"))
+    return session.execute(query)
+
+
+def get_latest_file_detail_checksums(session, category_ids, filename):
+    """Return the SHA256 checksum of the most recent FileDetail with the
+    specified filename, for each directory of the specified Categories.
+
+    :arg session: the session with which to connect to the database.
+    :arg category_ids: a list of category IDs.
+    :arg filename: the name of the file.
+    :returns: a dict of directory IDs to checksums.
+
+    """
+    ranked = (
+        sa.select(
+            model.FileDetail.directory_id,
+            model.FileDetail.sha256,
+            sa.func.row_number()
+            .over(
+                partition_by=model.FileDetail.directory_id,
+                order_by=model.FileDetail.id.desc(),
+            )
+            .label("rank"),
+        )
+        .where(
+            model.FileDetail.filename == filename,
+            model.FileDetail.directory_id.in_(
+                sa.select(model.CategoryDirectory.directory_id).where(
+                    model.CategoryDirectory.category_id.in_(category_ids)
+                )
+            ),
+        )
+        .subquery()
+    )
+    query = sa.select(ranked.c.directory_id, ranked.c.sha256).where(ranked.c.rank == 1)
+    return {directory_id: sha256 for directory_id, sha256 in session.execute(query)}
+
+
 def get_hostcategorydir_by_hostcategoryid_and_path(session, host_category_id, path):
     """Return all HostCategoryDir via its host_category_id and path.
 
@@ -841,6 +905,145 @@ def get_hostcategorydir_by_hostcategoryid_and_path(session, host_category_id, pa
     return query.first()
 
 
+def get_hostcategorydirs_by_hostcategory(session, host_category_id, paths=None):
+    """Return the id, path, up2date status and directory_id of all the
+    HostCategoryDir linked to the specified HostCategory, without loading
+    full objects.
+
+    :arg session: the session with which to connect to the database.
+    :arg paths: if provided, only return the HostCategoryDir with these paths.
+
+    """
+    query = sa.select(
+        model.HostCategoryDir.id,
+        model.HostCategoryDir.path,
+        model.HostCategoryDir.up2date,
+        model.HostCategoryDir.directory_id,
+    ).where(model.HostCategoryDir.host_category_id == host_category_id)
+    if paths is not None:
+        query = query.where(model.HostCategoryDir.path.in_(paths))
+    return session.execute(query).all()
+
+
+def count_hostcategorydirs(session, host_category_id):
+    """Return the number of HostCategoryDir linked to the specified HostCategory.
+
+    :arg session: the session with which to connect to the database.
+
+    """
+    query = sa.select(sa.func.count(model.HostCategoryDir.id)).where(
+        model.HostCategoryDir.host_category_id == host_category_id
+    )
+    return session.scalar(query)
+
+
+def add_hostcategorydirs(session, values):
+    """Insert HostCategoryDir rows in a single batched statement.
+
+    :arg session: the session with which to connect to the database.
+    :arg values: a list of dicts with the ``host_category_id``, ``path``,
+        ``up2date`` and ``directory_id`` keys.
+
+    """
+    if not values:
+        return
+    session.execute(sa.insert(model.HostCategoryDir.__table__), values)
+
+
+def update_hostcategorydirs(session, values):
+    """Update the up2date status and the directory of HostCategoryDir rows in
+    a single batched statement.
+
+    :arg session: the session with which to connect to the database.
+    :arg values: a list of dicts with the ``hcd_id``, ``hcd_up2date`` and
+        ``hcd_directory_id`` keys.
+
+    """
+    if not values:
+        return
+    table = model.HostCategoryDir.__table__
+    statement = (
+        sa.update(table)
+        .where(table.c.id == sa.bindparam("hcd_id"))
+        .values(
+            up2date=sa.bindparam("hcd_up2date"),
+            directory_id=sa.bindparam("hcd_directory_id"),
+        )
+    )
+    session.execute(statement, values)
+
+
+def set_hostcategorydirs_up2date(session, hcd_ids, up2date):
+    """Set the up2date status of the HostCategoryDir objects with the
+    provided IDs.
+
+    :arg session: the session with which to connect to the database.
+    :returns: the number of changed items
+
+    """
+    if not hcd_ids:
+        return 0
+    statement = (
+        sa.update(model.HostCategoryDir)
+        .where(model.HostCategoryDir.id.in_(hcd_ids))
+        .values(up2date=up2date)
+        .execution_options(synchronize_session=False)
+    )
+    return session.execute(statement).rowcount
+
+
+def set_hostcategory_up2date(session, host_category_id):
+    """Mark all the HostCategoryDir linked to the specified HostCategory as up to date.
+
+    :arg session: the session with which to connect to the database.
+    :returns: the number of changed items
+
+    """
+    statement = (
+        sa.update(model.HostCategoryDir)
+        .where(
+            model.HostCategoryDir.host_category_id == host_category_id,
+            model.HostCategoryDir.up2date.is_not(True),
+        )
+        .values(up2date=True)
+        .execution_options(synchronize_session=False)
+    )
+    return session.execute(statement).rowcount
+
+
+def delete_hostcategorydirs(session, hcd_ids):
+    """Delete the HostCategoryDir objects with the provided IDs.
+
+    :arg session: the session with which to connect to the database.
+    :returns: the number of deleted items
+
+    """
+    if not hcd_ids:
+        return 0
+    statement = (
+        sa.delete(model.HostCategoryDir)
+        .where(model.HostCategoryDir.id.in_(hcd_ids))
+        .execution_options(synchronize_session=False)
+    )
+    return session.execute(statement).rowcount
+
+
+def get_directory_ids_by_names(session, dirnames):
+    """Return the ID of the Directory objects with the provided names.
+
+    :arg session: the session with which to connect to the database.
+    :arg dirnames: a list of directory names.
+    :returns: a dict of directory names to IDs, the unknown names are missing.
+
+    """
+    if not dirnames:
+        return {}
+    query = sa.select(model.Directory.name, model.Directory.id).where(
+        model.Directory.name.in_(dirnames)
+    )
+    return dict(session.execute(query).all())
+
+
 def count_hostcategorydirs_with_unreadable_dir(session, hc):
     """Return the number of HostCategoryDir objects linked to a HostCategory
     that are linked to an unreadable Directory.
@@ -856,27 +1059,53 @@ def count_hostcategorydirs_with_unreadable_dir(session, hc):
     return session.scalar(query)
 
 
-def set_hostcategorydirs_not_up2date(session, hc, except_ids=None):
-    """Set the HostCategoryDir objects linked to the specified HostCategory
-    to not up2date, except those in the provided list of HostCategoryDir IDs.
+def refresh_host_capabilities(session, host_id):
+    """Recompute the HostCapability of a host from the up2date status of its
+    HostCategoryDir objects.
 
     :arg session: the session with which to connect to the database.
-    :returns: the number of changed items
 
     """
-    statement = sa.update(model.HostCategoryDir).where(
-        model.HostCategoryDir.host_category_id == hc.id
+    session.execute(
+        sa.delete(model.HostCapability)
+        .where(model.HostCapability.host_id == host_id)
+        .execution_options(synchronize_session=False)
+    )
+    has_up2date_dir = (
+        sa.select(model.HostCategoryDir.id)
+        .where(
+            model.HostCategoryDir.host_category_id == model.HostCategory.id,
+            model.HostCategoryDir.up2date.is_(True),
+        )
+        .exists()
     )
-    if except_ids:
-        statement = statement.where(
-            model.HostCategoryDir.id.not_in(except_ids),
+    query = sa.select(
+        model.HostCategory.id, model.HostCategory.host_id, model.HostCategory.category_id
+    ).where(
+        model.HostCategory.host_id == host_id,
+        model.HostCategory.category_id.is_not(None),
+        has_up2date_dir,
+    )
+    session.execute(
+        sa.insert(model.HostCapability).from_select(
+            ["host_category_id", "host_id", "category_id"], query
         )
-    statement = statement.values(up2date=False)
-    return session.execute(statement).rowcount
+    )
+
 
+def uploaded_config(session, host, config, batch_size=1000, full_reports=None):
+    """Update the configuration of a specific host.
 
-def uploaded_config(session, host, config):
-    """Update the configuration of a specific host."""
+    The HostCategoryDirs of each category are loaded at once and compared with
+    the reported directories in memory, the changes are written with batched
+    statements and committed in a single transaction.
+
+    A category section of a version 1 configuration may contain, instead of
+    the whole ``dirtree``, a ``delta`` with the directories added and removed
+    since the check-in whose fingerprint is ``base``. If that is not the last
+    tree we know of, the delta is ignored and the name of the category is
+    appended to ``full_reports``, if provided.
+    """
     message = ""
 
     def _config_categories(config):
@@ -886,25 +1115,36 @@ def uploaded_config(session, host, config):
         else:
             return []
 
-    def compare_dir(hcdir, files):
-        if hcdir.directory is None or hcdir.directory.files is None:
-            raise Exception
-        dfiles = hcdir.directory.files
-        if len(dfiles) == 0 and len(files) == 0:
-            return True
-        for fname, fdata in list(dfiles.items()):
-            if fname not in files:
-                return False
-            if fdata["size"] != files[fname]:
-                return False
-        return True
+    def _batches(items):
+        items = sorted(items)
+        for index in range(0, len(items), batch_size):
+            yield items[index : index + batch_size]
+
+    def _add_hostcategorydirs(values):
+        try:
+            with session.begin_nested():
+                add_hostcategorydirs(session, values)
+            return len(values)
+        except sa.exc.IntegrityError:
+            pass
+        # If a crawler created some of them concurrently we hit a unique
+        # violation, then we don't have to create those.
+        added = 0
+        for value in values:
+            try:
+                with session.begin_nested():
+                    add_hostcategorydirs(session, [value])
+                added += 1
+            except sa.exc.IntegrityError:
+                pass
+        return added
 
     # fill in the host category data (HostCategory and HostCategoryURL)
     # the category names in the config have been lowercased
     # so we have to find the matching mixed-case category name.
 
     for cat_name in _config_categories(config):
-        if "dirtree" not in config[cat_name]:
+        if "dirtree" not in config[cat_name] and "delta" not in config[cat_name]:
             # The received report_mirror data is missing
             # the actual data. Pretty unlikely, but possible.
             continue
@@ -921,76 +1161,135 @@ def uploaded_config(session, host, config):
             # it must be done through the web UI.
             continue
 
-        marked_up2date = 0
-        deleted = 0
+        delta = config[cat_name].get("delta")
+        if delta is None:
+            existing = {
+                row.path: row for row in get_hostcategorydirs_by_hostcategory(session, hc.id)
+            }
+            # and now one HostCategoryDir for each dir in the dirtree
+            reported = {dirname.strip("/") for dirname in config[cat_name]["dirtree"]}
+            removed = existing.keys() - reported
+            # Only set by the clients speaking the version 1
+            hc.dirtree_fingerprint = config[cat_name].get("fingerprint")
+        else:
+            if hc.dirtree_fingerprint is None or delta.get("base") != hc.dirtree_fingerprint:
+                # We missed a check-in, or never got the whole tree
+                message += f"Category {hc.category.name} full report requested\n"
+                if full_reports is not None:
+                    full_reports.append(cat_name)
+                continue
+            # Only load the directories the delta is about
+            reported = {dirname.strip("/") for dirname in delta.get("added", [])}
+            removed = {dirname.strip("/") for dirname in delta.get("removed", [])} - reported
+            existing = {}
+            for batch in _batches(reported | removed):
+                existing.update(
+                    (row.path, row)
+                    for row in get_hostcategorydirs_by_hostcategory(session, hc.id, paths=batch)
+                )
+            hc.dirtree_fingerprint = delta.get("fingerprint")
+
+        # This is evil, but it avoids stat()s on the client
+        # side and a lot of data uploading.
+        # A directory is considered up to date if it exists
+        # on the client and in the database.
+        # In contrast to report_mirror the crawler also
+        # checks for the actual files in the directory.
+        present = reported & existing.keys()
+        marked_up2date = len(present)
+        for batch in _batches(
+            existing[path].id for path in present if existing[path].up2date is not True
+        ):
+            set_hostcategorydirs_up2date(session, batch, True)
+
+        # Don't create an entry for a directory the database
+        # doesn't know about
+        topdir_name = hc.category.topdir.name
         added = 0
-        # and now one HostCategoryDir for each dir in the dirtree
-        for dirname, _files in list(config[cat_name]["dirtree"].items()):
-            d = dirname.strip("/")
-            hcdir = get_hostcategorydir_by_hostcategoryid_and_path(
-                session, host_category_id=hc.id, path=d
+        for batch in _batches(reported - existing.keys()):
+            dnames = {path: f"{topdir_name}/{path}" if path else topdir_name for path in batch}
+            directory_ids = get_directory_ids_by_names(session, list(dnames.values()))
+            added += _add_hostcategorydirs(
+                [
+                    {
+                        "host_category_id": hc.id,
+                        "path": path,
+                        "up2date": True,
+                        "directory_id": directory_ids[dname],
+                    }
+                    for path, dname in dnames.items()
+                    if dname in directory_ids
+                ]
             )
-            if hcdir:
-                # This is evil, but it avoids stat()s on the client
-                # side and a lot of data uploading.
-                # A directory is considered up to date if it exists
-                # on the client and in the database.
-                # In contrast to report_mirror the crawler also
-                # checks for the actual files in the directory.
-                marked_up2date += 1
-                if hcdir.up2date is not True:
-                    hcdir.up2date = True
-                    session.add(hcdir)
-                    session.commit()
-            else:
-                if len(d) > 0:
-                    dname = f"{hc.category.topdir.name}/{d}"
-                else:
-                    dname = hc.category.topdir.name
-
-                # Don't create an entry for a directory the database
-                # doesn't know about and if a crawler created it so we
-                # hit a unique violation, then we don't have to
-                try:
-                    directory = get_directory_by_name(session, dname)
-                    hcdir = model.HostCategoryDir(
-                        host_category_id=hc.id, path=d, directory_id=directory.id
-                    )
-                    session.add(hcdir)
-                    session.commit()
-                    added += 1
-                except Exception:
-                    pass
-
-        hcdirs = session.scalars(
-            sa.select(model.HostCategoryDir).where(model.HostCategoryDir.host_category_id == hc.id)
-        )
-        allowed_paths = list(config[cat_name]["dirtree"].keys())
-        for hcdir in hcdirs:
-            # handle disappearing hcdirs, deleted by other processes
-            try:
-                hcdirpath = hcdir.path
-            except Exception:
-                continue
-            if hcdirpath not in allowed_paths:
-                try:
-                    session.delete(hcdir)
-                    session.commit()
-                except Exception:
-                    pass
-                deleted += 1
+
+        deleted = 0
+        for batch in _batches(existing[path].id for path in removed if path in existing):
+            delete_hostcategorydirs(session, batch)
+            deleted += len(batch)
+
+        if delta is not None:
+            # The directories the delta doesn't mention are still on the mirror
+            set_hostcategory_up2date(session, hc.id)
+            marked_up2date = count_hostcategorydirs(session, hc.id) - added
 
         message += (
-            f"Category {cat.category.name} directories updated: {marked_up2date}  "
+            f"Category {hc.category.name} directories updated: {marked_up2date}  "
             f"added: {added}  deleted {deleted}\n"
         )
         host.last_checked_in = datetime.datetime.utcnow()
         session.add(hc)
-        session.commit()
 
+    refresh_host_capabilities(session, host.id)
+    session.commit()
+    # The HostCategoryDirs were changed behind the ORM's back
+    session.expire_all()
     return message
 
 
+def add_host_checkin(session, host, data):
+    """Queue a report_mirror check-in, to be processed by mm2_process-checkins.
+
+    :arg session: the session with which to connect to the database.
+    :arg host: the Host that checked in.
+    :arg data: the configuration sent by report_mirror, as bz2-compressed JSON.
+    :returns: the HostCheckin
+
+    """
+    checkin = model.HostCheckin(host_id=host.id, data=data)
+    session.add(checkin)
+    session.flush()
+    return checkin
+
+
+def get_host_checkins(session, limit=None):
+    """Return the oldest queued check-ins, with their data.
+
+    :arg session: the session with which to connect to the database.
+    :arg limit: the maximum number of check-ins to return.
+
+    """
+    query = (
+        sa.select(model.HostCheckin)
+        .options(undefer(model.HostCheckin.data))
+        .order_by(model.HostCheckin.id)
+        .limit(limit)
+    )
+    return session.scalars(query).all()
+
+
+def delete_host_checkins(session, checkin_ids):
+    """Delete the queued check-ins with the provided IDs.
+
+    :arg session: the session with which to connect to the database.
+    :returns: the number of deleted items
+
+    """
+    if not checkin_ids:
+        return 0
+    statement = sa.delete(model.HostCheckin).where(model.HostCheckin.id.in_(checkin_ids))
+    return session.execute(statement).rowcount
+
+
 def get_rsync_filter_directories(session, categories, since):
     """Return the list of directory that were updated.
 
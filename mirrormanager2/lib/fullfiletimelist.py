@@ -0,0 +1,264 @@
+"""
+MirrorManager2 internal api to read the fullfiletimelist-* files.
+
+Those files are generated on the master mirror and list every file and
+directory of a module with its ctime and size, in the [Files] section:
+
+    [Files]
+    1386338164	d	4096	linux/releases/20
+    1386338164	f	1196	linux/releases/20/Fedora-20-x86_64-CHECKSUM
+
+They have millions of lines, so they are parsed as bytes, in chunks, and the
+files are stored grouped by directory, with their ctimes and sizes in arrays.
+"""
+
+import collections.abc
+import hashlib
+import json
+import mmap
+import os
+from array import array
+from typing import NamedTuple
+
+FILES_SECTION = b"[Files]\n"
+# The size of the chunks of lines split at once
+CHUNK_SIZE = 1024 * 1024
+# The size of the digest of the lines of each directory
+DIGEST_SIZE = 16
+
+
+class DirectoryFiles(collections.abc.Mapping):
+    """The files of a directory, as {filename: {"stat": ctime, "size": size}}.
+
+    The ctimes and the sizes are stored in arrays of integers, the dicts are built on access.
+    """
+
+    __slots__ = ("_index", "_ctimes", "_sizes")
+
+    def __init__(self):
+        # The position of each file in the arrays
+        self._index = {}
+        self._ctimes = array("q")
+        self._sizes = array("q")
+
+    def __getitem__(self, filename):
+        position = self._index[filename]
+        return {"stat": self._ctimes[position], "size": self._sizes[position]}
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, filename):
+        return filename in self._index
+
+    def add(self, filename, ctime, size):
+        position = self._index.get(filename)
+        if position is None:
+            self._index[filename] = len(self._ctimes)
+            self._ctimes.append(ctime)
+            self._sizes.append(size)
+        else:
+            self._ctimes[position] = ctime
+            self._sizes[position] = size
+
+    def merge(self, other):
+        """Add the files of another DirectoryFiles, replacing those with the same name."""
+        for filename, position in other._index.items():
+            self.add(filename, other._ctimes[position], other._sizes[position])
+
+
+class FullFileTimeList(NamedTuple):
+    # The ctime of each directory
+    ctimes: dict
+    # The files of each directory, as DirectoryFiles
+    files: dict
+    # The directories containing a repodata directory
+    repo_dirs: set
+    # The directories containing both a summary file and an objects directory
+    atomic_dirs: set
+    # The digest of the lines of each directory, if requested
+    digests: dict | None = None
+
+
+class Fingerprint(NamedTuple):
+    path: str
+    size: int
+    mtime: int
+    sha256: str
+
+
+def _get_files_section(data):
+    """Return the start and the end of the lines of the [Files] section."""
+    if data[: len(FILES_SECTION)] == FILES_SECTION:
+        start = 0
+    else:
+        start = data.find(b"\n" + FILES_SECTION)
+        if start == -1:
+            return 0, 0
+        start += 1
+    start += len(FILES_SECTION)
+    # The section ends at the next one
+    end = data.find(b"\n[", start - 1)
+    if end == -1:
+        end = len(data)
+    return start, end
+
+
+def iter_lines(data, start, end, chunk_size=None):
+    """Yield the lines of data[start:end], splitting them in chunks of about chunk_size bytes."""
+    chunk_size = chunk_size or CHUNK_SIZE
+    while start < end:
+        stop = data.find(b"\n", min(start + chunk_size, end), end)
+        if stop == -1:
+            stop = end
+        yield from data[start:stop].split(b"\n")
+        start = stop + 1
+
+
+def parse_fullfiletimelist(data, with_digests=False):
+    """
+    Parse the [Files] section of a fullfiletimelist.
+
+    :param data: the content of the file, as bytes or mmap
+    :param with_digests: also compute a digest of the lines of each directory,
+                         its own line and the lines of its files, to compare
+                         it with another version of the file
+    :returns: a FullFileTimeList, the paths are relative to the top of the file
+    """
+    ctimes = {}
+    files = {}
+    repo_dirs = set()
+    has_summary = set()
+    has_objects = set()
+    digests = {} if with_digests else None
+
+    def _get_digest(path):
+        digest = digests.get(path)
+        if digest is None:
+            digest = digests[path] = hashlib.blake2b(digest_size=DIGEST_SIZE)
+        return digest
+
+    # Files of the same directory are usually next to each other
+    current_dirname = None
+    current_files = None
+    current_digest = None
+    start, end = _get_files_section(data)
+    for line in iter_lines(data, start, end):
+        cols = line.split(b"\t", 3)
+        # only rows with at least 4 columns are what we are looking for
+        # 'ctime\ttype\tsize\tname'
+        if len(cols) < 4:
+            continue
+        ctime, filetype, size, path = cols
+        filetype = filetype[:1]
+        if filetype == b"f":
+            dirname, _sep, basename = path.rpartition(b"/")
+            if dirname != current_dirname:
+                current_dirname = dirname
+                current_files = files.get(dirname)
+                if current_files is None:
+                    current_files = files[dirname] = DirectoryFiles()
+                if digests is not None:
+                    current_digest = _get_digest(dirname)
+            basename = basename.decode()
+            current_files.add(basename, int(ctime), int(size))
+            if current_digest is not None:
+                current_digest.update(line + b"\n")
+            if basename == "summary":
+                has_summary.add(dirname)
+        elif filetype == b"d":
+            ctimes[path] = int(ctime)
+            if digests is not None:
+                _get_digest(path).update(line + b"\n")
+            dirname, _sep, basename = path.rpartition(b"/")
+            if basename == b"repodata":
+                repo_dirs.add(dirname)
+            elif basename == b"objects":
+                has_objects.add(dirname)
+
+    # Only decode the paths once per directory
+    return FullFileTimeList(
+        ctimes={path.decode(): ctime for path, ctime in ctimes.items()},
+        files={path.decode(): dir_files for path, dir_files in files.items()},
+        repo_dirs={path.decode() for path in repo_dirs},
+        atomic_dirs={path.decode() for path in has_summary & has_objects},
+        digests=(
+            None
+            if digests is None
+            else {path.decode(): digest.hexdigest() for path, digest in digests.items()}
+        ),
+    )
+
+
+def read_fullfiletimelist(filename, with_digests=False):
+    """
+    Read and parse a fullfiletimelist file.
+
+    The file is not read line by line as a stream, as this breaks if the file
+    changes. It is loaded once into memory using mmap.
+    """
+    with open(filename, "rb") as f:
+        # tell mmap to open file read-only or mmap might fail
+        with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as m:
+            return parse_fullfiletimelist(m, with_digests=with_digests)
+
+
+def get_fingerprint(filename, previous=None):
+    """
+    Return the Fingerprint of a fullfiletimelist file.
+
+    The content is only hashed if the path, the size or the modification
+    time differ from the :previous: fingerprint.
+    """
+    s = os.stat(filename)
+    fingerprint = Fingerprint(filename, s.st_size, s.st_mtime_ns, None)
+    if previous is not None and fingerprint[:3] == tuple(previous[:3]):
+        return fingerprint._replace(sha256=previous.sha256)
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return fingerprint._replace(sha256=sha256.hexdigest())
+
+
+def get_changed_directories(previous_digests, digests):
+    """Return the directories whose lines differ between two versions of a fullfiletimelist,
+    including those that were added or removed."""
+    changed = {path for path, digest in digests.items() if previous_digests.get(path) != digest}
+    changed.update(path for path in previous_digests if path not in digests)
+    return changed
+
+
+class FullFileTimeListState:
+    """
+    What umdl knows about the last fullfiletimelist it processed for a
+    category: its fingerprint and the digests of its directories.
+
+    It is stored as JSON in a file.
+    """
+
+    def __init__(self, fingerprint=None, digests=None):
+        self.fingerprint = fingerprint
+        self.digests = digests
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls()
+        except ValueError:
+            # Corrupted, start over
+            return cls()
+        return cls(Fingerprint(**data["fingerprint"]), data["digests"])
+
+    def save(self, path):
+        # Write a new file and rename it, to never leave a half-written state
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"fingerprint": self.fingerprint._asdict(), "digests": self.digests}, f)
+        os.replace(tmp_path, path)
@@ -21,12 +21,17 @@
 MirrorManager2 Host configuration.
 """
 
+import bz2
+import json
 import logging
 
 import mirrormanager2.lib
 
 logger = logging.getLogger(__name__)
 
+# The versions of the report_mirror protocol. Version 1 adds the delta check-ins.
+SUPPORTED_VERSIONS = (0, 1)
+
 
 def validate_config(config):
     message = ""
@@ -38,8 +43,8 @@ def validate_config(config):
         message += "config file has no version field.\n"
         return (False, message)
     # this field is an integer
-    if config["version"] != 0:
-        message += "config file version is not 0, is {}.\n".format(config["version"])
+    if config["version"] not in SUPPORTED_VERSIONS:
+        message += "config file version is not 0 or 1, is {}.\n".format(config["version"])
         return (False, message)
 
     for section in ["global", "site", "host"]:
@@ -69,14 +74,20 @@ def validate_config(config):
         if category in ["global", "site", "host", "version", "stats"]:
             continue
 
-        for opt in ["dirtree"]:
-            if opt not in config[category]:
-                message += f"section [{category}] missing required option {opt}.\n"
-                return (False, message)
+        # Version 1 clients may only send the changes since their last check-in
+        if "dirtree" not in config[category] and (
+            config["version"] < 1 or "delta" not in config[category]
+        ):
+            message += f"section [{category}] missing required option dirtree.\n"
+            return (False, message)
     return (True, message)
 
 
-def read_host_config(session, config):
+def check_host_config(session, config):
+    """Validate a report_mirror configuration and the credentials it contains.
+
+    :returns: a tuple (host, host name, message), host is None if the check failed.
+    """
     rc, message = validate_config(config)
     if not rc:
         return (
@@ -112,6 +123,20 @@ def read_host_config(session, config):
             "Only private mirrors are allowed to use report_mirror.\n",
         )
 
+    return (host, chostname, message)
+
+
+def read_host_config(session, config, full_reports=None):
+    """Update the database from a report_mirror configuration.
+
+    :arg full_reports: if provided, the names of the categories for which the
+        client must send its whole directory tree are appended to it.
+    :returns: a tuple (result, host name, message), result is None if the check-in failed.
+    """
+    host, chostname, message = check_host_config(session, config)
+    if host is None:
+        return (None, chostname, message)
+
     # handle the optional arguments
     if "user_active" in config["host"]:
         if config["host"]["user_active"] in ["true", "1", "t", "y", "yes"]:
@@ -119,5 +144,32 @@ def read_host_config(session, config):
         else:
             host.user_active = False
 
-    message = mirrormanager2.lib.uploaded_config(session, host, config)
+    message = mirrormanager2.lib.uploaded_config(session, host, config, full_reports=full_reports)
     return (True, chostname, message)
+
+
+def is_delta_config(config):
+    """Return True if a configuration contains delta check-ins."""
+    return any(isinstance(section, dict) and "delta" in section for section in config.values())
+
+
+def encode_config(config):
+    """Return a configuration as bz2-compressed JSON, as stored in the check-in queue."""
+    return bz2.compress(json.dumps(config).encode("utf-8"))
+
+
+def decode_config(data):
+    return json.loads(bz2.decompress(data))
+
+
+def merge_configs(configs):
+    """Merge several check-ins of the same host into one, the most recent last.
+
+    Each check-in reports the whole content of its categories, so the most
+    recent section of each category replaces the previous ones. The delta
+    check-ins are not queued.
+    """
+    merged = {}
+    for config in configs:
+        merged.update(config)
+    return merged
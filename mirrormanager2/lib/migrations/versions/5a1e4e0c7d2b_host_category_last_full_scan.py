@@ -0,0 +1,24 @@
+"""HostCategory last full scan
+
+Revision ID: 5a1e4e0c7d2b
+Revises: 3264c6353b51
+Create Date: 2026-10-18 18:40:12.481203
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5a1e4e0c7d2b"
+down_revision = "3264c6353b51"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("host_category", sa.Column("last_full_scan", sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("host_category", "last_full_scan")
@@ -0,0 +1,39 @@
+"""Host check-in queue
+
+Revision ID: 7c3f9a2d4e18
+Revises: 5a1e4e0c7d2b
+Create Date: 2026-10-18 19:32:45.118274
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7c3f9a2d4e18"
+down_revision = "5a1e4e0c7d2b"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "host_checkin",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("host_id", sa.Integer(), nullable=False),
+        sa.Column("created", sa.DateTime(), nullable=False),
+        sa.Column("data", sa.LargeBinary(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["host_id"],
+            ["host.id"],
+            name=op.f("fk_host_checkin_host_id_host"),
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("id", name=op.f("pk_host_checkin")),
+    )
+    op.create_index(op.f("ix_host_checkin_host_id"), "host_checkin", ["host_id"], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_host_checkin_host_id"), table_name="host_checkin")
+    op.drop_table("host_checkin")
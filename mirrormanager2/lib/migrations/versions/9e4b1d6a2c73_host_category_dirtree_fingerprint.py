@@ -0,0 +1,24 @@
+"""HostCategory dirtree fingerprint
+
+Revision ID: 9e4b1d6a2c73
+Revises: 7c3f9a2d4e18
+Create Date: 2026-10-18 21:12:37.904417
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9e4b1d6a2c73"
+down_revision = "7c3f9a2d4e18"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("host_category", sa.Column("dirtree_fingerprint", sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("host_category", "dirtree_fingerprint")
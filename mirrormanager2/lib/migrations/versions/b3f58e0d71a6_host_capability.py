@@ -0,0 +1,64 @@
+"""Host capability summary
+
+Revision ID: b3f58e0d71a6
+Revises: 9e4b1d6a2c73
+Create Date: 2026-10-18 22:05:51.630928
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b3f58e0d71a6"
+down_revision = "9e4b1d6a2c73"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "host_capability",
+        sa.Column("host_category_id", sa.Integer(), nullable=False),
+        sa.Column("host_id", sa.Integer(), nullable=False),
+        sa.Column("category_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["category_id"],
+            ["category.id"],
+            name=op.f("fk_host_capability_category_id_category"),
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["host_category_id"],
+            ["host_category.id"],
+            name=op.f("fk_host_capability_host_category_id_host_category"),
+            ondelete="CASCADE",
+        ),
+        sa.ForeignKeyConstraint(
+            ["host_id"],
+            ["host.id"],
+            name=op.f("fk_host_capability_host_id_host"),
+            ondelete="CASCADE",
+        ),
+        sa.PrimaryKeyConstraint("host_category_id", name=op.f("pk_host_capability")),
+    )
+    op.create_index(
+        op.f("ix_host_capability_category_id"), "host_capability", ["category_id"], unique=False
+    )
+    op.create_index(
+        op.f("ix_host_capability_host_id"), "host_capability", ["host_id"], unique=False
+    )
+    # Fill it from the current up2date status of the HostCategoryDirs
+    op.execute(
+        "INSERT INTO host_capability (host_category_id, host_id, category_id) "
+        "SELECT hc.id, hc.host_id, hc.category_id FROM host_category hc "
+        "WHERE hc.host_id IS NOT NULL AND hc.category_id IS NOT NULL AND EXISTS ("
+        "SELECT 1 FROM host_category_dir hcd "
+        "WHERE hcd.host_category_id = hc.id AND hcd.up2date)"
+    )
+
+
+def downgrade():
+    op.drop_index(op.f("ix_host_capability_host_id"), table_name="host_capability")
+    op.drop_index(op.f("ix_host_capability_category_id"), table_name="host_capability")
+    op.drop_table("host_capability")
@@ -30,7 +30,7 @@ import pickle
 import time
 
 import sqlalchemy as sa
-from sqlalchemy.orm import deferred, relationship
+from sqlalchemy.orm import deferred, object_session, relationship
 
 from .database import BASE
 
@@ -164,6 +164,12 @@ class Host(BASE):
         back_populates="host",
         cascade="delete, delete-orphan",
     )
+    checkins = relationship(
+        "HostCheckin",
+        back_populates="host",
+        cascade="delete, delete-orphan",
+        order_by="HostCheckin.id",
+    )
 
     # exclusive_dirs = MultipleJoin('DirectoryExclusiveHost')
     # locations = SQLRelatedJoin('Location')
@@ -208,6 +214,12 @@ class Host(BASE):
             .values(up2date=False)
         )
         session.execute(statement)
+        # This host is not listed as up to date anymore
+        session.execute(
+            sa.delete(HostCapability)
+            .where(HostCapability.host_id == self.id)
+            .execution_options(synchronize_session=False)
+        )
 
     def is_active(self):
         return self.admin_active and self.user_active and self.site.user_active
@@ -327,29 +339,7 @@ class Directory(BASE):
         return f"<Directory({self.id} - {self.name})>"
 
     @classmethod
-    def age_file_details(cls, session, config):
-        cls._fill_file_details_cache(session, config)
-        cls._age_file_details(session, config)
-
-    @classmethod
-    def _fill_file_details_cache(cls, session, config):
-        cache = collections.defaultdict(list)
-
-        sql = sa.text(
-            "SELECT id, directory_id, filename, timestamp from file_detail "
-            "ORDER BY directory_id, filename, -timestamp"
-        )
-        results = session.execute(sql)
-
-        for id, directory_id, filename, timestamp in results:
-            k = (directory_id, filename)
-            v = dict(file_detail_id=id, timestamp=timestamp)
-            cache[k].append(v)
-
-        cls.file_details_cache = cache
-
-    @classmethod
-    def _age_file_details(cls, session, config):
+    def age_file_details(cls, session, config, batch_size=1000, progress_bar=None):
         """For each file, keep at least 1 FileDetail entry.
 
         Remove the second-most recent entry if the most recent entry is
@@ -357,6 +347,11 @@ class Directory(BASE):
         up the most recent change.
 
         Remove any others that are more than max_stale_days old.
+
+        The entries to remove are selected in SQL, and deleted by batches of
+        batch_size, each in its own transaction.
+
+        :returns: the number of FileDetail entries that were removed.
         """
 
         t = int(time.time())
@@ -365,21 +360,47 @@ class Directory(BASE):
         stale = t - (60 * 60 * 24 * max_stale)
         propogation = t - (60 * 60 * 24 * max_propogation)
 
-        for k, fds in list(cls.file_details_cache.items()):
-            directory_id, filename = k
-            if len(fds) > 1:
-                start = 2
-                # second-most recent only if most recent has had time to
-                # propogate
-                if fds[0]["timestamp"] < propogation:
-                    start = 1
-                # all others
-                for f in fds[start:]:
-                    if f["timestamp"] < stale:
-                        detail = FileDetail.get_by_pk(f["file_detail_id"])
-                        session.delete(detail)
+        # The entries of each file, most recent first
+        window = dict(
+            partition_by=(FileDetail.directory_id, FileDetail.filename),
+            order_by=(FileDetail.timestamp.desc().nulls_last(), FileDetail.id.desc()),
+        )
+        ranked = sa.select(
+            FileDetail.id,
+            FileDetail.timestamp,
+            sa.func.row_number().over(**window).label("rank"),
+            sa.func.first_value(FileDetail.timestamp).over(**window).label("most_recent"),
+        ).subquery()
+        query = (
+            sa.select(ranked.c.id)
+            .where(
+                ranked.c.timestamp < stale,
+                sa.or_(
+                    # all others
+                    ranked.c.rank > 2,
+                    # second-most recent only if most recent has had time to
+                    # propogate
+                    sa.and_(ranked.c.rank == 2, ranked.c.most_recent < propogation),
+                ),
+            )
+            .order_by(ranked.c.id)
+        )
+        expired = session.scalars(query).all()
+
+        if progress_bar is not None and expired:
+            progress_bar.reset(description="Removing old file details", total=len(expired))
+        for start in range(0, len(expired), batch_size):
+            batch = expired[start : start + batch_size]
+            session.execute(
+                sa.delete(FileDetailFileGroup).where(FileDetailFileGroup.file_detail_id.in_(batch))
+            )
+            session.execute(sa.delete(FileDetail).where(FileDetail.id.in_(batch)))
+            session.commit()
+            if progress_bar is not None:
+                progress_bar.advance(len(batch))
 
         session.commit()
+        return len(expired)
 
 
 # e.g. 'fedora' and 'epel'
@@ -416,6 +437,10 @@ class Product(BASE):
         return [v for k, v in sorted(list(versions.items()), reverse=True, key=intify)]
 
 
+# The columns of a Directory kept in Category.directory_cache
+DirectoryCacheEntry = collections.namedtuple("DirectoryCacheEntry", ["id", "ctime", "readable"])
+
+
 class Category(BASE):
     __tablename__ = "category"
 
@@ -456,19 +481,38 @@ class Category(BASE):
         """Return a string representation of the object."""
         return f"<Category({self.id} - {self.name})>"
 
+    def _get_relative_path(self, directory_name):
+        relative_path = directory_name[len(self.topdir.name) + 1 :]
+        return relative_path.strip("/")
+
     @property
     def directory_cache(self):
+        """The directories of the category, indexed by their path relative to the topdir.
+
+        Only the id, ctime and readable columns are loaded. Deleted directories are removed
+        with directory_cache_discard(), bulk changes reload it with directory_cache_clear().
+        """
         if not hasattr(self, "_directory_cache"):
-            self._directory_cache = dict()
-            topdirName = self.topdir.name
-            for directory in self.directories:
-                relative_path = directory.name[len(topdirName) + 1 :]
-                relative_path = relative_path.strip("/")
-                self._directory_cache[relative_path] = directory
+            query = (
+                sa.select(Directory.id, Directory.name, Directory.ctime, Directory.readable)
+                .join(CategoryDirectory, CategoryDirectory.directory_id == Directory.id)
+                .where(CategoryDirectory.category_id == self.id)
+            )
+            self._directory_cache = {
+                self._get_relative_path(name): DirectoryCacheEntry(id, ctime, readable)
+                for id, name, ctime, readable in object_session(self).execute(query)
+            }
         return self._directory_cache
 
+    def directory_cache_discard(self, directory):
+        """Remove a directory from the cache, if it is loaded."""
+        if not hasattr(self, "_directory_cache"):
+            return
+        self._directory_cache.pop(self._get_relative_path(directory.name), None)
+
     def directory_cache_clear(self):
-        delattr(self, "_directory_cache")
+        if hasattr(self, "_directory_cache"):
+            delattr(self, "_directory_cache")
 
 
 class SiteToSite(BASE):
@@ -514,6 +558,12 @@ class HostCategory(BASE):
         sa.Integer, sa.ForeignKey("category.id", ondelete="CASCADE"), nullable=True
     )
     always_up2date = sa.Column(sa.Boolean(), default=False, nullable=False)
+    # When the last complete scan of this category by the crawler started, in seconds since
+    # the epoch like Directory.ctime. Used by the delta crawls.
+    last_full_scan = sa.Column(sa.BigInteger, nullable=True)
+    # The fingerprint of the directory tree reported by the last report_mirror check-in, the
+    # base of the next delta check-in.
+    dirtree_fingerprint = sa.Column(sa.Text(), nullable=True)
 
     # Relations
     category = relationship("Category", back_populates="host_categories")
@@ -529,6 +579,12 @@ class HostCategory(BASE):
         back_populates="host_category",
         cascade="delete, delete-orphan",
     )
+    capability = relationship(
+        "HostCapability",
+        back_populates="host_category",
+        cascade="delete, delete-orphan",
+        uselist=False,
+    )
 
     # Constraints
     __table_args__ = (
@@ -570,6 +626,39 @@ class HostCategoryDir(BASE):
     )
 
 
+class HostCapability(BASE):
+    """A HostCategory with at least one up to date HostCategoryDir.
+
+    This summary of the host_category_dir table is maintained by the crawler
+    and the report_mirror check-ins, and used to list the public mirrors.
+    """
+
+    __tablename__ = "host_capability"
+
+    host_category_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("host_category.id", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    host_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("host.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    category_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("category.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+
+    __mapper_args__ = {"confirm_deleted_rows": False}
+
+    # Relations
+    host_category = relationship("HostCategory", back_populates="capability")
+
+
 class CategoryDirectory(BASE):
     __tablename__ = "category_directory"
 
@@ -1097,3 +1186,22 @@ class PropagationStat(BASE):
     no_info = sa.Column(sa.Integer, nullable=False, default=0)
 
     repository = relationship("Repository", back_populates="propagation_stats")
+
+
+class HostCheckin(BASE):
+    """A report_mirror check-in waiting to be processed by mm2_process-checkins"""
+
+    __tablename__ = "host_checkin"
+
+    id = sa.Column(sa.Integer, primary_key=True)
+    host_id = sa.Column(
+        sa.Integer,
+        sa.ForeignKey("host.id", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    created = sa.Column(sa.DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # The configuration sent by report_mirror, as bz2-compressed JSON
+    data = deferred(sa.Column(sa.LargeBinary(), nullable=False))
+
+    host = relationship("Host", back_populates="checkins")
@@ -54,6 +54,24 @@ def check_timeout(logger, p, timeout, e):
                 raise
 
 
+class RsyncError(Exception):
+    """The rsync process exited with a non-zero code, or was killed after the timeout."""
+
+    def __init__(self, returncode):
+        super().__init__(f"rsync returned exit code {returncode}")
+        self.returncode = returncode
+
+
+def _get_rsync_command(rsyncpath, extra_rsync_args=None, logger=None):
+    cmd = "rsync --temp-dir=/tmp -r --exclude=.snapshot --exclude='*.~tmp~'"
+    if extra_rsync_args is not None:
+        cmd += " " + extra_rsync_args
+    cmd += " " + rsyncpath
+    if logger is not None:
+        logger.debug("About to run the following rsync command: " + cmd)
+    return cmd
+
+
 def run_rsync(rsyncpath, extra_rsync_args=None, logger=None, timeout=None):
     """
     This functions runs 'rsync' on :rsyncpath: and returns the output listing
@@ -71,12 +89,7 @@ def run_rsync(rsyncpath, extra_rsync_args=None, logger=None, timeout=None):
     """
 
     tmpfile = tempfile.SpooledTemporaryFile(mode="w+t")
-    cmd = "rsync --temp-dir=/tmp -r --exclude=.snapshot --exclude='*.~tmp~'"
-    if extra_rsync_args is not None:
-        cmd += " " + extra_rsync_args
-    cmd += " " + rsyncpath
-    if logger is not None:
-        logger.debug("About to run the following rsync command: " + cmd)
+    cmd = _get_rsync_command(rsyncpath, extra_rsync_args, logger)
     devnull = open("/dev/null", "r+")
     p = subprocess.Popen(
         cmd,
@@ -108,3 +121,59 @@ def run_rsync(rsyncpath, extra_rsync_args=None, logger=None, timeout=None):
     tmpfile.flush()
     tmpfile.seek(0)
     return (result, tmpfile)
+
+
+def iter_rsync(rsyncpath, extra_rsync_args=None, logger=None, timeout=None):
+    """
+    This functions runs 'rsync' on :rsyncpath: and yields the lines of the
+    output listing while rsync is still running, without storing it.
+    The rsync process is killed if the iteration is stopped early.
+
+    :param rsyncpath: The path 'rsync' should use to do a recursive listing.
+                      This can be anything 'rsync' accepts.
+    :param extra_rsync_args: Additional parameters added to 'rsync' like
+                             excludes or includes or anything else.
+    :param logger: If a logger is available it will be used for messages
+    :param timeout: The timeout after which the rsync process should
+                    definitely end. Will be p.kill()-ed.
+    :raises RsyncError: after the last line, if rsync returned a non-zero
+                        exit code or was killed. The lines that were yielded
+                        may still be used.
+    """
+
+    cmd = _get_rsync_command(rsyncpath, extra_rsync_args, logger)
+    p = subprocess.Popen(
+        cmd,
+        shell=True,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        close_fds=True,
+        text=True,
+        errors="replace",
+    )
+
+    timeout_thread = None
+    e = None
+    if timeout:
+        # Start a thread to check the status of the process after ``timeout``
+        # seconds. If the process is still running then, kill it. This also
+        # closes the pipe and ends the iteration.
+        e = threading.Event()
+        timeout_thread = threading.Thread(target=check_timeout, args=[logger, p, timeout, e])
+        timeout_thread.start()
+
+    try:
+        yield from p.stdout
+    finally:
+        p.stdout.close()
+        if p.poll() is None:
+            # The iteration was stopped early
+            p.kill()
+        p.wait()
+        if e:
+            e.set()
+            timeout_thread.join()
+
+    if p.returncode != 0:
+        raise RsyncError(p.returncode)
@@ -20,16 +20,26 @@ directory (/pub/fedora/linux/updates/....)
 """
 
 import hashlib
+import json
 import logging
 import os
 import re
 import stat
+import tempfile
 from itertools import chain
 
 import rpmmd.repoMDObject
+import sqlalchemy as sa
 
 import mirrormanager2.lib
-from mirrormanager2.lib.model import FileDetail, Repository, Version
+from mirrormanager2.lib.model import (
+    CategoryDirectory,
+    Directory,
+    FileDetail,
+    JsonDictTypeFilter,
+    Repository,
+    Version,
+)
 from mirrormanager2.lib.repomap import repo_prefix
 
 logger = logging.getLogger(__name__)
@@ -42,6 +52,14 @@ logger = logging.getLogger(__name__)
 # this.
 OSTREE_ARCH = "x86_64"
 
+# Number of directories sent to the staging table at once
+STAGING_BATCH_SIZE = 1000
+
+# The digests stored in a FileDetail
+FILE_DETAIL_DIGESTS = ("md5", "sha1", "sha256", "sha512")
+# The size of the chunks read when hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
 
 def parent_dir(path):
     sdir = path.split("/")[:-1]
@@ -80,6 +98,111 @@ def set_repomd_timestamp(yumrepo):
     return timestamp
 
 
+def _get_directory_staging_table():
+    return sa.Table(
+        "umdl_directory_staging",
+        sa.MetaData(),
+        sa.Column("name", sa.Text(), primary_key=True),
+        # The directories are created in the order they were given
+        sa.Column("position", sa.Integer, nullable=False),
+        sa.Column("readable", sa.Boolean(), nullable=True),
+        sa.Column("ctime", sa.BigInteger, nullable=True),
+        sa.Column("changed", sa.Boolean(), nullable=False),
+        sa.Column("files", JsonDictTypeFilter(), nullable=True),
+        prefixes=["TEMPORARY"],
+    )
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def merge_directories(session, category, directories):
+    """
+    Create or update the directories of a category in a few set-based
+    statements instead of one round-trip per directory.
+
+    The directories are first sent to a temporary staging table, which is
+    then merged into the directory and category_directory tables. The ORM
+    objects of the session are expired afterwards.
+
+    :param session: SQLAlchemy session
+    :param category: MirrorManager database category object
+    :param directories: iterable of dicts with the keys name, readable
+                        (None if unknown), ctime, changed and files (only
+                        stored if changed is True)
+    :returns: the number of directories created and updated
+    """
+    # Send the pending changes before working on the tables directly
+    session.flush()
+    connection = session.connection()
+    staging = _get_directory_staging_table()
+    directory = Directory.__table__
+    category_directory = CategoryDirectory.__table__
+
+    connection.execute(sa.schema.DropTable(staging, if_exists=True))
+    connection.execute(sa.schema.CreateTable(staging))
+    rows = ({**item, "position": index} for index, item in enumerate(directories))
+    for batch in _batched(rows, STAGING_BATCH_SIZE):
+        connection.execute(staging.insert(), batch)
+
+    created = connection.execute(
+        directory.insert().from_select(
+            ["name", "readable", "ctime", "files"],
+            sa.select(
+                staging.c.name,
+                sa.func.coalesce(staging.c.readable, sa.true()),
+                staging.c.ctime,
+                staging.c.files,
+            )
+            .where(~sa.exists().where(directory.c.name == staging.c.name))
+            .order_by(staging.c.position),
+        )
+    ).rowcount
+
+    readable = sa.func.coalesce(staging.c.readable, directory.c.readable)
+    files = sa.case((staging.c.changed, staging.c.files), else_=directory.c.files)
+    updated = connection.execute(
+        sa.update(directory)
+        .where(
+            directory.c.name == staging.c.name,
+            sa.or_(
+                directory.c.readable != readable,
+                directory.c.ctime.is_distinct_from(staging.c.ctime),
+                directory.c.files.is_distinct_from(files),
+            ),
+        )
+        .values(readable=readable, ctime=staging.c.ctime, files=files)
+    ).rowcount
+
+    connection.execute(
+        category_directory.insert().from_select(
+            ["category_id", "directory_id"],
+            sa.select(sa.literal(category.id), directory.c.id)
+            .join(staging, staging.c.name == directory.c.name)
+            .where(
+                ~sa.exists().where(
+                    category_directory.c.category_id == category.id,
+                    category_directory.c.directory_id == directory.c.id,
+                )
+            ),
+        )
+    )
+    connection.execute(sa.schema.DropTable(staging))
+
+    # The ORM objects don't know about the changes
+    session.expire_all()
+    category.directory_cache_clear()
+    return created, updated
+
+
 class FileDetailFromChecksumsLoader:
     sha1_globs = list(re.compile(p) for p in [r".*\.sha1sum", "SHA1SUM", "sha1sum.txt"])
     md5_globs = list(re.compile(p) for p in [r".*\.md5sum", "MD5SUM", "md5sum.txt"])
@@ -96,6 +219,29 @@ class FileDetailFromChecksumsLoader:
         self.config = config
         self.directory = directory
         self.relative_dir_name = relative_dir_name or self.directory.name
+        self._filenames = None
+
+    @classmethod
+    def is_checksum_file(cls, filename):
+        return any(
+            g.match(filename)
+            for g in chain(cls.md5_globs, cls.sha1_globs, cls.sha256_globs, cls.sha512_globs)
+        )
+
+    @classmethod
+    def has_changed_checksum_files(cls, files, since):
+        """
+        Tells whether the listing of a directory has checksum files that
+        were modified after :since:, without accessing the file-system.
+
+        :param files: hash with the files in the directory, as in Directory.files
+        :param since: timestamp, usually the ctime of the directory
+        """
+        return any(
+            int(data["stat"]) > since
+            for filename, data in files.items()
+            if cls.is_checksum_file(filename)
+        )
 
     def _handle_checksum_line(self, line, checksumlen):
         """
@@ -165,8 +311,11 @@ class FileDetailFromChecksumsLoader:
 
         d = {}
         checksum_files = []
+        if self._filenames is None:
+            # List the directory only once for all the globs
+            self._filenames = list(self._get_filenames())
         for g in globs:
-            for f in self._get_filenames():
+            for f in self._filenames:
                 if g.match(f):
                     checksum_files.append(os.path.join(self.relative_dir_name, f))
         for f in checksum_files:
@@ -207,8 +356,24 @@ class FileDetailFromChecksumsLoader:
         sha512dict = self._checksums_from_globs(self.sha512_globs, 128)
 
         sum_files = set(chain(md5dict, sha1dict, sha256dict, sha512dict))
+        if not sum_files:
+            return
 
-        for f in sum_files:
+        # Fetch the existing details of the directory at once, and compare them in memory
+        columns = (
+            FileDetail.filename,
+            FileDetail.sha1,
+            FileDetail.md5,
+            FileDetail.sha256,
+            FileDetail.sha512,
+            FileDetail.timestamp,
+            FileDetail.size,
+        )
+        query = sa.select(*columns).where(FileDetail.directory_id == self.directory.id)
+        existing = {tuple(row) for row in self.session.execute(query)}
+
+        new_details = []
+        for f in sorted(sum_files):
             size, ctime = self._get_size_and_ctime(f)
             if size is None or ctime is None:
                 continue
@@ -217,23 +382,27 @@ class FileDetailFromChecksumsLoader:
             sha256 = sha256dict.get(f)
             sha512 = sha512dict.get(f)
 
-            fd_attrs = dict(
-                directory_id=self.directory.id,
-                filename=f,
-                sha1=sha1,
-                md5=md5,
-                sha256=sha256,
-                sha512=sha512,
-                timestamp=ctime,
-                size=size,
+            key = (f, sha1, md5, sha256, sha512, ctime, size)
+            if key in existing:
+                continue
+            existing.add(key)
+            new_details.append(
+                dict(
+                    directory_id=self.directory.id,
+                    filename=f,
+                    sha1=sha1,
+                    md5=md5,
+                    sha256=sha256,
+                    sha512=sha512,
+                    timestamp=ctime,
+                    size=size,
+                )
             )
+            logger.debug("Added checksum for %s to database", f)
 
-            fd = mirrormanager2.lib.get_file_detail(self.session, **fd_attrs)
-            if not fd:
-                fd = FileDetail(**fd_attrs)
-                self.session.add(fd)
-                self.session.commit()
-                logger.debug("Added checksum for %s to database", f)
+        if new_details:
+            self.session.execute(sa.insert(FileDetail), new_details)
+            self.session.commit()
 
 
 class FileDetailFromChecksumsListLoader(FileDetailFromChecksumsLoader):
@@ -256,6 +425,153 @@ class FileDetailFromChecksumsListLoader(FileDetailFromChecksumsLoader):
         return size, ctime
 
 
+class PathComponentMatcher:
+    """
+    Find the first item of a list whose name is a component of a path.
+
+    This is equivalent to trying ``re.match(f".*(^|/){name}(/|$).*", path)``
+    on each item in order, but the names that are plain words are looked up in
+    a dict, from the components of the path. The other names are compiled
+    once, as regular expressions.
+    """
+
+    LITERAL_RE = re.compile(r"[\w-]+")
+
+    def __init__(self, items=(), get_name=lambda item: item.name):
+        self._get_name = get_name
+        self._count = 0
+        # {name: (priority, item)}, the first item with that name wins
+        self._literals = {}
+        # [(priority, regex, item)]
+        self._regexes = []
+        for item in items:
+            self.add(item)
+
+    def add(self, item):
+        """Add an item after the existing ones."""
+        name = self._get_name(item)
+        priority = self._count
+        self._count += 1
+        if self.LITERAL_RE.fullmatch(name):
+            self._literals.setdefault(name, (priority, item))
+        else:
+            self._regexes.append((priority, re.compile(f".*(^|/){name}(/|$).*"), item))
+
+    def match(self, path):
+        """Return the first item matching the path, or None."""
+        best = None
+        for component in path.split("/"):
+            found = self._literals.get(component)
+            if found is not None and (best is None or found[0] < best[0]):
+                best = found
+        for priority, regex, item in self._regexes:
+            if best is not None and priority > best[0]:
+                break
+            if regex.match(path):
+                best = (priority, item)
+                break
+        return None if best is None else best[1]
+
+
+def hash_file(f, algorithms=FILE_DETAIL_DIGESTS, chunk_size=None):
+    """Read a binary file object once, and return its size and its hexdigests as a dict."""
+    chunk_size = chunk_size or HASH_CHUNK_SIZE
+    hashes = [(name, hashlib.new(name)) for name in algorithms]
+    size = 0
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+        size += len(chunk)
+        for _name, h in hashes:
+            h.update(chunk)
+    return size, {name: h.hexdigest() for name, h in hashes}
+
+
+class DigestCache:
+    """
+    The size and the digests of files, indexed by their path.
+
+    An entry is only valid while the inode, the size and the modification time
+    of the file do not change. The cache is stored as JSON in a file, so that
+    the repository metadata files are not hashed again on every run.
+    """
+
+    def __init__(self, path=None, entries=None):
+        self.path = path
+        self._entries = entries or {}
+        self._changed = False
+        # The paths looked up or set since the cache was loaded
+        self._used = set()
+
+    @classmethod
+    def load(cls, path):
+        if path is None:
+            return cls()
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return cls(path)
+        except ValueError:
+            # Corrupted, start over
+            logger.warning("Ignoring the corrupted digest cache %s", path)
+            return cls(path)
+        return cls(path, entries)
+
+    def save(self, prune=None):
+        """Write the cache to its file.
+
+        :param prune: a directory, the entries of the files below it that were
+                      not looked up or set since the cache was loaded are
+                      dropped, they are for files that don't exist anymore
+        """
+        if self.path is None:
+            return
+        if prune is not None:
+            prefix = os.path.join(prune, "")
+            unused = [
+                path for path in self._entries if path.startswith(prefix) and path not in self._used
+            ]
+            for path in unused:
+                del self._entries[path]
+            self._changed = self._changed or bool(unused)
+        if not self._changed:
+            return
+        # Write a new file and rename it, to never leave a half-written cache. Each
+        # process has its own temporary file, umdl and update-single-file-detail may
+        # run at the same time.
+        with tempfile.NamedTemporaryFile(
+            "w",
+            dir=os.path.dirname(self.path) or ".",
+            prefix=f"{os.path.basename(self.path)}.",
+            suffix=".tmp",
+            delete=False,
+        ) as f:
+            try:
+                json.dump(self._entries, f)
+            except BaseException:
+                f.close()
+                os.unlink(f.name)
+                raise
+        os.replace(f.name, self.path)
+        self._changed = False
+
+    @staticmethod
+    def _get_key(s):
+        return [s.st_ino, s.st_size, s.st_mtime_ns]
+
+    def get(self, path, s):
+        """Return the size and the digests of a file from its stat() result, or None."""
+        self._used.add(path)
+        entry = self._entries.get(path)
+        if entry is None or entry["key"] != self._get_key(s):
+            return None
+        return entry["size"], entry["digests"]
+
+    def set(self, path, s, size, digests):
+        self._entries[path] = {"key": self._get_key(s), "size": size, "digests": digests}
+        self._used.add(path)
+        self._changed = True
+
+
 class RepoMaker:
     allowed_targets = ["repomd.xml", "summary"]
 
@@ -264,6 +580,10 @@ class RepoMaker:
         self.config = config
         self._arch_cache = None
         self._version_cache = None
+        self._arch_matcher = None
+        # The matchers of the versions of each product
+        self._version_matchers = {}
+        self.digest_cache = DigestCache.load(config.get("UMDL_DIGEST_CACHE"))
 
     @property
     def arch_cache(self):
@@ -277,6 +597,21 @@ class RepoMaker:
             self._version_cache = mirrormanager2.lib.get_versions(self.session)
         return self._version_cache
 
+    def _add_version(self, ver):
+        self.version_cache.append(ver)
+        matcher = self._version_matchers.get(ver.product_id)
+        if matcher is not None:
+            matcher.add(ver)
+
+    def _get_version_matcher(self, product_id):
+        try:
+            return self._version_matchers[product_id]
+        except KeyError:
+            matcher = self._version_matchers[product_id] = PathComponentMatcher(
+                v for v in self.version_cache if v.product_id == product_id
+            )
+            return matcher
+
     def create_version_from_path(self, category, path):
         ver = None
         vname = _get_version_from_path(path)
@@ -305,27 +640,23 @@ class RepoMaker:
         if "SRPMS" in path:
             arch = mirrormanager2.lib.get_arch_by_name(self.session, "source")
         else:
-            for a in self.arch_cache:
-                s = f".*(^|/){a.name}(/|$).*"
-                if re.compile(s).match(path):
-                    arch = mirrormanager2.lib.get_arch_by_name(self.session, a.name)
-                    break
+            if self._arch_matcher is None:
+                self._arch_matcher = PathComponentMatcher(self.arch_cache)
+            a = self._arch_matcher.match(path)
+            if a is not None:
+                arch = mirrormanager2.lib.get_arch_by_name(self.session, a.name)
 
         ver = None
         # newest versions/IDs first, also handles stupid Fedora 9.newkey hack.
-        for v in self.version_cache:
-            if v.product_id != category.product.id:
-                continue
-            s = f".*(^|/){v.name}(/|$).*"
-            if re.compile(s).match(path):
-                ver = mirrormanager2.lib.get_version_by_id(self.session, v.id)
-                break
+        v = self._get_version_matcher(category.product.id).match(path)
+        if v is not None:
+            ver = mirrormanager2.lib.get_version_by_id(self.session, v.id)
 
         # create Versions if we can figure it out...
         if ver is None:
             ver = self.create_version_from_path(category, path)
             if ver:
-                self.version_cache.append(ver)
+                self._add_version(ver)
         return (ver, arch)
 
     def make_repo(self, directory, relativeDName, category, target):
@@ -370,7 +701,7 @@ class RepoMaker:
                 ver = self.create_version_from_path(category, relativeDName)
                 self.session.add(ver)
                 self.session.flush()
-                self.version_cache.append(ver)
+                self._add_version(ver)
 
         repo = None
         prefix = repo_prefix(relativeDName, category, ver)
@@ -417,22 +748,26 @@ class RepoMaker:
 
         absolutepath = os.path.join(diskpath, relativeDName, target)
 
-        if not os.path.exists(absolutepath):
-            logger.warning(f"{warning}: {absolutepath!r} does not exist")
-            return
-
         try:
-            with open(absolutepath, "rb") as f:
-                contents = f.read()
-        except Exception:
-            logger.exception("Error reading %s", absolutepath)
+            s = os.stat(absolutepath)
+        except OSError:
+            logger.warning(f"{warning}: {absolutepath!r} does not exist")
             return
 
-        size = len(contents)
-        md5 = hashlib.md5(contents).hexdigest()
-        sha1 = hashlib.sha1(contents).hexdigest()
-        sha256 = hashlib.sha256(contents).hexdigest()
-        sha512 = hashlib.sha512(contents).hexdigest()
+        cached = self.digest_cache.get(absolutepath, s)
+        if cached is None:
+            try:
+                with open(absolutepath, "rb") as f:
+                    # The file may have changed since the stat() above
+                    s = os.fstat(f.fileno())
+                    size, digests = hash_file(f)
+            except Exception:
+                logger.exception("Error reading %s", absolutepath)
+                return
+            self.digest_cache.set(absolutepath, s, size, digests)
+        else:
+            logger.debug("Using the cached digests of %s", absolutepath)
+            size, digests = cached
 
         if target == "repomd.xml":
             yumrepo = rpmmd.repoMDObject.RepoMD("repoid", absolutepath)
@@ -442,15 +777,15 @@ class RepoMaker:
         elif target == "summary":
             # TODO -- ostree repos may have a timestamp in their summary file
             # someday.  for now, just use the system mtime.
-            timestamp = os.path.getmtime(absolutepath)
+            timestamp = s.st_mtime
 
         fd_attrs = dict(
             directory_id=D.id,
             filename=target,
-            sha1=sha1,
-            md5=md5,
-            sha256=sha256,
-            sha512=sha512,
+            sha1=digests["sha1"],
+            md5=digests["md5"],
+            sha256=digests["sha256"],
+            sha512=digests["sha512"],
             size=size,
             timestamp=timestamp,
         )
@@ -0,0 +1,117 @@
+"""
+MirrorManager2 internal api to walk a directory tree on disk.
+
+The master mirror is usually an NFS mount, where each stat() or directory
+listing is a round trip to the server. ``walk_tree()`` lists the directories
+with os.scandir() in a pool of threads, so that many of them are in flight at
+the same time, and only stat()s the files of the directories that need it.
+"""
+
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+
+class ScannedDirectory(NamedTuple):
+    # The path relative to the top of the tree, "" for the top
+    path: str
+    # The stat() result of the directory itself
+    stat: os.stat_result
+    # The names of the sub-directories, including the symlinks to directories
+    dirnames: list
+    # The names of the other entries
+    filenames: list
+    # The stat() result of each file, or None if the files were not stat()ed
+    files: dict | None
+
+
+def _scan_directory(fullpath, path, entry, stat_files):
+    """List a directory, return its ScannedDirectory and the DirEntry of the
+    sub-directories to walk, or (None, []) if it can't be listed."""
+    try:
+        # The DirEntry from the parent's listing caches its stat() result
+        s = entry.stat() if entry is not None else os.stat(fullpath)
+        with os.scandir(fullpath) as it:
+            entries = list(it)
+    except OSError as e:
+        logger.debug("Avoiding %r, dissappeared or unreadable: %s", path, e)
+        return None, []
+
+    dirnames = []
+    filenames = []
+    file_entries = []
+    subdirs = []
+    for child in entries:
+        try:
+            is_dir = child.is_dir()
+        except OSError:
+            is_dir = False
+        if not is_dir:
+            filenames.append(child.name)
+            file_entries.append(child)
+            continue
+        dirnames.append(child.name)
+        # Like os.walk(), do not follow the symlinks to directories
+        try:
+            is_symlink = child.is_symlink()
+        except OSError:
+            is_symlink = False
+        if not is_symlink:
+            subdirs.append(child)
+
+    files = None
+    if stat_files is not None and stat_files(path, s):
+        files = {}
+        for child in file_entries:
+            try:
+                files[child.name] = child.stat()
+            except OSError:
+                continue
+    return ScannedDirectory(path, s, dirnames, filenames, files), subdirs
+
+
+def walk_tree(top, exclude=None, stat_files=None, max_workers=1):
+    """
+    Walk a directory tree, listing up to ``max_workers`` directories at the same time.
+
+    Like os.walk() the symlinks to directories are not followed, and the
+    directories that can't be listed are skipped.
+
+    :param top: the top of the tree
+    :param exclude: a function called with the relative path of each
+                    directory, the directories for which it returns True and
+                    their sub-directories are not walked
+    :param stat_files: a function called, in the worker threads, with the
+                       relative path and the stat() result of each directory,
+                       the files of the directories for which it returns True
+                       are stat()ed
+    :param max_workers: the number of threads listing the directories
+    :returns: an iterator of ScannedDirectory, a directory always comes
+              after its parent but the order is not deterministic otherwise
+    """
+    if exclude is not None and exclude(""):
+        return
+    with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+        pending = {executor.submit(_scan_directory, top, "", None, stat_files)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    scanned, subdirs = future.result()
+                    if scanned is None:
+                        continue
+                    for child in subdirs:
+                        path = f"{scanned.path}/{child.name}" if scanned.path else child.name
+                        if exclude is not None and exclude(path):
+                            continue
+                        pending.add(
+                            executor.submit(_scan_directory, child.path, path, child, stat_files)
+                        )
+                    yield scanned
+        finally:
+            # The iteration was interrupted
+            for future in pending:
+                future.cancel()
@@ -32,8 +32,8 @@ def main(config, debug):
         access_stat_threshold = datetime.now() - timedelta(days=config["ACCESS_STATS_KEEP_DAYS"])
         mmlib.delete_expired_access_stats(session, access_stat_threshold)
 
-        ## This is actually done by Directory.age_file_details, but one day we may prefer doing it
-        ## this way instead of building a filedetails cache etc.
+        ## This is actually done by Directory.age_file_details at the end of umdl, but one day we
+        ## may prefer doing it here.
         # file_details_threshold = datetime.now() - timedelta(days=config["MAX_STALE_DAYS"])
         # mmlib.delete_expired_file_details(session, file_details_threshold)
 
@@ -0,0 +1,119 @@
+"""
+Process the report_mirror check-ins queued by the XML-RPC endpoint.
+
+When CHECKIN_QUEUE is enabled, the web application only checks the credentials
+of a check-in and stores it. This script updates the database from the queued
+check-ins, oldest first. When a host checked in several times since the last
+run, its check-ins are merged and the database is only updated once.
+
+This should be run automatically and regularly, every few minutes. Only one
+instance runs at a time: the others exit right away while CHECKIN_QUEUE_LOCK_FILE
+is locked.
+"""
+
+import fcntl
+import logging
+from itertools import groupby
+from operator import itemgetter
+
+import click
+
+import mirrormanager2.lib
+from mirrormanager2.lib.database import get_db_manager
+from mirrormanager2.lib.hostconfig import decode_config, merge_configs, read_host_config
+
+from .common import config_option, setup_logging
+
+logger = logging.getLogger(__name__)
+
+
+def decode_checkins(host_id, checkins):
+    """Decode the queued check-ins of a host, dropping the ones that can't be decoded.
+
+    :param checkins: the (id, data) tuples of the check-ins, the oldest first
+    :returns: the list of the decoded configurations, in the same order
+    """
+    configs = []
+    for checkin_id, data in checkins:
+        try:
+            config = decode_config(data)
+        except Exception:
+            logger.exception("Could not decode the check-in %s of host %s", checkin_id, host_id)
+            continue
+        if not isinstance(config, dict):
+            logger.error("The check-in %s of host %s is not a dict", checkin_id, host_id)
+            continue
+        configs.append(config)
+    return configs
+
+
+def process_host_checkins(session, host_id, checkins):
+    """Update the database from the queued check-ins of a host, then remove them from the queue.
+
+    :param checkins: the (id, data) tuples of the check-ins, the oldest first
+    :returns: True if the check-ins were processed successfully.
+    """
+    checkin_ids = [checkin_id for checkin_id, _data in checkins]
+    configs = decode_checkins(host_id, checkins)
+    r = None
+    if configs:
+        try:
+            config = merge_configs(configs)
+            r, host, message = read_host_config(session, config)
+        except Exception:
+            logger.exception("Error processing the check-ins %s of host %s", checkin_ids, host_id)
+            session.rollback()
+            r = None
+        else:
+            if r is not None:
+                logger.info(
+                    "Checkin for host %s (%s check-ins) succesful: %s", host, len(configs), message
+                )
+            else:
+                logger.error("Error for host %s during checkin: %s", host, message)
+    # Don't retry failed check-ins, the host will check in again
+    mirrormanager2.lib.delete_host_checkins(session, checkin_ids)
+    session.commit()
+    return r is not None
+
+
+@click.command()
+@config_option
+@click.option(
+    "--batch-size",
+    type=int,
+    default=100,
+    show_default=True,
+    help="number of check-ins loaded at once",
+)
+@click.option("--debug", is_flag=True, default=False, help="enable debugging")
+def main(config, batch_size, debug):
+    config = mirrormanager2.lib.read_config(config)
+    db_manager = get_db_manager(config)
+    setup_logging(debug=debug)
+
+    processed = 0
+    failed = 0
+    with open(config.get("CHECKIN_QUEUE_LOCK_FILE"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info("Another mm2_process-checkins is running, exiting")
+            return
+        with db_manager.Session() as session:
+            while True:
+                checkins = mirrormanager2.lib.get_host_checkins(session, limit=batch_size)
+                if not checkins:
+                    break
+                # Coalesce the check-ins of each host, keeping them in order. The objects are
+                # expired by the commits, only keep their values.
+                checkins = sorted((c.host_id, c.id, c.data) for c in checkins)
+                for host_id, host_checkins in groupby(checkins, key=itemgetter(0)):
+                    host_checkins = [
+                        (checkin_id, data) for _host_id, checkin_id, data in host_checkins
+                    ]
+                    if not process_host_checkins(session, host_id, host_checkins):
+                        failed += 1
+                    processed += len(host_checkins)
+
+    logger.info("Processed %s check-ins, %s hosts failed", processed, failed)
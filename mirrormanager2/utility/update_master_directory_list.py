@@ -23,13 +23,11 @@ import datetime
 import glob
 import logging
 import logging.handlers
-import mmap
 import os
 import re
 import stat
 import time
 from contextlib import contextmanager
-from dataclasses import dataclass
 from functools import partial
 
 import click
@@ -41,8 +39,15 @@ from rich.progress import Progress
 import mirrormanager2.lib
 import mirrormanager2.lib.umdl as umdl
 from mirrormanager2.lib.database import get_db_manager
+from mirrormanager2.lib.fullfiletimelist import (
+    FullFileTimeListState,
+    get_changed_directories,
+    get_fingerprint,
+    read_fullfiletimelist,
+)
 from mirrormanager2.lib.model import Directory
-from mirrormanager2.lib.sync import run_rsync
+from mirrormanager2.lib.sync import RsyncError, iter_rsync
+from mirrormanager2.lib.walk import walk_tree
 
 from .common import config_option, filter_master_directories
 
@@ -62,11 +67,20 @@ class MasterFilter(logging.Filter):
         return True
 
 
+def compile_excludes(excludes):
+    """Return one regular expression matching the paths that any of the patterns matches."""
+    if not excludes:
+        # Never matches
+        return re.compile(r"(?!)")
+    return re.compile("|".join(f"(?:{e})" for e in excludes))
+
+
+STD_EXCLUDES_RE = compile_excludes(STD_EXCLUDES)
+
+
 def is_excluded(path, excludes):
-    for e in excludes:
-        if re.compile(e).match(path):
-            return True
-    return False
+    """Return True if the path is excluded, excludes is compiled by compile_excludes()."""
+    return excludes.match(path) is not None
 
 
 def ctime_from_rsync(date, hms):
@@ -121,6 +135,7 @@ class DirSynchronizer:
         # drop any trailing slashes from path
         self.path = path.rstrip("/")
         self.excludes = excludes or []
+        self.excludes_re = compile_excludes(self.excludes)
         self.make_repo_file_details = True
         self.progress_bar = None
 
@@ -147,13 +162,14 @@ class DirSynchronizer:
         directories = self.category.directories  # in ascending name order
         directories.reverse()  # now in descending name order, bottoms up
         for d in directories:
-            if is_excluded(d.name, self.excludes):
+            if is_excluded(d.name, self.excludes_re):
                 continue
             gone = self._is_dir_gone(d, **kwargs)
             if gone and len(d.categories) == 1:  # safety, this should always trigger
                 logger.info("Deleting gone directory %s", d.name)
                 self.session.delete(d)
                 self.session.flush()
+                self.category.directory_cache_discard(d)
 
     def sync_directories(self, category_directories):
         logger.debug("  sync_directories %s", self.category)
@@ -163,58 +179,38 @@ class DirSynchronizer:
                 total=len(category_directories),
             )
 
-        for relativeDName in sorted(category_directories.keys()):
-            value = category_directories[relativeDName]
-            set_readable = False
-            set_ctime = False
-            set_files = False
-
-            if self.progress_bar is not None:
-                self.progress_bar.advance()
+        created, updated = umdl.merge_directories(
+            self.session,
+            self.category,
+            self._iter_staged_directories(category_directories),
+        )
+        logger.info("%s: %s directories created, %s updated", self.category.name, created, updated)
 
-            if relativeDName in self.category.directory_cache:
+        for relativeDName, value in category_directories.items():
+            # Only look for checksum files on disk if the directory changed, or if the
+            # listing says that its checksum files were modified in place.
+            if value["changed"] or umdl.FileDetailFromChecksumsLoader.has_changed_checksum_files(
+                value["files"], value["ctime"]
+            ):
                 d = self.category.directory_cache[relativeDName]
-                if value["readable"] is not None and d.readable != value["readable"]:
-                    set_readable = True
-                if d.ctime != value["ctime"]:
-                    set_ctime = True
                 D = mirrormanager2.lib.get_directory_by_id(self.session, d.id)
-            else:
-                if relativeDName == "":
-                    D = self.category.topdir
-                else:
-                    # Can't find the new directory, just add it
-                    dname = os.path.join(self.category.topdir.name, relativeDName)
-                    D = Directory(name=dname, readable=value["readable"], ctime=value["ctime"])
-                    logger.debug(
-                        "Created Directory({}, readable={}, ctime={})".format(
-                            dname, value["readable"], value["ctime"]
-                        )
-                    )
-                # Add this category to the directory
-                D.categories.append(self.category)
-                self.session.add(D)
-                # And flush so that we can already start using it
-                self.session.flush()
-                # Refresh the cache
-                self.category.directory_cache_clear()
-                d = self.category.directory_cache[relativeDName]
+                loader = umdl.FileDetailFromChecksumsLoader(self.session, self.config, D)
+                loader.load()
 
-            if value["changed"]:
-                set_files = True
-
-            if set_readable:
-                D.readable = value["readable"]
-            if set_ctime:
-                D.ctime = value["ctime"]
-            if set_files:
-                short_fl = short_filelist(value["files"])
-                if D.files != short_fl:
-                    D.files = short_fl
-            self.session.add(D)
-            self.session.flush()
-            loader = umdl.FileDetailFromChecksumsLoader(self.session, self.config, D)
-            loader.load()
+    def _iter_staged_directories(self, category_directories):
+        topdirName = self.category.topdir.name
+        # Parent directories first
+        for relativeDName in sorted(category_directories):
+            value = category_directories[relativeDName]
+            if self.progress_bar is not None:
+                self.progress_bar.advance()
+            yield {
+                "name": os.path.join(topdirName, relativeDName) if relativeDName else topdirName,
+                "readable": value["readable"],
+                "ctime": value["ctime"],
+                "changed": value["changed"],
+                "files": short_filelist(value["files"]) if value["changed"] else None,
+            }
 
     def sync_repos(self, category_directories):
         if self.progress_bar is not None:
@@ -230,8 +226,8 @@ class DirSynchronizer:
             if self.progress_bar is not None:
                 self.progress_bar.advance()
 
-            D = self.category.directory_cache[relativeDName]
-            # D = mirrormanager2.lib.get_directory_by_id(self.session, d.id)
+            d = self.category.directory_cache[relativeDName]
+            D = mirrormanager2.lib.get_directory_by_id(self.session, d.id)
 
             if (data["isRepository"] or data["isAtomic"]) and not any(
                 srd in relativeDName for srd in SKIP_REPO_DIRS
@@ -246,28 +242,35 @@ class DirSynchronizer:
                 if target in data["files"] and self.make_repo_file_details:
                     repomaker.make_file_details(D, self.path, relativeDName, target)
 
+        # Forget the files of this category that are gone
+        repomaker.digest_cache.save(prune=self.path)
+
 
 class RsyncDirSynchronizer(DirSynchronizer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.make_repo_file_details = False  # ab: not sure why
+        self.all_excludes_re = compile_excludes(STD_EXCLUDES + self.excludes)
 
-    @contextmanager
-    def _get_rsync_listing(self, extra_rsync_options=None):
+    def _iter_rsync_listing(self, extra_rsync_options=None):
         try:
-            result, output = run_rsync(self.path, extra_rsync_options, logger)
-        except Exception:
-            logger.warning("Failed to run rsync.", exc_info=True)
-            return
-        if result > 0:
+            yield from iter_rsync(self.path, extra_rsync_options, logger)
+        except RsyncError as e:
+            # still, try to use the output listing if we can
             logger.info(
-                "rsync returned exit code %s for Category %s: %s",
-                result,
+                "rsync returned exit code %s for Category %s",
+                e.returncode,
                 self.category.name,
-                output,
             )
-        # still, try to use the output listing if we can
-        yield output
+
+    @contextmanager
+    def _get_rsync_listing(self, extra_rsync_options=None):
+        # The listing is parsed while rsync is running
+        output = self._iter_rsync_listing(extra_rsync_options)
+        try:
+            yield output
+        finally:
+            output.close()
 
     def _get_category_directories(self, **kwargs):
         with self._get_rsync_listing(**kwargs) as output:
@@ -283,7 +286,7 @@ class RsyncDirSynchronizer(DirSynchronizer):
         else:
             directoryname = os.path.join(topdirName, relativeDName)
 
-        if is_excluded(directoryname, STD_EXCLUDES + self.excludes):
+        if is_excluded(directoryname, self.all_excludes_re):
             return
 
         perms = line.split()[0]
@@ -370,42 +373,44 @@ class FileDirSynchronizer(RsyncDirSynchronizer):
 
 
 class DiskDirSynchronizer(DirSynchronizer):
+    def _is_excluded(self, relativeDName):
+        if is_excluded(relativeDName, STD_EXCLUDES_RE):
+            logger.info("excluding %s", relativeDName)
+            return True
+        return False
+
     def _get_category_directories(self, **kwargs):
         logger.debug("sync_directories_from_disk %r", self.path)
-        unreadable_dirs = set()
         category_directories = {}
+        # Load it before the threads start
+        directory_cache = self.category.directory_cache
 
-        for dirpath, dirnames, filenames in os.walk(self.path, topdown=True):
-            relativeDName = dirpath[len(self.path) + 1 :]
-            relativeDName = relativeDName.strip("/")
-            logger.debug("  walking %r", relativeDName)
-            if is_excluded(relativeDName, STD_EXCLUDES):
-                logger.info("excluding %s", relativeDName)
-                # exclude all its subdirs too
-                dirnames[:] = []
-                continue
-
-            # avoid disappearing directories
-            try:
-                s = os.stat(os.path.join(self.path, relativeDName))
-                ctime = s[stat.ST_CTIME]
-            except OSError:
-                logger.debug("Avoiding %r, dissappeared.", relativeDName)
-                continue
-
+        def _get_db_ctime(relativeDName):
             try:
-                d_ctime = self.category.directory_cache[relativeDName].ctime
+                return directory_cache[relativeDName].ctime
             except KeyError:
                 # we'll need to create it
-                d_ctime = 0
+                return 0
 
-            # dirnames.sort()
+        def _has_changed(relativeDName, s):
+            # skip per-file stat()s if the directory hasn't changed
+            return _get_db_ctime(relativeDName) != s[stat.ST_CTIME]
 
+        scanned_directories = walk_tree(
+            self.path,
+            exclude=self._is_excluded,
+            stat_files=_has_changed,
+            max_workers=self.config.get("UMDL_DISK_WALKER_THREADS", 4),
+        )
+        for scanned in scanned_directories:
+            relativeDName = scanned.path
+            logger.debug("  walking %r", relativeDName)
+            s = scanned.stat
+            ctime = s[stat.ST_CTIME]
+            d_ctime = _get_db_ctime(relativeDName)
             readable = bool(s.st_mode & stat.S_IRWXO & (stat.S_IROTH | stat.S_IXOTH))
-            if not readable or umdl.parent_dir(relativeDName) in unreadable_dirs:
-                unreadable_dirs.add(relativeDName)
-            isRepo = "repodata" in dirnames
-            isAtomic = "summary" in filenames and "objects" in dirnames
+            isRepo = "repodata" in scanned.dirnames
+            isAtomic = "summary" in scanned.filenames and "objects" in scanned.dirnames
 
             changed = d_ctime != ctime
             relativeDNameText = f" {relativeDName}" if relativeDName else ""
@@ -420,8 +425,16 @@ class DiskDirSynchronizer(DirSynchronizer):
             else:
                 logger.debug("%s %s has not changed", self.category.name, relativeDName)
 
+            files = {}
+            if scanned.files is not None:
+                for f, fs in scanned.files.items():
+                    files[f] = {
+                        "size": str(fs.st_size),
+                        "stat": fs[stat.ST_CTIME],
+                    }
+
             category_directories[relativeDName] = {
-                "files": {},
+                "files": files,
                 "isRepository": isRepo,
                 "isAtomic": isAtomic,
                 "readable": readable,
@@ -429,66 +442,61 @@ class DiskDirSynchronizer(DirSynchronizer):
                 "changed": changed,
             }
 
-            # skip per-file stat()s if the directory hasn't changed
-            if changed:
-                for f in filenames:
-                    try:
-                        s = os.stat(os.path.join(self.path, relativeDName, f))
-                    except OSError:
-                        continue
-                    category_directories[relativeDName]["files"][f] = {
-                        "size": str(s.st_size),
-                        "stat": s[stat.ST_CTIME],
-                    }
-
         return category_directories
 
 
-@dataclass
-class FFTLine:
-    # Type can be either 'f' or 'd'
-    filetype: str
-    readable: bool
-    path: str
-    timestamp: int
-    size: int
-
-
 class FFTDirSynchronizer(DirSynchronizer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The digests of the directories of the fullfiletimelist processed by the previous run
+        self._previous_digests = None
+        self._digests = None
+
     def _is_dir_gone(self, d, ctimes):
         if d.name == self.category.topdir.name:
             return False
         return d.name not in ctimes
 
-    def _read_fullfiletimelist(self, filename):
-        with open(filename, "rb") as f:
-            # tell mmap to open file read-only or mmap might fail
-            m = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
-            in_files_section = False
-            row = m.readline()
-            while row:
-                row = row.decode()
-                if row.strip() == "[Files]":
-                    in_files_section = True
-                elif in_files_section and row.strip().startswith("["):
-                    in_files_section = False
-                if not in_files_section:
-                    row = m.readline()
-                    continue
-                cols = row.strip().split("\t")
-                # only rows with at least 4 columns are what we are looking for
-                # 'ctime\ttype\tsize\tname'
-                if len(cols) < 4:
-                    row = m.readline()
-                    continue
-                yield FFTLine(
-                    filetype=cols[1][0],
-                    readable=len(cols[1]) >= 2 and cols[1][1] == "-",
-                    path=cols[3],
-                    timestamp=int(cols[0]),
-                    size=int(cols[2]),
-                )
-                row = m.readline()
+    def _get_state_path(self):
+        cache_dir = self.config.get("UMDL_FULLFILETIMELIST_CACHE_DIR")
+        if not cache_dir:
+            return None
+        return os.path.join(cache_dir, f"category-{self.category.id}.json")
+
+    def _find_fullfiletimelist(self):
+        # let's look for a fullfiletimelist-* file
+        try:
+            if self.category.name == "Fedora Linux":
+                filelist = glob.glob(f"{self.path}/../fullfiletimelist-*")
+            else:
+                filelist = glob.glob(f"{self.path}/fullfiletimelist-*")
+        except Exception as e:
+            raise SyncImpossible from e
+
+        if len(filelist) < 1:
+            # not a single element found in the glob
+            raise SyncImpossible
+
+        # blindly take the first file found by the glob
+        return filelist[0]
+
+    def sync(self, **kwargs):
+        state_path = self._get_state_path()
+        if state_path is None:
+            return super().sync(**kwargs)
+
+        filename = self._find_fullfiletimelist()
+        state = FullFileTimeListState.load(state_path)
+        fingerprint = get_fingerprint(filename, state.fingerprint)
+        if fingerprint == state.fingerprint:
+            logger.info("%s has not changed since the last run, skipping", filename)
+            return
+        # Only process the directories that changed since the previous fullfiletimelist
+        self._previous_digests = state.digests
+        super().sync(**kwargs)
+        # The state must not get ahead of the database
+        self.session.commit()
+        FullFileTimeListState(fingerprint, self._digests).save(state_path)
 
     def _parse_fullfiletimelist(self):
         """
@@ -520,79 +528,56 @@ class FFTDirSynchronizer(DirSynchronizer):
                 return p[6:]
             return p
 
-        # let's look for a fullfiletimelist-* file
-        try:
-            if self.category.name == "Fedora Linux":
-                filelist = glob.glob(f"{self.path}/../fullfiletimelist-*")
-            else:
-                filelist = glob.glob(f"{self.path}/fullfiletimelist-*")
-        except Exception as e:
-            raise SyncImpossible from e
-
-        if len(filelist) < 1:
-            # not a single element found in the glob
-            raise SyncImpossible
-
-        # blindly take the first file found by the glob
-        logger.info("Loading and parsing %s", filelist[0])
+        filename = self._find_fullfiletimelist()
+        logger.info("Loading and parsing %s", filename)
 
         if self.progress_bar is not None:
             self.progress_bar.reset(
                 description=f"Reading fullfiletimelist of {self.category.name}", total=None
             )
 
+        umdl_prefix = self.config["UMDL_PREFIX"]
+        fft = read_fullfiletimelist(filename, with_digests=self._get_state_path() is not None)
+        self._digests = fft.digests
+
+        # The paths of the fullfiletimelist are converted to directory names once per
+        # directory, not once per file. The top directory of the category (an empty
+        # path) is named without a trailing slash, like the root directory added below.
+        def _get_directory_name(path):
+            path = _handle_fedora_linux_category(path)
+            if path:
+                path = os.path.join(self.path, path)
+            else:
+                path = self.path
+            return path.replace(umdl_prefix, "")
+
         # A hash with directories as key and ctime as value
-        ctimes = {}
+        ctimes = {_get_directory_name(path): ctime for path, ctime in fft.ctimes.items()}
         # A hash with directories as key and
         # { filename: { 'stat' : ctime, 'size': 'filesize' } } as value
         files = {}
-        seen = set()
+        for path, dir_files in fft.files.items():
+            name = _get_directory_name(path)
+            if name in files:
+                # Several paths of the file can point to the same directory
+                files[name].merge(dir_files)
+            else:
+                files[name] = dir_files
         # A set with a list of directories with a repository (repodata)
-        repo = set()
-        # These two sets will be used to determine if it's an atomic repo dir.
+        repo = {_get_directory_name(path) for path in fft.repo_dirs}
         # An atomic repo dir has both a summary file and an objects dir
-        has_summary = set()
-        has_objects = set()
-
-        umdl_prefix = self.config["UMDL_PREFIX"]
-        # Not opening the file as stream and reading line by line as this breaks
-        # if the file changes. As this can happen, the file is loaded once into
-        # memory using mmap.
-        for line in self._read_fullfiletimelist(filelist[0]):
-            # only files (type: f)
-            if line.filetype == "f":
-                # put all the information in a dict with path as key
-                fullpath = os.path.dirname(_handle_fedora_linux_category(line.path))
-                fullpath = os.path.join(self.path, fullpath).replace(umdl_prefix, "")
-                basename = os.path.basename(line.path)
-
-                if fullpath in seen:
-                    files[fullpath].update({basename: {"stat": line.timestamp, "size": line.size}})
-                else:
-                    files[fullpath] = {basename: {"stat": line.timestamp, "size": line.size}}
-                    # Use a set() to track if the element already exists in the dict().
-                    # This is much faster than if fullpath in files.keys(); much much faster
-                    seen.add(fullpath)
-                if basename == "summary":
-                    # There is a 'summary' file, add the parent
-                    # directory to the has_summary set().
-                    has_summary.add(fullpath)
-            elif line.filetype == "d":
-                # get all directories and their ctime
-                fullpath = os.path.join(self.path, _handle_fedora_linux_category(line.path))
-                fullpath = fullpath.replace(umdl_prefix, "")
-                ctimes[fullpath] = line.timestamp
-                basename = os.path.basename(line.path)
-                # Only if a directory contains a 'repodata' directory
-                # it should be used for repository creation.
-                if basename == "repodata":
-                    # This is a 'repodata' directory, add the parent
-                    # directory to the repo set().
-                    repo.add(os.path.dirname(fullpath))
-                if basename == "objects":
-                    # This is a 'objects' directory, add the parent
-                    # directory to the has_objects set().
-                    has_objects.add(os.path.dirname(fullpath))
+        atomic = {_get_directory_name(path) for path in fft.atomic_dirs}
+
+        # The directories to process, None for all of them
+        changed_dirs = None
+        if self._previous_digests is not None and self._digests is not None:
+            changed_dirs = {
+                _get_directory_name(path)
+                for path in get_changed_directories(self._previous_digests, self._digests)
+            }
+            logger.info(
+                "%s directories changed since the previous fullfiletimelist", len(changed_dirs)
+            )
 
         # add the root directory of the current category
         tmp = self.path.replace(umdl_prefix, "")
@@ -601,7 +586,8 @@ class FFTDirSynchronizer(DirSynchronizer):
             "ctimes": ctimes,
             "files": files,
             "repo_dirs": repo,
-            "atomic_dirs": has_summary & has_objects,
+            "atomic_dirs": atomic,
+            "changed_dirs": changed_dirs,
         }
 
     def _get_category_directories(self, **kwargs):
@@ -618,11 +604,13 @@ class FFTDirSynchronizer(DirSynchronizer):
 
         category_directories = {}
         for dirname in data["ctimes"].keys():
+            if data["changed_dirs"] is not None and dirname not in data["changed_dirs"]:
+                continue
             if dirname in seen:
                 logger.info("Skipping already seen directory %s", dirname)
                 continue
             seen.add(dirname)
-            if is_excluded(dirname, STD_EXCLUDES):
+            if is_excluded(dirname, STD_EXCLUDES_RE):
                 logger.info("Excluding %s", dirname)
                 continue
             try:
@@ -766,8 +754,9 @@ def main(
                     progress_bar,
                 )
 
-        logger.debug("Refresh the list of repomd.xml")
-        Directory.age_file_details(session, config)
+            logger.debug("Refresh the list of repomd.xml")
+            deleted = Directory.age_file_details(session, config, progress_bar=progress_bar)
+            logger.debug("Removed %s old file details", deleted)
         session.commit()
 
     _current_cname = "N/A"
@@ -60,6 +60,7 @@ def main(config, categories, debug, filename):
 
             repomaker = mirrormanager2.lib.umdl.RepoMaker(session, config)
             created = repomaker.make_file_details(directory, master_dir["path"], dirname, target)
+            repomaker.digest_cache.save()
 
             if created is False:
                 logger.warning(f"FileDetail unchanged {filename!r}")
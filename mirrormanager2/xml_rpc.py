@@ -27,8 +27,16 @@ import json
 import logging
 import pickle
 
+from flask import current_app
+
+import mirrormanager2.lib
 from mirrormanager2.database import DB
-from mirrormanager2.lib.hostconfig import read_host_config
+from mirrormanager2.lib.hostconfig import (
+    check_host_config,
+    encode_config,
+    is_delta_config,
+    read_host_config,
+)
 
 try:
     from flask_xmlrpcre.xmlrpcre import XMLRPCHandler
@@ -44,17 +52,51 @@ XMLRPC = XMLRPCHandler("xmlrpc")
 @XMLRPC.register
 def checkin(pickledata):
     is_pickle = False
-    uncompressed = bz2.decompress(base64.urlsafe_b64decode(pickledata))
+    compressed = base64.urlsafe_b64decode(pickledata)
+    uncompressed = bz2.decompress(compressed)
     try:
         config = json.loads(uncompressed)
     except ValueError:
         logging.info("Fell back to pickle")
         is_pickle = True
         config = pickle.loads(uncompressed)
-    r, host, message = read_host_config(DB.session, config)
+    # The delta check-ins are small and must be checked against the last known tree right away
+    if current_app.config.get("CHECKIN_QUEUE") and not (
+        isinstance(config, dict) and is_delta_config(config)
+    ):
+        # The JSON payload is already compressed the way the queue stores it
+        data = encode_config(config) if is_pickle else compressed
+        return _queue_checkin(config, data, is_pickle)
+    full_reports = []
+    r, host, message = read_host_config(DB.session, config, full_reports=full_reports)
     if r is not None:
         logging.info(f"Checkin for host {host} (pickle:{is_pickle}) succesful: {message}")
-        return message + "checked in successful"
+        return _reply(config, message + "checked in successful", full_reports)
     else:
         logging.error(f"Error for host {host} (pickle:{is_pickle}) during checkin: {message}")
-        return message + "error checking in"
+        return _reply(config, message + "error checking in")
+
+
+def _reply(config, message, full_reports=()):
+    """Build the response to a check-in.
+
+    The clients speaking the version 1 of the protocol get a struct with the
+    categories they must send the whole directory tree of, the others a string.
+    """
+    if isinstance(config, dict) and config.get("version") == 1:
+        return {"message": message, "full_report": list(full_reports)}
+    return message
+
+
+def _queue_checkin(config, data, is_pickle):
+    """Check the credentials and queue the check-in for mm2_process-checkins."""
+    host, chostname, message = check_host_config(DB.session, config)
+    if host is None:
+        logging.error(f"Error for host {chostname} (pickle:{is_pickle}) during checkin: {message}")
+        return _reply(config, message + "error checking in")
+    checkin = mirrormanager2.lib.add_host_checkin(DB.session, host, data)
+    DB.session.commit()
+    logging.info(f"Checkin {checkin.id} for host {chostname} (pickle:{is_pickle}) queued")
+    return _reply(
+        config, message + f"check-in {checkin.id} queued for processing\nchecked in successful"
+    )
@@ -12,7 +12,7 @@ from sqlalchemy import select
 
 from mirrormanager2.app import create_app
 from mirrormanager2.database import DB
-from mirrormanager2.lib import model
+from mirrormanager2.lib import model, refresh_host_capabilities
 
 from .auth import AnotherFakeFasUser, FakeFasUser, FakeFasUserAdmin, user_set
 
@@ -875,6 +875,11 @@ def hostcategorydir(db):
             up2date=True,
         )
         db.add(item)
+    db.flush()
+
+    # Like the crawler and the check-ins do
+    for host_id in db.scalars(select(model.Host.id)):
+        refresh_host_capabilities(db, host_id)
 
     db.commit()
 
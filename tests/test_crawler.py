@@ -15,22 +15,30 @@
 mirrormanager2 tests for the crawler.
 """
 
+import asyncio
 import os
+import signal
 from datetime import datetime
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
+import aiohttp
 import pytest
 import sqlalchemy as sa
 from fedora_messaging.testing import mock_sends
 from mirrormanager_messages.host import HostCrawlerDisabledV1
 
 from mirrormanager2 import default_config
+from mirrormanager2.crawler.autoindex import AutoindexParser, parse_size
 from mirrormanager2.crawler.connection_pool import ConnectionPool
-from mirrormanager2.crawler.crawler import CrawlResult
+from mirrormanager2.crawler.crawler import Crawler, CrawlResult, get_hcd_path
+from mirrormanager2.crawler.database import get_crawler_db_manager, worker_session
+from mirrormanager2.crawler.manifest import DirectoryManifest, FileEntry, ManifestStore
+from mirrormanager2.crawler.reconciler import HostCategoryDirReconciler
 from mirrormanager2.crawler.reporter import store_crawl_result
-from mirrormanager2.crawler.states import CrawlStatus
-from mirrormanager2.lib import model
-from mirrormanager2.lib.sync import run_rsync
+from mirrormanager2.crawler.rsync_listing import SYMLINK, RsyncListing, get_include_patterns
+from mirrormanager2.crawler.states import CrawlStatus, SyncStatus
+from mirrormanager2.lib import get_directory_files_by_categories, model
+from mirrormanager2.lib.sync import RsyncError, iter_rsync, run_rsync
 
 FOLDER = os.path.dirname(os.path.abspath(__file__))
 
@@ -132,21 +140,111 @@ def test_run_rsync():
     assert "fedora/linux/development/22/" in output
 
 
+def test_iter_rsync():
+    """Test the iter_rsync function"""
+
+    # Test timeout if timeout works
+    with pytest.raises(RsyncError) as excinfo:
+        for _line in iter_rsync("/", timeout=0.05):
+            pass
+    assert excinfo.value.returncode == -9
+
+    # Test with non-existing directory
+    with pytest.raises(RsyncError) as excinfo:
+        list(iter_rsync("this-is-not-here-i-hope--"))
+    assert excinfo.value.returncode == 23
+
+    # Test the 'normal' usage
+    dest = FOLDER + "/../testdata/"
+    output = "".join(iter_rsync(dest, "--exclude *aalib*"))
+    assert "pub/fedora/linux/releases/20/Fedora/" in output
+    assert "aalib" not in output
+
+    # Stopping the iteration early kills rsync
+    lines = iter_rsync("/")
+    next(lines)
+    lines.close()
+
+
 def test_scan_rsync(db, dir_obj_with_files, config):
     """Test scanning directories with missing files."""
     connection_pool = ConnectionPool(config)
     connector = connection_pool.get(f"rsync://{FOLDER}/../testdata/")
     dir_url = f"rsync:///{FOLDER}/../testdata/pub/fedora/linux"
-    scan_result = {
-        f"{dir_url}/{filename}": fileinfo for filename, fileinfo in dir_obj_with_files.files.items()
-    }
-    for fileinfo in scan_result.values():
-        fileinfo["mode"] = "f"
+    scan_result = RsyncListing()
+    scan_result.feed(
+        f"-rw-r--r-- {fileinfo['size']} 2023/10/01 10:00:00 {dir_url}/{filename}\n"
+        for filename, fileinfo in dir_obj_with_files.files.items()
+    )
     connector._scan_result = scan_result
     result = connector.check_dir(dir_url, dir_obj_with_files)
     assert result is True
 
 
+def test_rsync_listing():
+    """Test that the rsync listing only keeps the wanted directories."""
+    listing = RsyncListing(wanted={"", "releases/39"})
+    listing.feed(
+        [
+            "drwxr-xr-x          4,096 2023/10/01 10:00:00 .\n",
+            "-rw-r--r--             42 2023/10/01 10:00:00 README\n",
+            "drwxr-xr-x          4,096 2023/10/01 10:00:00 releases/39\n",
+            "-rw-r--r--      1,234,567 2023/10/01 10:00:00 releases/39/a file.iso\n",
+            "lrwxrwxrwx             10 2023/10/01 10:00:00 releases/39/latest -> ../40\n",
+            "-rw-r--r--      1,234,567 2023/10/01 10:00:00 releases/40/other.iso\n",
+            "invalid line\n",
+        ]
+    )
+    assert listing.lines == 7
+    assert len(listing) == 3
+    assert listing.get_size("", "README") == 42
+    assert listing.get_size("releases/39", "a file.iso") == 1234567
+    assert listing.get_size("releases/39", "latest") == SYMLINK
+    assert listing.get_size("releases/40", "other.iso") is None
+    assert listing.get_size("releases", "39") is None
+
+
+def test_rsync_include_patterns():
+    """Test the rsync include patterns of the known directories."""
+    patterns = list(get_include_patterns(["", "releases/39", "releases/39/os", "x[1]"]))
+    assert patterns == [
+        "/*",
+        "/releases/",
+        "/releases/39/",
+        "/releases/39/*",
+        "/releases/39/os/",
+        "/releases/39/os/*",
+        "/x\\[1]/",
+        "/x\\[1]/*",
+    ]
+
+
+def test_rsync_include_filter(dir_obj, config):
+    """Test that rsync is only asked to list the directories of the category."""
+    connection_pool = ConnectionPool(config)
+    url = "rsync://mirror.example.com/fedora/linux"
+    connector = connection_pool.get(url)
+    calls = []
+
+    def iter_rsync(rsyncpath, extra_rsync_args, logger):
+        filter_path = extra_rsync_args.split("--include-from=")[1].split()[0]
+        with open(filter_path) as filter_file:
+            calls.append((rsyncpath, extra_rsync_args, filter_file.read()))
+        yield "drwxr-xr-x          4,096 2023/10/01 10:00:00 .\n"
+        yield "-rw-r--r--              1 2023/10/01 10:00:00 does-not-exist\n"
+
+    connector.prepare_category(url, [dir_obj], len(dir_obj.name) + 1)
+    with patch("mirrormanager2.crawler.rsync_connector.iter_rsync", iter_rsync):
+        listing = connector._run(url)
+    assert len(calls) == 1
+    rsyncpath, extra_rsync_args, patterns = calls[0]
+    assert rsyncpath == f"{url}/"
+    assert extra_rsync_args.startswith(config["CRAWLER_RSYNC_PARAMETERS"])
+    assert extra_rsync_args.endswith(" --exclude='*'")
+    assert patterns == "/*\n"
+    assert listing.get_size("", "does-not-exist") == 1
+
+
 def test_scan_missing_files_rsync(db, dir_obj_with_files, config):
     """Test scanning directories with missing files."""
     connection_pool = ConnectionPool(config)
@@ -178,7 +276,7 @@ def test_scan_http(db, dir_obj_with_files):
     assert result is True
     connector.get_connection.assert_called_once()
     connector._check_file.assert_called_once_with(
-        mocked_connection, f"{dir_url}/does-not-exist", {"size": 1, "stat": 1}, True
+        mocked_connection, f"{dir_url}/does-not-exist", FileEntry("does-not-exist", 1, 1), True
     )
 
 
@@ -194,7 +292,7 @@ def test_scan_missing_files_http(db, dir_obj_with_files):
     assert result is False
     connector.get_connection.assert_called_once()
     connector._check_file.assert_called_once_with(
-        mocked_connection, f"{dir_url}/does-not-exist", {"size": 1, "stat": 1}, True
+        mocked_connection, f"{dir_url}/does-not-exist", FileEntry("does-not-exist", 1, 1), True
     )
 
 
@@ -211,6 +309,124 @@ def test_scan_empty_directory_http(db, dir_obj):
     connector._check_file.assert_not_called()
 
 
+@pytest.mark.parametrize("missing", [None, "file-3"])
+def test_scan_http_concurrently(db, dir_obj, missing):
+    """Test scanning directories with simultaneous HTTP requests"""
+    dir_obj.files = {f"file-{index}": {"size": 1, "stat": 1} for index in range(10)}
+    db.commit()
+    connection_pool = ConnectionPool({"CRAWLER_HTTP_CONCURRENCY": 4}, max_connections=3)
+    connector = connection_pool.get("http://localhost/testdata/")
+    assert connector.concurrency == 3
+    connector.get_connection = Mock()
+    connector._check_file = Mock(
+        side_effect=lambda conn, url, file_entry, readable: file_entry.name != missing
+    )
+    dir_url = "http://localhost/testdata/pub/fedora/linux"
+    result = connector.check_dir(dir_url, dir_obj)
+    connection_pool.close_all()
+    if missing is None:
+        assert result is True
+        assert connector._check_file.call_count == 10
+    else:
+        assert result is False
+        # The remaining files were not checked
+        assert connector._check_file.call_count < 10
+
+
+NGINX_LISTING = """<html><head><title>Index of /</title></head><body><pre><a href="../">../</a>
+<a href="file%20one.rpm">file one.rpm</a>                    01-Oct-2023 10:00             1234
+<a href="repomd.xml">repomd.xml</a>                          01-Oct-2023 10:00             3100
+<a href="sub/">sub/</a>                                      01-Oct-2023 10:00             -
+</pre></body></html>"""
+
+NOSIZE_LISTING = """<html><head><title>Index of /</title></head><body><pre><a href="../">../</a>
+<a href="file%20one.rpm">file one.rpm</a>                    01-Oct-2023 10:00             1234
+<a href="nosize.rpm">nosize.rpm</a>                          01-Oct-2023 10:00             -
+</pre></body></html>"""
+
+APACHE_LISTING = """<html><body><table>
+<tr><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=S;O=A">Size</a></th></tr>
+<tr><td><a href="../">Parent Directory</a></td><td align="right">  - </td></tr>
+<tr><td><a href="file%20one.rpm"><img src="/icons/rpm.gif"></a></td>
+<td><a href="file%20one.rpm">file one.rpm</a></td>
+<td align="right">2023-10-01 10:00  </td><td align="right">1.2K</td><td>&nbsp;</td></tr>
+<tr><td><a href="repomd.xml">repomd.xml</a></td>
+<td align="right">2023-10-01 10:00  </td><td align="right">3.0K</td><td>&nbsp;</td></tr>
+</table></body></html>"""
+
+
+@pytest.mark.parametrize("listing", [NGINX_LISTING, APACHE_LISTING])
+def test_autoindex_parser(listing):
+    parser = AutoindexParser({"file one.rpm", "repomd.xml", "sub", "other"})
+    # Feed the listing in small chunks, as it is downloaded
+    for index in range(0, len(listing), 10):
+        parser.feed(listing[index : index + 10])
+    parser.close()
+    assert set(parser.entries) == {"file one.rpm", "repomd.xml"}
+    assert parser.entries["file one.rpm"].matches(1234)
+    assert not parser.entries["file one.rpm"].matches(4321)
+    assert parser.entries["repomd.xml"].matches(3100)
+
+
+@pytest.mark.parametrize(
+    "text,size,expected",
+    [
+        ("1234", 1234, True),
+        ("1234", 1235, False),
+        ("2.1G", int(2.1 * 1024**3), True),
+        ("2.1G", int(2.14 * 1024**3), True),
+        ("2.1G", int(2.06 * 1024**3), True),
+        # One unit of the last displayed decimal away
+        ("2.1G", int(2.2 * 1024**3), False),
+        ("2.1G", int(2.0 * 1024**3), False),
+        # A half-synced file
+        ("2.1G", int(1.5 * 1024**3), False),
+        ("512M", 512 * 1024**2 + 400 * 1024, True),
+        ("512M", 513 * 1024**2, False),
+        ("512M", 511 * 1024**2, False),
+        ("3.0K", 3100, True),
+        ("3.0KiB", 3100, True),
+        ("3.0K", 3200, False),
+    ],
+)
+def test_listed_size(text, size, expected):
+    assert parse_size(text).matches(size) is expected
+
+
+@pytest.mark.parametrize(
+    "sizes,listing,expected,checked_files",
+    [
+        ({"file one.rpm": 1234, "repomd.xml": 3100}, NGINX_LISTING, True, False),
+        ({"file one.rpm": 1235, "repomd.xml": 3100}, NGINX_LISTING, False, False),
+        # Not in the listing: check the files one by one
+        ({"file one.rpm": 1234, "other.rpm": 1}, NGINX_LISTING, True, True),
+        # Listed without a size: check the files one by one
+        ({"file one.rpm": 1234, "nosize.rpm": 1}, NOSIZE_LISTING, True, True),
+        # Not a listing
+        ({"file one.rpm": 1234, "other.rpm": 1}, "<html></html>", True, True),
+    ],
+)
+def test_scan_http_autoindex(
+    db, dir_obj, mocked_responses, sizes, listing, expected, checked_files
+):
+    """Test scanning directories with their HTTP listing"""
+    dir_obj.files = {name: {"size": size, "stat": 1} for name, size in sizes.items()}
+    db.commit()
+    dir_url = "http://localhost/testdata/pub/fedora/linux"
+    mocked_responses.get(f"{dir_url}/", body=listing, content_type="text/html")
+    connection_pool = ConnectionPool({"CRAWLER_HTTP_AUTOINDEX": True})
+    connector = connection_pool.get("http://localhost/testdata/")
+    connector.compare_sha256 = Mock(return_value=True)
+    connector._check_file = Mock(return_value=True)
+    result = connector.check_dir(dir_url, dir_obj)
+    assert result is expected
+    assert connector._check_file.called is checked_files
+    if "repomd.xml" in sizes and expected is True:
+        connector.compare_sha256.assert_called_once()
+    else:
+        connector.compare_sha256.assert_not_called()
+
+
 def test_scan_ftp(db, dir_obj_with_files):
     """Test scanning directories with ftp"""
     connection_pool = ConnectionPool({})
@@ -267,3 +483,221 @@ def test_reporter_host_disabled(config, db, site, hosts):
     db.refresh(failed_host)
     assert failed_host.user_active is False
     assert failed_host.disable_reason == "dummy crawl failure"
+
+
+def test_crawler_db_manager_pool_stats(config, tmp_path):
+    config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path.as_posix()}/test.sqlite"
+    db_manager = get_crawler_db_manager(config, threads=2)
+    with worker_session(db_manager) as session:
+        session.execute(sa.text("SELECT 1"))
+        session.commit()
+        # The connection is kept for the whole duration of the session
+        session.execute(sa.text("SELECT 1"))
+        session.commit()
+    stats = db_manager.pool_stats
+    assert stats.pool_size == 2
+    assert stats.connections == 1
+    assert stats.checkouts == 1
+    assert stats.checked_out == 0
+    assert stats.peak_checked_out == 1
+    assert stats.waits == 1
+
+
+def test_hcd_reconciler(
+    db, base_items, site, hosts, directory, category, hostcategory, hostcategorydir
+):
+    hc = db.get(model.HostCategory, 3)
+    reconciler = HostCategoryDirReconciler(db, hc, batch_size=2)
+    assert reconciler.sync_dir("pub/fedora/linux/releases/27", 5, True) == SyncStatus.UNCHANGED
+    assert (
+        reconciler.sync_dir("pub/fedora/linux/releases/27/extramirror3", 5, False)
+        == SyncStatus.NOT_UP2DATE
+    )
+    # New directories
+    assert reconciler.sync_dir("pub/fedora/linux/releases/26", 4, True) == SyncStatus.UNCHANGED
+    assert reconciler.sync_dir("pub/fedora/linux/extras", 2, False) == SyncStatus.UNKNOWN
+    assert reconciler.sync_dir("pub/fedora/linux/extras", 2, None) == SyncStatus.UNKNOWN
+    reconciler.flush()
+    # All the existing HostCategoryDirs have been seen
+    assert reconciler.set_unseen_not_up2date() == 0
+    db.commit()
+
+    hcds = db.scalars(
+        sa.select(model.HostCategoryDir).where(model.HostCategoryDir.host_category_id == 3)
+    ).all()
+    assert {hcd.path: (hcd.up2date, hcd.directory_id) for hcd in hcds} == {
+        "pub/fedora/linux/releases/27": (True, 5),
+        "pub/fedora/linux/releases/27/extramirror3": (False, 5),
+        "pub/fedora/linux/releases/26": (True, 4),
+    }
+
+
+def test_hcd_reconciler_unseen(
+    db, base_items, site, hosts, directory, category, hostcategory, hostcategorydir
+):
+    hc = db.get(model.HostCategory, 3)
+    reconciler = HostCategoryDirReconciler(db, hc)
+    assert reconciler.sync_dir("pub/fedora/linux/releases/27", 5, True) == SyncStatus.UNCHANGED
+    reconciler.flush()
+    assert reconciler.set_unseen_not_up2date() == 1
+    db.commit()
+
+    hcds = db.scalars(
+        sa.select(model.HostCategoryDir).where(model.HostCategoryDir.host_category_id == 3)
+    ).all()
+    assert {hcd.path: hcd.up2date for hcd in hcds} == {
+        "pub/fedora/linux/releases/27": True,
+        "pub/fedora/linux/releases/27/extramirror3": False,
+    }
+
+
+def test_manifest_store(db, base_items, directory, category, categorydirectory, filedetail):
+    db.get(model.Directory, 4).files = {
+        "repomd.xml": {"size": 2972, "stat": 1351758825},
+        "other.xml": {"size": "12", "stat": "1351758800"},
+    }
+    # In both categories
+    db.add(model.CategoryDirectory(category_id=2, directory_id=4))
+    db.commit()
+    directory_ids = [row.id for row in get_directory_files_by_categories(db, [1, 2])]
+    assert sorted(directory_ids) == sorted(set(directory_ids))
+    store = ManifestStore.build(db, [1, 2])
+    assert len(store) == 6
+    assert store.get(4) == DirectoryManifest(
+        files=(
+            FileEntry("other.xml", 12, 1351758800),
+            FileEntry("repomd.xml", 2972, 1351758825),
+        ),
+        repomd_sha256="foo_sha256",
+    )
+    assert store.get(3) == DirectoryManifest(files=())
+    # Directory 9 is not in the requested categories
+    assert store.get(9) is None
+
+
+def test_connector_get_manifest(db, dir_obj_with_files):
+    expected = DirectoryManifest(files=(FileEntry("does-not-exist", 1, 1),))
+    connector = ConnectionPool({}).get("http://localhost/")
+    # Without a manifest store, the manifest is read from the database
+    assert connector.get_manifest(dir_obj_with_files) == expected
+    # The store has precedence
+    manifests = ManifestStore({dir_obj_with_files.id: DirectoryManifest(files=())})
+    connector = ConnectionPool({}, manifests=manifests).get("http://localhost/")
+    assert connector.get_manifest(dir_obj_with_files) == DirectoryManifest(files=())
+
+
+def test_async_crawler_check_dir():
+    from aiohttp import web
+
+    from mirrormanager2.crawler.async_engine import AsyncCrawler, DirectoryEntry, HostPlan
+
+    async def handler(request):
+        if request.match_info["name"] == "missing":
+            raise web.HTTPNotFound()
+        return web.Response(body=b"content")
+
+    async def check_dirs():
+        app = web.Application()
+        app.router.add_route("HEAD", "/pub/{name}", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        url = f"http://127.0.0.1:{port}/pub"
+        async with aiohttp.ClientSession() as http:
+            engine = Mock(config={}, options={"host_timeout": None}, http=http)
+            host = HostPlan(id=1, name="mirror.example.com", max_connections=2)
+            crawler = AsyncCrawler(engine, host, Mock())
+            results = []
+            for files in (
+                [FileEntry("present", 7, 1)],
+                [FileEntry("present", 8, 1)],
+                [FileEntry("present", 7, 1), FileEntry("missing", 1, 1)],
+                [],
+            ):
+                directory = DirectoryEntry(1, "pub", True, DirectoryManifest(files=tuple(files)))
+                results.append(await crawler.check_dir(url, directory))
+        await runner.cleanup()
+        return results
+
+    assert asyncio.run(check_dirs()) == [True, False, False, True]
+
+
+def test_async_engine_global_timeout():
+    from mirrormanager2.crawler import threads
+    from mirrormanager2.crawler.async_engine import AsyncCrawlEngine
+    from mirrormanager2.crawler.threads import GlobalTimeoutError
+
+    engine = AsyncCrawlEngine({"threads": 2, "canary": False}, {}, Mock(), None)
+
+    async def crawl_host(progress_bar, host_id):
+        engine.host_names[host_id] = f"mirror{host_id}.example.com"
+        if host_id != 1:
+            # These crawls won't complete before the timeout
+            await asyncio.sleep(60)
+        return CrawlResult(
+            host_id=host_id,
+            host_name=f"mirror{host_id}.example.com",
+            status=CrawlStatus.OK.value,
+            details=None,
+            finished_at=datetime.now(),
+            duration=0,
+        )
+
+    engine.crawl_host = crawl_host
+    results = []
+    signal.setitimer(signal.ITIMER_REAL, 0.5)
+    try:
+        with pytest.raises(GlobalTimeoutError):
+            for result in engine.run([1, 2, 3], Mock(), timeout=3600):
+                results.append(result)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        threads.shutdown = False
+
+    assert [(r.host_id, r.host_name, r.status) for r in results[:1]] == [
+        (1, "mirror1.example.com", CrawlStatus.OK.value)
+    ]
+    # The cancelled crawls are reported like the timed out threads
+    assert sorted((r.host_id, r.host_name, r.status) for r in results[1:]) == [
+        (2, "mirror2.example.com", CrawlStatus.UNKNOWN.value),
+        (3, "mirror3.example.com", CrawlStatus.UNKNOWN.value),
+    ]
+    assert results[1].details.startswith("Crawler reached its maximum execution time")
+
+
+def test_crawler_delta_select_changed_directories(
+    db, config, base_items, site, hosts, directory, category, hostcategory
+):
+    hc = db.get(model.HostCategory, 3)
+    hc.last_full_scan = 1000
+    directories = [db.get(model.Directory, directory_id) for directory_id in (4, 5, 8, 9)]
+    # Unchanged, changed, unchanged but not up2date, unchanged but not on the host yet
+    for dir_obj, ctime, up2date in zip(directories, (500, 2000, 500, 500), (True, True, False)):
+        dir_obj.ctime = ctime
+        db.add(
+            model.HostCategoryDir(
+                host_category_id=hc.id,
+                directory_id=dir_obj.id,
+                path=get_hcd_path(hc.category.topdir.name, dir_obj.name),
+                up2date=up2date,
+            )
+        )
+    directories[3].ctime = 500
+    db.commit()
+
+    options = {"debug": False, "host_timeout": None, "delta": True}
+    crawler = Crawler(config, db, options, Mock(), hc.host)
+    reconciler = HostCategoryDirReconciler(db, hc)
+    selected = crawler._select_changed_directories(hc, directories, reconciler)
+    assert [dir_obj.id for dir_obj in selected] == [5, 8, 9]
+    assert reconciler.kept == 1
+
+    # The directory that was not checked is not marked as not up2date
+    reconciler.set_unseen_not_up2date()
+    db.commit()
+    hcds = db.scalars(
+        sa.select(model.HostCategoryDir).where(model.HostCategoryDir.host_category_id == hc.id)
+    ).all()
+    assert {hcd.directory_id: hcd.up2date for hcd in hcds} == {4: True, 5: False, 8: False}
@@ -0,0 +1,112 @@
+"""
+mirrormanager2 tests for the fullfiletimelist parser.
+"""
+
+from mirrormanager2.lib.fullfiletimelist import (
+    FullFileTimeListState,
+    get_changed_directories,
+    get_fingerprint,
+    parse_fullfiletimelist,
+    read_fullfiletimelist,
+)
+
+FFT = b"""[Version]
+2
+
+[Files]
+1386338164\td\t4096\tlinux
+1386338165\td\t4096\tlinux/releases/20
+1386338166\tf\t1196\tlinux/releases/20/Fedora-20-x86_64-CHECKSUM
+1386338167\tf-\t42\tlinux/releases/20/README
+1386338168\td\t4096\tlinux/releases/20/os/repodata
+1386338169\tf\t3456\tlinux/releases/20/os/repodata/repomd.xml
+1386338170\td\t4096\tlinux/atomic/objects
+1386338171\tf\t10\tlinux/atomic/summary
+1386338172\tl\t10\tlinux/latest
+1386338173\tf\t20\tlinux/releases/20/README.txt
+invalid line
+
+[Checksums SHA1]
+abcdef\tlinux/releases/20/README
+"""
+
+
+def test_parse_fullfiletimelist():
+    fft = parse_fullfiletimelist(FFT)
+    assert fft.ctimes == {
+        "linux": 1386338164,
+        "linux/releases/20": 1386338165,
+        "linux/releases/20/os/repodata": 1386338168,
+        "linux/atomic/objects": 1386338170,
+    }
+    assert sorted(fft.files) == [
+        "linux/atomic",
+        "linux/releases/20",
+        "linux/releases/20/os/repodata",
+    ]
+    files = fft.files["linux/releases/20"]
+    assert sorted(files) == ["Fedora-20-x86_64-CHECKSUM", "README", "README.txt"]
+    assert files["README"] == {"stat": 1386338167, "size": 42}
+    assert dict(fft.files["linux/atomic"]) == {"summary": {"stat": 1386338171, "size": 10}}
+    assert fft.repo_dirs == {"linux/releases/20/os"}
+    assert fft.atomic_dirs == {"linux/atomic"}
+
+
+def test_parse_fullfiletimelist_small_chunks(monkeypatch):
+    expected = parse_fullfiletimelist(FFT)
+    # Lines must not be cut at the chunks' boundaries
+    monkeypatch.setattr("mirrormanager2.lib.fullfiletimelist.CHUNK_SIZE", 7)
+    assert parse_fullfiletimelist(FFT) == expected
+
+
+def test_parse_fullfiletimelist_no_files_section():
+    fft = parse_fullfiletimelist(b"[Version]\n2\n")
+    assert fft.ctimes == {}
+    assert fft.files == {}
+
+
+def test_read_fullfiletimelist(tmp_path):
+    path = tmp_path / "fullfiletimelist-fedora"
+    path.write_bytes(FFT)
+    fft = read_fullfiletimelist(path.as_posix())
+    assert fft.ctimes == parse_fullfiletimelist(FFT).ctimes
+
+
+def test_get_changed_directories():
+    previous = parse_fullfiletimelist(FFT, with_digests=True)
+    assert previous.digests.keys() == {
+        "linux",
+        "linux/releases/20",
+        "linux/releases/20/os/repodata",
+        "linux/atomic",
+        "linux/atomic/objects",
+    }
+    assert get_changed_directories(previous.digests, previous.digests) == set()
+
+    new_fft = FFT.replace(
+        b"1386338167\tf-\t42\tlinux/releases/20/README\n",
+        b"1386338199\tf-\t43\tlinux/releases/20/README\n",
+    ).replace(b"1386338170\td\t4096\tlinux/atomic/objects\n", b"")
+    new = parse_fullfiletimelist(new_fft, with_digests=True)
+    assert get_changed_directories(previous.digests, new.digests) == {
+        "linux/releases/20",
+        "linux/atomic/objects",
+    }
+
+
+def test_fullfiletimelist_state(tmp_path):
+    fft_path = tmp_path / "fullfiletimelist-fedora"
+    fft_path.write_bytes(FFT)
+    fingerprint = get_fingerprint(fft_path.as_posix())
+    assert fingerprint.size == len(FFT)
+    assert get_fingerprint(fft_path.as_posix(), fingerprint) == fingerprint
+
+    state_path = (tmp_path / "state.json").as_posix()
+    assert FullFileTimeListState.load(state_path).fingerprint is None
+    FullFileTimeListState(fingerprint, {"linux": "abcd"}).save(state_path)
+    state = FullFileTimeListState.load(state_path)
+    assert state.fingerprint == fingerprint
+    assert state.digests == {"linux": "abcd"}
+
+    fft_path.write_bytes(FFT + b"\n")
+    assert get_fingerprint(fft_path.as_posix(), fingerprint).sha256 != fingerprint.sha256
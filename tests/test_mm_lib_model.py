@@ -2,6 +2,10 @@
 mirrormanager2 model tests.
 """
 
+import time
+
+import sqlalchemy as sa
+
 import mirrormanager2.lib.model as model
 
 
@@ -148,6 +152,28 @@ def test_category_repr(db, base_items, directory, category):
     assert str(item) == "<Category(2 - Fedora EPEL)>"
 
 
+def test_category_directory_cache(db, base_items, directory, category, categorydirectory):
+    """Test the Category.directory_cache index of mirrormanager2.lib.model."""
+    item = model.Category.get_by_pk(1)
+    cache = item.directory_cache
+    assert len(cache) == 5
+    assert cache[""].id == item.topdir_id
+    assert cache["releases/26"] == (4, 0, True)
+    # The cache is reloaded after being cleared
+    new_dir = model.Directory(name="pub/fedora/linux/releases/28", readable=False, ctime=42)
+    new_dir.categories.append(item)
+    db.add(new_dir)
+    db.flush()
+    assert "releases/28" not in item.directory_cache
+    item.directory_cache_clear()
+    cache = item.directory_cache
+    assert cache["releases/28"] == (new_dir.id, 42, False)
+    # The cache is updated in place
+    item.directory_cache_discard(new_dir)
+    assert item.directory_cache is cache
+    assert "releases/28" not in cache
+
+
 def test_hostcategory_repr(db, base_items, directory, category, site, hosts, hostcategory):
     """Test the HostCategory.__repr__ object of mirrormanager2.lib.model."""
     item = model.HostCategory.get_by_pk(1)
@@ -217,3 +243,37 @@ def test_user_groups(db, base_items, user_groups):
     assert item.groups == ["fpca"]
     item = model.User.get_by_pk(4)
     assert item.groups == ["fpca", "packager"]
+
+
+def test_directory_age_file_details(db, base_items, directory):
+    """Test the Directory.age_file_details method of mirrormanager2.lib.model."""
+    now = int(time.time())
+    day = 24 * 60 * 60
+    config = {"MAX_STALE_DAYS": 4}
+
+    def _add(directory_id, filename, age):
+        item = model.FileDetail(
+            filename=filename, directory_id=directory_id, timestamp=now - age * day
+        )
+        db.add(item)
+        return item
+
+    # A single entry is always kept
+    single = _add(1, "repomd.xml", 10)
+    # The most recent entry is old enough, only keep it
+    old = [_add(2, "repomd.xml", age) for age in (5, 6, 7)]
+    # The most recent entry may not have propagated, keep the previous one too
+    recent = [_add(3, "repomd.xml", age) for age in (1, 6, 7, 8)]
+    # Nothing is stale
+    fresh = [_add(3, "summary", age) for age in (0, 1, 2)]
+    group = model.FileGroup(name="group", files=[old[2]])
+    db.add(group)
+    db.commit()
+
+    deleted = model.Directory.age_file_details(db, config, batch_size=2)
+
+    assert deleted == 4
+    remaining = {fd.id for fd in db.scalars(sa.select(model.FileDetail))}
+    expected = {single.id, old[0].id, recent[0].id, recent[1].id} | {fd.id for fd in fresh}
+    assert remaining == expected
+    assert db.scalars(sa.select(model.FileDetailFileGroup)).all() == []
@@ -704,6 +704,36 @@ def test_get_mirrors_version(
     check_results_host(results)
 
 
+def test_get_mirrors_up2date(
+    db,
+    base_items,
+    site,
+    hosts,
+    directory,
+    category,
+    hostcategory,
+    hostcategorydir,
+    version,
+    repository,
+):
+    """Test that get_mirrors uses the HostCapability to list the up2date mirrors."""
+    expected = {1, 2} | set(range(4, 29))
+    results = mirrormanager2.lib.get_mirrors(db, up2date=True)
+    assert {host.id for host in results} == expected
+    results = mirrormanager2.lib.get_mirrors(db, up2date=True, version_id=1)
+    assert {host.id for host in results} == expected
+
+    # The HostCategoryDirs of host 4 are not up2date anymore
+    hc = mirrormanager2.lib.get_host(db, 4).categories[0]
+    mirrormanager2.lib.set_hostcategorydirs_up2date(db, [hcd.id for hcd in hc.directories], False)
+    mirrormanager2.lib.refresh_host_capabilities(db, 4)
+    # Host 1 is marked not up2date
+    mirrormanager2.lib.get_host(db, 1).set_not_up2date(db)
+    db.commit()
+    results = mirrormanager2.lib.get_mirrors(db, up2date=True)
+    assert {host.id for host in results} == expected - {1, 4}
+
+
 def test_get_user_sites_empty(db):
     results = mirrormanager2.lib.get_user_sites(db, "pingou")
     assert results == []
@@ -789,6 +819,19 @@ def test_get_hostcategorydir_by_hostcategoryid_and_path(
     assert result.host_category.category.name == "Fedora Linux"
 
 
+def test_get_hostcategorydirs_by_hostcategory(
+    db, base_items, site, hosts, directory, category, hostcategory, hostcategorydir
+):
+    """Test the get_hostcategorydirs_by_hostcategory function of
+    mirrormanager2.lib.
+    """
+    results = mirrormanager2.lib.get_hostcategorydirs_by_hostcategory(db, 3)
+    assert sorted((r.path, r.up2date, r.directory_id) for r in results) == [
+        ("pub/fedora/linux/releases/27", True, 5),
+        ("pub/fedora/linux/releases/27/extramirror3", True, 5),
+    ]
+
+
 def test_get_file_detail_empty(db):
     results = mirrormanager2.lib.get_file_detail(db, "repomd.xml", 7)
     assert results is None
@@ -824,3 +867,55 @@ def test_get_file_detail(db, directory, filedetail):
     results = mirrormanager2.lib.get_file_detail(db, "repomd.xml", 7, timestamp=1357758825)
     assert results.md5 == "foo_md5"
     assert results.directory.name == "pub/fedora/linux/updates/testing/25/x86_64"
+
+
+def test_uploaded_config(db, base_items, site, hosts, directory, category, hostcategory):
+    """Test the uploaded_config function of mirrormanager2.lib."""
+    db.add_all(
+        [
+            mirrormanager2.lib.model.HostCategoryDir(
+                host_category_id=1, directory_id=4, path="releases/26", up2date=False
+            ),
+            mirrormanager2.lib.model.HostCategoryDir(
+                host_category_id=1, directory_id=5, path="releases/27/extramirror1", up2date=True
+            ),
+        ]
+    )
+    db.commit()
+    host = mirrormanager2.lib.get_host(db, 1)
+    config = {
+        "version": 1,
+        "host": {"name": host.name},
+        "fedora linux": {
+            "dirtree": {
+                "": {},
+                "releases/26": {},
+                "releases/27/": {},
+                "updates/testing/26/x86_64": {},
+                # Unknown directories are not added
+                "releases/42": {},
+            }
+        },
+        # Unknown categories are ignored
+        "fedora other": {"dirtree": {"": {}}},
+    }
+
+    message = mirrormanager2.lib.uploaded_config(db, host, config, batch_size=2)
+
+    assert message == "Category Fedora Linux directories updated: 1  added: 3  deleted 1\n"
+    hcds = {
+        row.path: (row.up2date, row.directory_id)
+        for row in mirrormanager2.lib.get_hostcategorydirs_by_hostcategory(db, 1)
+    }
+    assert hcds == {
+        "": (True, 1),
+        "releases/26": (True, 4),
+        "releases/27": (True, 5),
+        "updates/testing/26/x86_64": (True, 8),
+    }
+    assert host.last_checked_in is not None
+    # The host is now listed as up2date
+    assert host in mirrormanager2.lib.get_mirrors(db, up2date=True)
+
+    message = mirrormanager2.lib.uploaded_config(db, host, config)
+    assert message == "Category Fedora Linux directories updated: 4  added: 0  deleted 0\n"
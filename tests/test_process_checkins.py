@@ -0,0 +1,231 @@
+"""
+mirrormanager2 tests for the queued report_mirror check-ins.
+"""
+
+import base64
+import bz2
+import fcntl
+import json
+import logging
+import xmlrpc.client
+
+import pytest
+import sqlalchemy as sa
+from click.testing import CliRunner
+
+import mirrormanager2.lib
+import mirrormanager2.lib.model as model
+from mirrormanager2.lib.hostconfig import encode_config
+from mirrormanager2.utility import process_checkins
+
+
+@pytest.fixture()
+def configfile(tmp_path):
+    path = tmp_path.joinpath("mirrormanager2_tests.cfg")
+    path.write_text(
+        f"SQLALCHEMY_DATABASE_URI = 'sqlite:///{tmp_path.as_posix()}/test.sqlite'\n"
+        f"CHECKIN_QUEUE_LOCK_FILE = '{tmp_path.as_posix()}/process-checkins.lock'\n"
+    )
+    return path.as_posix()
+
+
+@pytest.fixture()
+def private_hostcategory(db, base_items, site, hosts, directory, category):
+    item = model.HostCategory(host_id=3, category_id=1, always_up2date=False)
+    db.add(item)
+    db.commit()
+    return item.id
+
+
+def _make_config(dirtree, user_active="1"):
+    return {
+        "version": 0,
+        "global": {"enabled": "1"},
+        "site": {"name": "test-mirror", "password": "test_password"},
+        "host": {"name": "private.localhost", "user_active": user_active},
+        "fedora linux": {"dirtree": dirtree},
+    }
+
+
+def _checkin(client, config):
+    data = base64.urlsafe_b64encode(bz2.compress(json.dumps(config).encode())).decode()
+    response = client.post(
+        "/xmlrpc", data=xmlrpc.client.dumps((data,), "checkin"), content_type="text/xml"
+    )
+    assert response.status_code == 200
+    (result,), _method = xmlrpc.client.loads(response.data)
+    return result
+
+
+def test_checkin_queue(app, client, db, private_hostcategory, configfile, caplog):
+    """Test that check-ins are queued, then processed and merged by host."""
+    app.config["CHECKIN_QUEUE"] = True
+
+    result = _checkin(client, _make_config({"": {}, "releases/26": {}}))
+    assert result.endswith("queued for processing\nchecked in successful")
+    result = _checkin(client, _make_config({"": {}, "releases/27": {}}, user_active="0"))
+    assert result.endswith("queued for processing\nchecked in successful")
+    # Wrong credentials are refused right away
+    config = _make_config({})
+    config["site"]["password"] = "wrong"
+    result = _checkin(client, config)
+    assert result == "Config file site name or password incorrect.\nerror checking in"
+
+    checkins = mirrormanager2.lib.get_host_checkins(db)
+    assert [checkin.host_id for checkin in checkins] == [3, 3]
+    # Nothing was processed yet
+    assert mirrormanager2.lib.get_hostcategorydirs_by_hostcategory(db, private_hostcategory) == []
+
+    caplog.clear()
+    caplog.set_level(logging.INFO)
+    result = CliRunner().invoke(process_checkins.main, ["-c", configfile])
+    assert result.exit_code == 0, result.output
+
+    # The most recent check-in wins
+    db.expire_all()
+    hcds = mirrormanager2.lib.get_hostcategorydirs_by_hostcategory(db, private_hostcategory)
+    assert sorted(row.path for row in hcds) == ["", "releases/27"]
+    host = mirrormanager2.lib.get_host(db, 3)
+    assert host.user_active is False
+    assert host.last_checked_in is not None
+    assert db.scalar(sa.select(sa.func.count(model.HostCheckin.id))) == 0
+    assert caplog.messages == [
+        "Checkin for host private.localhost (2 check-ins) succesful: "
+        "Category Fedora Linux directories updated: 0  added: 2  deleted 0\n",
+        "Processed 2 check-ins, 0 hosts failed",
+    ]
+
+
+def test_checkin_without_queue(client, db, private_hostcategory):
+    """Test that check-ins are processed right away when the queue is disabled."""
+    result = _checkin(client, _make_config({"": {}, "releases/26": {}}))
+    assert result == (
+        "Category Fedora Linux directories updated: 0  added: 2  deleted 0\n"
+        "checked in successful"
+    )
+    assert mirrormanager2.lib.get_host_checkins(db) == []
+
+
+def test_process_invalid_checkin(db, private_hostcategory, configfile, caplog):
+    """Test that check-ins that can't be processed are dropped."""
+    caplog.set_level(logging.INFO)
+    host = mirrormanager2.lib.get_host(db, 3)
+    mirrormanager2.lib.add_host_checkin(db, host, b"garbage")
+    db.commit()
+
+    result = CliRunner().invoke(process_checkins.main, ["-c", configfile])
+    assert result.exit_code == 0, result.output
+
+    assert mirrormanager2.lib.get_host_checkins(db) == []
+    assert "Processed 1 check-ins, 1 hosts failed" in caplog.messages
+
+
+def test_process_some_invalid_checkins(db, private_hostcategory, configfile, caplog):
+    """Test that an invalid check-in doesn't discard the other check-ins of the host."""
+    caplog.set_level(logging.INFO)
+    host = mirrormanager2.lib.get_host(db, 3)
+    mirrormanager2.lib.add_host_checkin(
+        db, host, encode_config(_make_config({"": {}, "releases/26": {}}))
+    )
+    mirrormanager2.lib.add_host_checkin(db, host, b"garbage")
+    mirrormanager2.lib.add_host_checkin(db, host, encode_config(["not", "a", "dict"]))
+    db.commit()
+
+    result = CliRunner().invoke(process_checkins.main, ["-c", configfile])
+    assert result.exit_code == 0, result.output
+
+    db.expire_all()
+    hcds = mirrormanager2.lib.get_hostcategorydirs_by_hostcategory(db, private_hostcategory)
+    assert sorted(row.path for row in hcds) == ["", "releases/26"]
+    assert mirrormanager2.lib.get_host_checkins(db) == []
+    assert "Processed 3 check-ins, 0 hosts failed" in caplog.messages
+
+
+def test_process_checkins_locked(db, private_hostcategory, configfile, tmp_path, caplog):
+    """Test that overlapping runs don't process the same check-ins."""
+    caplog.set_level(logging.INFO)
+    host = mirrormanager2.lib.get_host(db, 3)
+    mirrormanager2.lib.add_host_checkin(db, host, encode_config(_make_config({"": {}})))
+    db.commit()
+
+    with open(tmp_path / "process-checkins.lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        result = CliRunner().invoke(process_checkins.main, ["-c", configfile])
+    assert result.exit_code == 0, result.output
+    assert "Another mm2_process-checkins is running, exiting" in caplog.messages
+    assert len(mirrormanager2.lib.get_host_checkins(db)) == 1
+
+
+def test_delta_checkin(app, client, db, private_hostcategory):
+    """Test the version 1 check-ins, which only send the changes since the previous one."""
+    # Delta check-ins are never queued
+    app.config["CHECKIN_QUEUE"] = True
+
+    def _hcd_paths():
+        db.expire_all()
+        hcds = mirrormanager2.lib.get_hostcategorydirs_by_hostcategory(db, private_hostcategory)
+        return sorted(row.path for row in hcds)
+
+    def _delta_config(base, fingerprint, added=(), removed=()):
+        config = _make_config({})
+        config["version"] = 1
+        config["fedora linux"] = {
+            "delta": {
+                "base": base,
+                "fingerprint": fingerprint,
+                "added": list(added),
+                "removed": list(removed),
+            }
+        }
+        return config
+
+    # Without a known tree, the whole tree is requested
+    result = _checkin(client, _delta_config("fp0", "fp1", added=["releases/26"]))
+    assert result == {
+        "message": "Category Fedora Linux full report requested\nchecked in successful",
+        "full_report": ["fedora linux"],
+    }
+    assert _hcd_paths() == []
+
+    app.config["CHECKIN_QUEUE"] = False
+    config = _make_config({"": {}, "releases/26": {}})
+    config["version"] = 1
+    config["fedora linux"]["fingerprint"] = "fp1"
+    result = _checkin(client, config)
+    assert result == {
+        "message": "Category Fedora Linux directories updated: 0  added: 2  deleted 0\n"
+        "checked in successful",
+        "full_report": [],
+    }
+    hc = db.get(model.HostCategory, private_hostcategory)
+    assert hc.dirtree_fingerprint == "fp1"
+
+    app.config["CHECKIN_QUEUE"] = True
+    # Directories unknown to the database are ignored
+    result = _checkin(
+        client,
+        _delta_config("fp1", "fp2", added=["releases/27", "unknown"], removed=["releases/26"]),
+    )
+    assert result == {
+        "message": "Category Fedora Linux directories updated: 1  added: 1  deleted 1\n"
+        "checked in successful",
+        "full_report": [],
+    }
+    assert _hcd_paths() == ["", "releases/27"]
+    assert db.get(model.HostCategory, private_hostcategory).dirtree_fingerprint == "fp2"
+    assert mirrormanager2.lib.get_host_checkins(db) == []
+
+    # The client missed a check-in, the delta is ignored
+    result = _checkin(client, _delta_config("fp1", "fp3", removed=["releases/27"]))
+    assert result["full_report"] == ["fedora linux"]
+    assert _hcd_paths() == ["", "releases/27"]
+    assert db.get(model.HostCategory, private_hostcategory).dirtree_fingerprint == "fp2"
+
+    # Errors are reported in the struct too
+    config = _delta_config("fp2", "fp3")
+    config["site"]["password"] = "wrong"
+    result = _checkin(client, config)
+    assert result == {
+        "message": "Config file site name or password incorrect.\nerror checking in",
+        "full_report": [],
+    }
@@ -2,8 +2,10 @@
 mirrormanager2 tests for the `Update Master Directory List` (UMDL) cron.
 """
 
+import hashlib
 import logging
 import os
+import re
 
 import pytest
 import sqlalchemy as sa
@@ -274,3 +276,247 @@ def test_1_umdl(db, command_args, base_items, directory, category, categorydirec
 
     results = db.execute(sa.select(model.HostCategoryDir)).scalars().all()
     assert len(results) == 0
+
+
+def test_umdl_twice(db, command_args, base_items, directory, category, categorydirectory, caplog):
+    """Test that running the umdl cron again on the same tree changes nothing."""
+    result = run_command(command_args)
+    assert result.exit_code == 0, result.output
+    directories = db.execute(sa.select(model.Directory.id, model.Directory.ctime)).all()
+    caplog.clear()
+    caplog.set_level(logging.INFO)
+
+    result = run_command(command_args)
+    assert result.exit_code == 0, result.output
+    assert "Fedora Linux: 0 directories created, 0 updated" in caplog.messages
+    db.expire_all()
+    assert db.execute(sa.select(model.Directory.id, model.Directory.ctime)).all() == directories
+
+
+def test_has_changed_checksum_files():
+    loader_class = mirrormanager2.lib.umdl.FileDetailFromChecksumsLoader
+    files = {
+        "Fedora-Live-x86_64-20-CHECKSUM": {"size": "1196", "stat": 1386000000},
+        "Fedora-Live-KDE-x86_64-20-1.iso": {"size": "1", "stat": 1387000000},
+    }
+    assert loader_class.has_changed_checksum_files(files, 1385000000)
+    # Only the checksum files are considered
+    assert not loader_class.has_changed_checksum_files(files, 1386000000)
+    assert not loader_class.has_changed_checksum_files({}, 0)
+
+
+def test_umdl_fullfiletimelist_cache(db, base_items, directory, category, tmp_path, caplog):
+    """Test that unchanged fullfiletimelists are skipped, and changed ones are diffed."""
+    caplog.set_level(logging.INFO)
+    category = mirrormanager2.lib.get_category_by_name(db, "Fedora EPEL")
+    path = tmp_path.joinpath("srv", category.topdir.name)
+    for dirname in ("8", "9"):
+        path.joinpath(dirname).mkdir(parents=True)
+    fft_path = path.joinpath("fullfiletimelist-epel")
+    fft_lines = [
+        "[Files]",
+        "1700000001\td\t4096\t8",
+        "1700000002\tf\t42\t8/foo.rpm",
+    ]
+    fft_path.write_text("\n".join(fft_lines) + "\n")
+    config = {
+        "UMDL_PREFIX": f"{tmp_path.as_posix()}/srv/",
+        "UMDL_FULLFILETIMELIST_CACHE_DIR": tmp_path.as_posix(),
+    }
+
+    def sync():
+        syncer = update_master_directory_list.FFTDirSynchronizer(
+            db, config, category, path.as_posix()
+        )
+        syncer.sync()
+
+    sync()
+    assert category.directory_cache["8"].ctime == 1700000001
+    assert os.path.exists(tmp_path.joinpath(f"category-{category.id}.json"))
+
+    caplog.clear()
+    sync()
+    assert caplog.messages == [
+        f"{fft_path.as_posix()} has not changed since the last run, skipping"
+    ]
+
+    caplog.clear()
+    fft_lines.append("1700000003\td\t4096\t9")
+    fft_path.write_text("\n".join(fft_lines) + "\n")
+    sync()
+    assert "1 directories changed since the previous fullfiletimelist" in caplog.messages
+    assert category.directory_cache["9"].ctime == 1700000003
+    assert category.directory_cache["8"].ctime == 1700000001
+
+
+def test_umdl_fullfiletimelist_top_level_repodata(db, base_items, directory, category, tmp_path):
+    """Test that a repodata at the top of the category marks the category directory."""
+    category = mirrormanager2.lib.get_category_by_name(db, "Fedora EPEL")
+    path = tmp_path.joinpath("srv", category.topdir.name)
+    path.mkdir(parents=True)
+    path.joinpath("fullfiletimelist-epel").write_text(
+        "\n".join(
+            [
+                "[Files]",
+                "1700000001\td\t4096\trepodata",
+                "1700000002\tf\t42\trepodata/repomd.xml",
+                "1700000003\tf\t42\tfoo.rpm",
+                "1700000004\td\t4096\t8",
+                "1700000005\td\t4096\t8/repodata",
+            ]
+        )
+        + "\n"
+    )
+    config = {"UMDL_PREFIX": f"{tmp_path.as_posix()}/srv/"}
+    syncer = update_master_directory_list.FFTDirSynchronizer(db, config, category, path.as_posix())
+    data = syncer._parse_fullfiletimelist()
+    topdir = category.topdir.name
+    assert data["repo_dirs"] == {topdir, f"{topdir}/8"}
+    assert topdir in data["ctimes"]
+    assert list(data["files"][topdir]) == ["foo.rpm"]
+
+
+def test_hash_file(tmp_path):
+    path = tmp_path.joinpath("repomd.xml")
+    path.write_bytes(b"x" * 1000)
+    with open(path, "rb") as f:
+        size, digests = mirrormanager2.lib.umdl.hash_file(f, chunk_size=64)
+    assert size == 1000
+    assert digests.keys() == {"md5", "sha1", "sha256", "sha512"}
+    assert digests["sha256"] == hashlib.sha256(b"x" * 1000).hexdigest()
+    assert digests["md5"] == hashlib.md5(b"x" * 1000).hexdigest()
+
+
+def test_make_file_details_digest_cache(db, base_items, directory, tmp_path, monkeypatch):
+    """Test that the repository metadata files are only hashed when they change."""
+    cache_path = tmp_path.joinpath("digests.json")
+    config = {"UMDL_DIGEST_CACHE": cache_path.as_posix()}
+    repodir = tmp_path.joinpath("atomic", "21")
+    repodir.mkdir(parents=True)
+    summary = repodir.joinpath("summary")
+    summary.write_bytes(b"summary")
+    d = mirrormanager2.lib.get_directory_by_name(db, "pub/fedora/linux/releases/26")
+    hashed = []
+    hash_file = mirrormanager2.lib.umdl.hash_file
+
+    def _hash_file(f, *args, **kwargs):
+        hashed.append(f.name)
+        return hash_file(f, *args, **kwargs)
+
+    monkeypatch.setattr(mirrormanager2.lib.umdl, "hash_file", _hash_file)
+
+    repomaker = mirrormanager2.lib.umdl.RepoMaker(db, config)
+    assert repomaker.make_file_details(d, tmp_path.as_posix(), "atomic/21", "summary") is True
+    repomaker.digest_cache.save()
+    assert hashed == [summary.as_posix()]
+
+    # Unchanged: the digests come from the cache of the previous run
+    repomaker = mirrormanager2.lib.umdl.RepoMaker(db, config)
+    assert repomaker.make_file_details(d, tmp_path.as_posix(), "atomic/21", "summary") is False
+    assert hashed == [summary.as_posix()]
+
+    # Changed
+    summary.write_bytes(b"new summary")
+    assert repomaker.make_file_details(d, tmp_path.as_posix(), "atomic/21", "summary") is True
+    assert hashed == [summary.as_posix()] * 2
+    fd = mirrormanager2.lib.get_file_detail(db, "summary", d.id, reverse=True)
+    assert fd.size == len(b"new summary")
+    assert fd.sha256 == hashlib.sha256(b"new summary").hexdigest()
+
+
+def test_digest_cache_save_prune(tmp_path):
+    """Test that the entries of the files that are gone are dropped."""
+    cache_path = tmp_path.joinpath("digests.json").as_posix()
+    s = os.stat(tmp_path)
+    cache = mirrormanager2.lib.umdl.DigestCache(cache_path)
+    for path in ("/srv/a/repomd.xml", "/srv/a/gone/repomd.xml", "/srv/b/repomd.xml"):
+        cache.set(path, s, 1, {"sha256": "x"})
+    cache.save()
+
+    cache = mirrormanager2.lib.umdl.DigestCache.load(cache_path)
+    assert cache.get("/srv/a/repomd.xml", s) == (1, {"sha256": "x"})
+    # Only the entries below the pruned directory are dropped
+    cache.save(prune="/srv/a")
+    cache = mirrormanager2.lib.umdl.DigestCache.load(cache_path)
+    assert cache.get("/srv/a/repomd.xml", s) is not None
+    assert cache.get("/srv/a/gone/repomd.xml", s) is None
+    assert cache.get("/srv/b/repomd.xml", s) is not None
+    # No temporary file is left behind
+    assert os.listdir(tmp_path) == ["digests.json"]
+
+
+def test_path_component_matcher():
+    names = ["x86_64", "9.newkey", "9", "i386", "el/7", "20"]
+    matcher = mirrormanager2.lib.umdl.PathComponentMatcher(names, get_name=lambda name: name)
+    paths = [
+        "",
+        "x86_64",
+        "releases/20/Everything/x86_64/os",
+        "releases/9.newkey/i386/os",
+        "releases/9xnewkey/i386",
+        "releases/9/i386",
+        "epel/el/7/x86_64",
+        "releases/200/Everything/x86_64_v2/os",
+        "i386/20",
+    ]
+    for path in paths:
+        expected = None
+        for name in names:
+            if re.compile(f".*(^|/){name}(/|$).*").match(path):
+                expected = name
+                break
+        assert matcher.match(path) == expected, path
+
+    # Added items come last
+    matcher.add("Everything")
+    assert matcher.match("releases/Everything/x86_64") == "x86_64"
+    assert matcher.match("releases/Everything/aarch64") == "Everything"
+
+
+def test_compile_excludes():
+    excludes = update_master_directory_list.compile_excludes(
+        update_master_directory_list.STD_EXCLUDES + [r"pub/archive"]
+    )
+    is_excluded = update_master_directory_list.is_excluded
+    assert is_excluded("pub/fedora/.snapshot", excludes)
+    assert is_excluded("pub/fedora/.~tmp~", excludes)
+    assert is_excluded("pub/archive/fedora", excludes)
+    assert not is_excluded("pub/fedora/linux", excludes)
+    assert not is_excluded("pub/fedora", update_master_directory_list.compile_excludes([]))
+
+
+def test_file_detail_from_checksums_loader(db, base_items, directory, tmp_path):
+    """Test that the checksums are only added once, and added again when they change."""
+    d = mirrormanager2.lib.get_directory_by_name(db, "pub/fedora/linux/releases/26")
+    tmp_path.joinpath("images").mkdir()
+    checksums = tmp_path.joinpath("images", "Fedora-26-CHECKSUM")
+    checksums.write_text(
+        f"SHA256 (Fedora-26.iso) = {'a' * 64}\n"
+        f"SHA256 (Fedora-26-boot.iso) = {'b' * 64}\n"
+        f"SHA256 (pxeboot/vmlinuz) = {'c' * 64}\n"
+    )
+    files = {
+        "Fedora-26-CHECKSUM": {"size": "100", "stat": 1500000000},
+        "Fedora-26.iso": {"size": "1000", "stat": 1500000000},
+        "Fedora-26-boot.iso": {"size": "10", "stat": 1500000000},
+    }
+    config = {"UMDL_PREFIX": tmp_path.as_posix()}
+
+    def _load():
+        mirrormanager2.lib.umdl.FileDetailFromChecksumsListLoader(
+            db, config, d, files, relative_dir_name="images"
+        ).load()
+        query = sa.select(model.FileDetail.filename, model.FileDetail.size).where(
+            model.FileDetail.directory_id == d.id
+        )
+        return sorted(db.execute(query).all())
+
+    expected = [("Fedora-26-boot.iso", 10), ("Fedora-26.iso", 1000)]
+    assert _load() == expected
+    assert _load() == expected
+
+    files["Fedora-26.iso"] = {"size": "2000", "stat": 1500000001}
+    assert _load() == [("Fedora-26-boot.iso", 10), ("Fedora-26.iso", 1000), ("Fedora-26.iso", 2000)]
+    fd = mirrormanager2.lib.get_file_detail(db, "Fedora-26.iso", d.id, reverse=True)
+    assert fd.sha256 == "a" * 64
+    assert fd.timestamp == 1500000001
@@ -0,0 +1,86 @@
+import os
+
+import pytest
+
+from mirrormanager2.lib.walk import walk_tree
+
+
+@pytest.fixture
+def tree(tmp_path):
+    for dirname in ("a/b/c", "a/d", "e", "e/.snapshot/f"):
+        (tmp_path / dirname).mkdir(parents=True)
+    for filename in ("top.txt", "a/b/c/file.rpm", "a/d/file1", "a/d/file2", "e/.snapshot/f/x"):
+        (tmp_path / filename).write_text(filename)
+    # A symlink to a directory is listed but not walked
+    os.symlink("a", tmp_path / "link-to-a")
+    # A broken symlink is a file
+    os.symlink("missing", tmp_path / "e" / "broken")
+    return tmp_path
+
+
+def _walk(top):
+    result = {}
+    for dirpath, dirnames, filenames in os.walk(top):
+        path = os.path.relpath(dirpath, top)
+        result["" if path == "." else path] = (sorted(dirnames), sorted(filenames))
+    return result
+
+
+@pytest.mark.parametrize("max_workers", [1, 4])
+def test_walk_tree(tree, max_workers):
+    scanned = {
+        d.path: (sorted(d.dirnames), sorted(d.filenames))
+        for d in walk_tree(str(tree), max_workers=max_workers)
+    }
+    assert scanned == _walk(str(tree))
+
+
+def test_walk_tree_parents_first(tree):
+    seen = set()
+    for scanned in walk_tree(str(tree), max_workers=4):
+        if scanned.path:
+            assert os.path.dirname(scanned.path) in seen
+        seen.add(scanned.path)
+    assert len(seen) == 8
+
+
+def test_walk_tree_exclude(tree):
+    excluded = []
+
+    def exclude(path):
+        if path.endswith(".snapshot"):
+            excluded.append(path)
+            return True
+        return False
+
+    paths = {d.path for d in walk_tree(str(tree), exclude=exclude, max_workers=2)}
+    assert paths == {"", "a", "a/b", "a/b/c", "a/d", "e"}
+    assert excluded == ["e/.snapshot"]
+
+
+def test_walk_tree_stat_files(tree):
+    calls = []
+
+    def stat_files(path, s):
+        calls.append(path)
+        assert s.st_ino == os.stat(tree / path).st_ino
+        return path in ("a/d", "e")
+
+    scanned = {d.path: d for d in walk_tree(str(tree), stat_files=stat_files, max_workers=2)}
+    assert sorted(calls) == sorted(scanned)
+    assert scanned["a/b/c"].files is None
+    assert scanned["a/d"].files.keys() == {"file1", "file2"}
+    assert scanned["a/d"].files["file1"].st_size == len("a/d/file1")
+    # The broken symlink can't be stat()ed
+    assert scanned["e"].filenames == ["broken"]
+    assert scanned["e"].files == {}
+
+
+def test_walk_tree_unreadable(tmp_path):
+    assert list(walk_tree(str(tmp_path / "missing"))) == []
+
+
+def test_walk_tree_interrupted(tree):
+    walker = walk_tree(str(tree), max_workers=2)
+    assert next(walker).path == ""
+    walker.close()